@@ -0,0 +1,141 @@
+"""
+Compact storage for resolved analytics rows.
+"""
+from array import array
+from datetime import date
+from itertools import groupby
+
+# Ordinals of all supported dates fit in 20 bits, so (key id, date) sorts as one integer
+_DATE_BITS = 20
+
+# Rows appended before the accumulator is compacted for the first time
+COMPACT_THRESHOLD = 100000
+
+
+class StatsAccumulator(object):
+    """
+    Accumulates integer values by (key, date).
+
+    Keys are interned and dates stored as proleptic ordinals, so a cell
+    costs a few machine words in ``array('l')`` columns instead of nested
+    dicts. Rows for the same (key, date) are merged when the accumulator is
+    compacted: with ``merge='sum'`` the values are added together (e.g.
+    visits to the same dataset in different languages), with
+    ``merge='replace'`` the latest added row wins.
+    """
+
+    def __init__(self, columns, merge='sum'):
+        if merge not in ('sum', 'replace'):
+            raise ValueError("merge should be either 'sum' or 'replace'")
+        self.columns = tuple(columns)
+        self.merge = merge
+        self.keys = []
+        self.key_ids = {}
+        self.key_column = array('l')
+        self.date_column = array('l')
+        self.value_columns = [array('l') for _ in self.columns]
+        self.compacted_size = 0
+
+    def add(self, key, date_ordinal, *values):
+        key_id = self.key_ids.get(key)
+        if key_id is None:
+            key_id = self.key_ids[key] = len(self.keys)
+            self.keys.append(key)
+        self.key_column.append(key_id)
+        self.date_column.append(date_ordinal)
+        for column, value in zip(self.value_columns, values):
+            column.append(value)
+
+        # Compact whenever the uncompacted tail has grown as large as the compacted part
+        if len(self.date_column) >= max(COMPACT_THRESHOLD, 2 * self.compacted_size):
+            self.compact()
+
+    def extend(self, other):
+        '''
+        Adds all cells of another accumulator with the same columns, as if
+        they were added after the cells of this one
+        '''
+        other.compact()
+        for i in xrange(len(other.date_column)):
+            self.add(other.keys[other.key_column[i]], other.date_column[i],
+                     *[column[i] for column in other.value_columns])
+
+    def compact(self):
+        '''
+        Sorts the cells by (key, date) and merges cells with the same key and date
+        '''
+        if len(self.date_column) == self.compacted_size:
+            # Nothing added since the last compaction
+            return
+        key_column = self.key_column
+        date_column = self.date_column
+        value_columns = self.value_columns
+
+        # sorted() is stable, so rows of the same cell stay in the order they were added
+        order = sorted(xrange(len(date_column)),
+                       key=lambda i: key_column[i] << _DATE_BITS | date_column[i])
+
+        new_keys = array('l')
+        new_dates = array('l')
+        new_values = [array('l') for _ in value_columns]
+        replace = self.merge == 'replace'
+        previous = None
+        for i in order:
+            cell = (key_column[i], date_column[i])
+            if cell == previous:
+                for new_column, column in zip(new_values, value_columns):
+                    new_column[-1] = column[i] if replace else new_column[-1] + column[i]
+            else:
+                new_keys.append(cell[0])
+                new_dates.append(cell[1])
+                for new_column, column in zip(new_values, value_columns):
+                    new_column.append(column[i])
+                previous = cell
+
+        self.key_column = new_keys
+        self.date_column = new_dates
+        self.value_columns = new_values
+        self.compacted_size = len(new_dates)
+
+    def drop_before(self, first_date):
+        '''
+        Removes the cells dated before first_date
+
+        :return: number of cells removed
+        '''
+        self.compact()
+        first = first_date.toordinal()
+        keep = [i for i in xrange(len(self.date_column)) if self.date_column[i] >= first]
+        dropped = len(self.date_column) - len(keep)
+        if dropped:
+            self.key_column = array('l', (self.key_column[i] for i in keep))
+            self.date_column = array('l', (self.date_column[i] for i in keep))
+            self.value_columns = [array('l', (column[i] for i in keep)) for column in self.value_columns]
+            self.compacted_size = len(keep)
+        return dropped
+
+    def __len__(self):
+        '''
+        Number of distinct (key, date) cells
+        '''
+        self.compact()
+        return len(self.date_column)
+
+    def rows(self):
+        '''
+        Yields (key, date, values) ordered by the order the keys were first
+        added in and then by date, one per distinct cell
+        '''
+        self.compact()
+        keys = self.keys
+        for i in xrange(len(self.date_column)):
+            yield (keys[self.key_column[i]],
+                   date.fromordinal(self.date_column[i]),
+                   tuple(column[i] for column in self.value_columns))
+
+    def groups(self):
+        '''
+        Yields (key, [(date, values), ...]) with the cells of each key sorted by date
+        '''
+        for key, rows in groupby(self.rows(), lambda row: row[0]):
+            yield key, [(row[1], row[2]) for row in rows]
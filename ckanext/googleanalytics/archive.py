@@ -0,0 +1,139 @@
+"""
+Archives of raw Google Analytics rows.
+
+``extract`` writes the rows of every query type and date window into
+``<directory>/<query type>/<start date>_<end date>.ndjson.gz``, one JSON
+array per line, and lists the files in ``<directory>/manifest.json``.
+``load`` replays an archive through the resolvers and save functions, so
+stats can be re-derived without spending API quota.
+"""
+import os
+import json
+import gzip
+import hashlib
+import datetime
+
+from ckanext.googleanalytics.accumulator import StatsAccumulator
+
+log = __import__('logging').getLogger(__name__)
+
+MANIFEST = 'manifest.json'
+MANIFEST_VERSION = 1
+
+# Rows handed to a resolver at once while loading
+RESOLVE_BATCH = 10000
+
+
+def _file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(65536), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class ArchiveWriter(object):
+    def __init__(self, directory, profile_id):
+        if os.path.exists(os.path.join(directory, MANIFEST)):
+            raise ValueError('%s already contains an archive' % directory)
+        self.directory = directory
+        self.manifest = {
+            'version': MANIFEST_VERSION,
+            'created': datetime.datetime.utcnow().isoformat(),
+            'profile_id': profile_id,
+            'queries': {},
+            'files': [],
+        }
+
+    def write_window(self, query, start_date, end_date, rows):
+        '''
+        Writes the rows of one query type and window and adds the file to the manifest
+        '''
+        start_date = start_date.strftime('%Y-%m-%d')
+        end_date = end_date.strftime('%Y-%m-%d')
+        query_directory = os.path.join(self.directory, query['type'])
+        if not os.path.isdir(query_directory):
+            os.makedirs(query_directory)
+
+        relative_path = os.path.join(query['type'], '%s_%s.ndjson.gz' % (start_date, end_date))
+        path = os.path.join(self.directory, relative_path)
+        with gzip.open(path, 'wb') as f:
+            for row in rows:
+                f.write(json.dumps(row))
+                f.write('\n')
+
+        self.manifest['queries'][query['type']] = dict(
+            (key, query[key]) for key in ('filters', 'metrics', 'sort', 'dimensions'))
+        self.manifest['files'].append({
+            'type': query['type'],
+            'start_date': start_date,
+            'end_date': end_date,
+            'path': relative_path,
+            'rows': len(rows),
+            'sha256': _file_sha256(path),
+        })
+
+    def close(self):
+        path = os.path.join(self.directory, MANIFEST)
+        with open(path + '.tmp', 'w') as f:
+            json.dump(self.manifest, f, indent=2, sort_keys=True)
+        os.rename(path + '.tmp', path)
+
+
+class ArchiveReader(object):
+    def __init__(self, directory):
+        self.directory = directory
+        with open(os.path.join(directory, MANIFEST)) as f:
+            self.manifest = json.load(f)
+        if self.manifest.get('version') != MANIFEST_VERSION:
+            raise ValueError('Unsupported archive version %s' % self.manifest.get('version'))
+
+    def entries(self, query_type):
+        '''
+        Files of the query type, in the order they were extracted
+        '''
+        return [entry for entry in self.manifest['files'] if entry['type'] == query_type]
+
+    def path(self, entry):
+        return os.path.join(self.directory, entry['path'])
+
+    def verify(self, entry):
+        if _file_sha256(self.path(entry)) != entry['sha256']:
+            raise ValueError('Checksum mismatch in %s' % entry['path'])
+
+
+def read_rows(path):
+    with gzip.open(path, 'rb') as f:
+        for line in f:
+            yield json.loads(line)
+
+
+def resolve_file(resolver, path, data):
+    '''
+    Feeds the rows of one archive file to a resolver in batches
+    '''
+    batch = []
+    for row in read_rows(path):
+        batch.append(row)
+        if len(batch) >= RESOLVE_BATCH:
+            resolver({'rows': batch}, data)
+            batch = []
+    if batch:
+        resolver({'rows': batch}, data)
+    return data
+
+
+# The command of the current worker process, inherited from the parent on fork
+_command = None
+
+
+def resolve_file_task(task):
+    '''
+    Pool task resolving one archive file into its own accumulator
+    '''
+    query_type, columns, merge, path = task
+    _command.malformed_rows.clear()
+    data = StatsAccumulator(columns, merge=merge)
+    resolve_file(getattr(_command, 'resolver_type_%s' % query_type), path, data)
+    data.compact()
+    return data, _command.malformed_rows[query_type]
@@ -0,0 +1,384 @@
+"""
+Multi-process historical backfill.
+
+The date range is split into consecutive, non-overlapping windows which a
+pool of worker processes fetches and resolves. Workers write the resolved
+rows into staging tables, and once every window is done the staged rows
+replace the date range in package_stats, resource_stats,
+audience_location_date and search_terms in a single transaction.
+
+Every run stages into tables of its own, and a PostgreSQL advisory lock
+keeps a second backfill from running at the same time.
+"""
+import uuid
+import datetime
+import multiprocessing
+from contextlib import contextmanager
+
+from sqlalchemy import MetaData, Table, Column, types, select, func, and_, or_, not_, exists
+import ckan.model as model
+
+from ckanext.googleanalytics.model import PackageStats, ResourceStats, AudienceLocation, AudienceLocationDate, \
+    AudienceLocationTotals, SearchStats, get_compacted_before
+from ckanext.googleanalytics.accumulator import StatsAccumulator
+from ckanext.googleanalytics import bulkload
+
+log = __import__('logging').getLogger(__name__)
+
+STAGING_INSERT_BATCH = 5000
+LOOKUP_BATCH = 1000
+
+# pg_advisory_lock key held by a running backfill
+LOCK_ID = 0x67616266
+
+
+class StagingTables(object):
+    """
+    The staging tables of one backfill run. Their names end with the run
+    id, so that runs never write into or drop each other's tables.
+    """
+
+    def __init__(self, run_id=None):
+        self.run_id = run_id or uuid.uuid4().hex[:12]
+        self.metadata = MetaData()
+        self.package_stats = Table(
+            'package_stats_staging_%s' % self.run_id, self.metadata,
+            Column('package_id', types.UnicodeText, nullable=False),
+            Column('visit_date', types.DateTime, nullable=False),
+            Column('visits', types.Integer, nullable=False),
+            Column('entrances', types.Integer, nullable=False),
+            Column('downloads', types.Integer, nullable=False),
+        )
+        self.resource_stats = Table(
+            'resource_stats_staging_%s' % self.run_id, self.metadata,
+            Column('resource_id', types.UnicodeText, nullable=False),
+            Column('visit_date', types.DateTime, nullable=False),
+            Column('visits', types.Integer, nullable=False),
+        )
+        self.audience_location_date = Table(
+            'audience_location_date_staging_%s' % self.run_id, self.metadata,
+            Column('location_name', types.UnicodeText, nullable=False),
+            Column('date', types.DateTime, nullable=False),
+            Column('visits', types.Integer, nullable=False),
+        )
+        self.search_terms = Table(
+            'search_terms_staging_%s' % self.run_id, self.metadata,
+            Column('search_term', types.UnicodeText, nullable=False),
+            Column('date', types.DateTime, nullable=False),
+            Column('count', types.Integer, nullable=False),
+        )
+
+    def for_query_type(self, query_type):
+        return {
+            'package': self.package_stats,
+            'package_downloads': self.package_stats,
+            'resource': self.resource_stats,
+            'visitorlocation': self.audience_location_date,
+            'search_terms': self.search_terms,
+        }[query_type]
+
+    def create(self):
+        self.metadata.create_all(model.meta.engine)
+
+    def drop(self):
+        self.metadata.drop_all(model.meta.engine)
+
+
+@contextmanager
+def backfill_lock():
+    '''
+    Holds the backfill advisory lock on a connection of its own for the
+    duration of the block
+
+    :raises Exception: if another backfill holds the lock
+    '''
+    if model.meta.engine.dialect.name != 'postgresql':
+        yield
+        return
+    connection = model.meta.engine.connect()
+    try:
+        if not connection.execute(select([func.pg_try_advisory_lock(LOCK_ID)])).scalar():
+            raise Exception('Another backfill is running')
+        try:
+            yield
+        finally:
+            connection.execute(select([func.pg_advisory_unlock(LOCK_ID)]))
+    finally:
+        connection.close()
+
+
+def split_windows(start_date, end_date, days):
+    '''
+    Splits the dates from start_date to end_date (inclusive) into
+    consecutive windows of at most ``days`` days.
+
+    :return: [(window_start, window_end), ...]
+    '''
+    windows = []
+    while start_date <= end_date:
+        window_end = min(start_date + datetime.timedelta(days=days - 1), end_date)
+        windows.append((start_date, window_end))
+        start_date = window_end + datetime.timedelta(days=1)
+    return windows
+
+
+def _chunks(items, size):
+    for i in xrange(0, len(items), size):
+        yield items[i:i + size]
+
+
+def lookup_package_ids(keys):
+    '''
+    Maps package names and ids to package ids with one query per batch of keys.
+    Keys that match no package are left out.
+    '''
+    package_ids = {}
+    for chunk in _chunks(list(keys), LOOKUP_BATCH):
+        rows = (model.Session.query(model.Package.id, model.Package.name)
+                .filter(or_(model.Package.id.in_(chunk), model.Package.name.in_(chunk)))
+                .all())
+        for package_id, name in rows:
+            package_ids[package_id] = package_id
+            package_ids[name] = package_id
+    return package_ids
+
+
+def lookup_resource_ids(keys):
+    resource_ids = set()
+    for chunk in _chunks(list(keys), LOOKUP_BATCH):
+        resource_ids.update(row[0] for row in
+                            model.Session.query(model.Resource.id).filter(model.Resource.id.in_(chunk)).all())
+    return resource_ids
+
+
+def _staging_rows(query_type, data):
+    '''
+    Converts the resolved rows of one query type to rows of its staging table
+    '''
+    if query_type in ('package', 'package_downloads'):
+        package_ids = lookup_package_ids(data.keys)
+        for key, visit_date, values in data.rows():
+            package_id = package_ids.get(key)
+            if package_id is None:
+                continue
+            if query_type == 'package':
+                visits, entrances, downloads = values[0], values[1], 0
+            else:
+                visits, entrances, downloads = 0, 0, values[0]
+            yield {'package_id': package_id, 'visit_date': visit_date,
+                   'visits': visits, 'entrances': entrances, 'downloads': downloads}
+    elif query_type == 'resource':
+        resource_ids = lookup_resource_ids(data.keys)
+        for key, visit_date, values in data.rows():
+            if key in resource_ids:
+                yield {'resource_id': key, 'visit_date': visit_date, 'visits': values[0]}
+    elif query_type == 'visitorlocation':
+        for key, visit_date, values in data.rows():
+            yield {'location_name': key, 'date': visit_date, 'visits': values[0]}
+    elif query_type == 'search_terms':
+        for key, visit_date, values in data.rows():
+            yield {'search_term': key, 'date': visit_date, 'count': values[0]}
+
+
+def stage(staging, query_type, data):
+    '''
+    Writes resolved rows into the staging table of the query type
+
+    :param staging: StagingTables of the run
+    :return: number of rows staged
+    '''
+    table = staging.for_query_type(query_type)
+    if bulkload.supports_bulk_load(model.meta.engine):
+        columns = [column.name for column in table.columns]
+        not_null = [column.name for column in table.columns if isinstance(column.type, types.UnicodeText)]
+        with model.meta.engine.begin() as connection:
+            return bulkload.copy_rows(connection, table.name, columns,
+                                      ([row[column] for column in columns]
+                                       for row in _staging_rows(query_type, data)), not_null=not_null)
+
+    staged = 0
+    batch = []
+    for row in _staging_rows(query_type, data):
+        batch.append(row)
+        if len(batch) >= STAGING_INSERT_BATCH:
+            model.meta.engine.execute(table.insert(), batch)
+            staged += len(batch)
+            batch = []
+    if batch:
+        model.meta.engine.execute(table.insert(), batch)
+        staged += len(batch)
+    return staged
+
+
+def location_total_deltas(connection, in_range, staged_table):
+    '''
+    Changes of AudienceLocationTotals when the visits in_range are replaced
+    with the staged ones, read before the replaced rows are deleted
+    '''
+    location_table = AudienceLocation.__table__
+    location_date_table = AudienceLocationDate.__table__
+    staged = staged_table.c
+
+    deltas = {}
+    for location_id, visits in connection.execute(
+            select([location_date_table.c.location_id, func.sum(location_date_table.c.visits)])
+            .where(and_(in_range, location_date_table.c.location_id != None))  # noqa: E711
+            .group_by(location_date_table.c.location_id)):
+        deltas[location_id] = {'location_id': location_id, 'visits': -(visits or 0)}
+    for location_id, visits in connection.execute(
+            select([location_table.c.id, func.sum(staged.visits)])
+            .select_from(staged_table.join(location_table, location_table.c.location_name == staged.location_name))
+            .group_by(location_table.c.id)):
+        delta = deltas.setdefault(location_id, {'location_id': location_id, 'visits': 0})
+        delta['visits'] += visits or 0
+    return deltas.values()
+
+
+def merge_staging(staging, start_date, end_date):
+    '''
+    Replaces the stats between start_date and end_date (inclusive) with the
+    staged rows, in one transaction. Package and resource stats dated
+    before the compaction cutoff are left alone.
+    '''
+    end_exclusive = end_date + datetime.timedelta(days=1)
+    package_table = PackageStats.__table__
+    resource_table = ResourceStats.__table__
+    location_table = AudienceLocation.__table__
+    location_date_table = AudienceLocationDate.__table__
+    search_table = SearchStats.__table__
+
+    # Package and resource stats of compacted months are already in the monthly rows
+    compacted_before = get_compacted_before()
+    stats_start = max(start_date, compacted_before) if compacted_before is not None else start_date
+
+    with model.meta.engine.begin() as connection:
+        connection.execute(package_table.delete().where(
+            and_(package_table.c.visit_date >= stats_start, package_table.c.visit_date < end_exclusive)))
+        staged = staging.package_stats.c
+        connection.execute(package_table.insert().from_select(
+            ['package_id', 'visit_date', 'visits', 'entrances', 'downloads'],
+            select([staged.package_id, staged.visit_date, func.sum(staged.visits), func.sum(staged.entrances),
+                    func.sum(staged.downloads)])
+            .where(staged.visit_date >= stats_start)
+            .group_by(staged.package_id, staged.visit_date)))
+
+        connection.execute(resource_table.delete().where(
+            and_(resource_table.c.visit_date >= stats_start, resource_table.c.visit_date < end_exclusive)))
+        staged = staging.resource_stats.c
+        connection.execute(resource_table.insert().from_select(
+            ['resource_id', 'visit_date', 'visits'],
+            select([staged.resource_id, staged.visit_date, func.sum(staged.visits)])
+            .where(staged.visit_date >= stats_start)
+            .group_by(staged.resource_id, staged.visit_date)))
+
+        staged = staging.audience_location_date.c
+        connection.execute(location_table.insert().from_select(
+            ['location_name'],
+            select([staged.location_name]).distinct()
+            .where(not_(exists().where(location_table.c.location_name == staged.location_name)))))
+        in_range = and_(location_date_table.c.date >= start_date, location_date_table.c.date < end_exclusive)
+        deltas = location_total_deltas(connection, in_range, staging.audience_location_date)
+        connection.execute(location_date_table.delete().where(in_range))
+        connection.execute(location_date_table.insert().from_select(
+            ['location_id', 'date', 'visits'],
+            select([location_table.c.id, staged.date, func.sum(staged.visits)])
+            .select_from(staging.audience_location_date.join(
+                location_table, location_table.c.location_name == staged.location_name))
+            .group_by(location_table.c.id, staged.date)))
+        AudienceLocationTotals.add_visits(connection, deltas)
+
+        connection.execute(search_table.delete().where(
+            and_(search_table.c.date >= start_date, search_table.c.date < end_exclusive)))
+        staged = staging.search_terms.c
+        connection.execute(search_table.insert().from_select(
+            ['search_term', 'date', 'count'],
+            select([staged.search_term, staged.date, func.sum(staged.count)])
+            .group_by(staged.search_term, staged.date)))
+
+
+# The command and staging tables of the current worker process, see init_worker
+_command = None
+_staging = None
+
+
+def init_worker(command, credentials_file, run_id):
+    '''
+    Pool initializer: gives the worker its own database connections and GA service
+    '''
+    global _command, _staging
+    model.meta.engine.dispose()
+    model.Session.remove()
+    _command = command
+    _staging = StagingTables(run_id)
+    _command.init_service([None, credentials_file])
+
+
+def backfill_window(window):
+    '''
+    Fetches, resolves and stages all query types for one window
+
+    :return: (window, {query type: rows staged}, {query type: malformed rows})
+    '''
+    start_date, end_date = window
+    staged = {}
+    _command.malformed_rows.clear()
+    try:
+        queries = _command.query_definitions()
+        for query, results in zip(queries, _command.fetch_window(queries, start_date, end_date)):
+            data = StatsAccumulator(query['columns'], merge=query['merge'])
+            query['resolver'](results, data)
+            staged[query['type']] = stage(_staging, query['type'], data)
+    finally:
+        model.Session.remove()
+    return window, staged, dict(_command.malformed_rows)
+
+
+def run(command, credentials_file, start_date, end_date, workers, window_days):
+    '''
+    Backfills the stats from start_date to end_date with ``workers`` processes
+    '''
+    windows = split_windows(start_date, end_date, window_days)
+    log.info("Backfilling %d windows between %s and %s with %d workers", len(windows), start_date, end_date,
+             workers)
+
+    with backfill_lock():
+        staging = StagingTables()
+        staging.create()
+        try:
+            totals = _run_workers(command, credentials_file, staging, windows, workers)
+            print 'Merging staged rows'
+            merge_staging(staging, start_date, end_date)
+        finally:
+            staging.drop()
+
+    log.info("Backfill done: %s", totals)
+    return totals
+
+
+def _run_workers(command, credentials_file, staging, windows, workers):
+    '''
+    Stages all windows with a pool of worker processes
+
+    :return: {query type: rows staged}
+    '''
+    # Connections must not be shared with the forked workers
+    model.Session.remove()
+    pool = multiprocessing.Pool(processes=workers, initializer=init_worker,
+                                initargs=(command, credentials_file, staging.run_id))
+    totals = {}
+    try:
+        for window, staged, malformed in pool.imap_unordered(backfill_window, windows):
+            print 'Staged %s -> %s: %s' % (window[0], window[1], ', '.join(
+                '%s %d' % item for item in sorted(staged.items())))
+            for query_type, count in staged.iteritems():
+                totals[query_type] = totals.get(query_type, 0) + count
+            for query_type, count in malformed.iteritems():
+                if count:
+                    log.warning("Window %s -> %s: skipped %d malformed rows of type %s",
+                                window[0], window[1], count, query_type)
+        pool.close()
+        pool.join()
+    except BaseException:
+        pool.terminate()
+        raise
+    return totals
@@ -0,0 +1,232 @@
+"""
+Bulk loading of resolved rows into the stats tables on PostgreSQL.
+
+Rows are streamed as CSV into ``COPY ... FROM STDIN`` on a temporary table
+and merged into the stats table with one ``INSERT ... SELECT`` per query
+type, instead of one ORM lookup and flush per row. The statements run on
+the connection of model.Session, so they are committed with the rest of
+the ingest.
+"""
+import csv
+import datetime
+from cStringIO import StringIO
+
+from sqlalchemy import text
+
+log = __import__('logging').getLogger(__name__)
+
+# ON CONFLICT needs PostgreSQL 9.5
+MIN_SERVER_VERSION = (9, 5)
+
+COPY_CHUNK_SIZE = 65536
+
+
+def _csv_value(value):
+    if value is None:
+        return ''
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        return value.isoformat()
+    return str(value)
+
+
+class CsvStream(object):
+    """
+    Read-only file object producing CSV from an iterable of row tuples on
+    demand, so COPY can consume any number of rows in constant memory.
+    """
+
+    def __init__(self, rows):
+        self.rows = iter(rows)
+        self.buffer = ''
+        self.row_count = 0
+
+    def _fill(self, size):
+        out = StringIO()
+        writer = csv.writer(out, lineterminator='\n')
+        written = len(self.buffer)
+        for row in self.rows:
+            writer.writerow([_csv_value(value) for value in row])
+            self.row_count += 1
+            if size >= 0 and written + out.tell() >= size:
+                break
+        self.buffer += out.getvalue()
+
+    def read(self, size=-1):
+        if size < 0 or len(self.buffer) < size:
+            self._fill(size)
+        if size < 0:
+            result, self.buffer = self.buffer, ''
+        else:
+            result, self.buffer = self.buffer[:size], self.buffer[size:]
+        return result
+
+    def readline(self, size=-1):
+        return self.read(size)
+
+
+def copy_rows(connection, table_name, columns, rows, not_null=()):
+    '''
+    Streams rows into table_name with COPY FROM STDIN
+
+    :param connection: SQLAlchemy connection to a PostgreSQL database
+    :param not_null: columns whose empty values are read as empty strings
+        instead of NULL, like the ORM would save them
+    :return: number of rows copied
+    '''
+    stream = CsvStream(rows)
+    options = 'FORMAT csv'
+    if not_null:
+        options += ', FORCE_NOT_NULL (%s)' % ', '.join(not_null)
+    cursor = connection.connection.cursor()
+    try:
+        cursor.copy_expert('COPY %s (%s) FROM STDIN WITH (%s)' % (table_name, ', '.join(columns), options),
+                           stream, size=COPY_CHUNK_SIZE)
+    finally:
+        cursor.close()
+    return stream.row_count
+
+
+def supports_bulk_load(engine):
+    if engine.dialect.name != 'postgresql':
+        return False
+    version = engine.dialect.server_version_info
+    if version is None:
+        with engine.connect() as connection:
+            version = engine.dialect._get_server_version_info(connection)
+    return tuple(version[:2]) >= MIN_SERVER_VERSION
+
+
+class BulkLoader(object):
+    """
+    Save functions of GACommand for PostgreSQL. Each takes the
+    StatsAccumulator of its query type and keeps the semantics of the
+    corresponding ORM save function, apart from search terms: these replace
+    the counts of the loaded dates instead of adding duplicate rows.
+    """
+
+    def __init__(self, session):
+        self.session = session
+
+    def _load(self, table_name, column_definitions, rows):
+        connection = self.session.connection()
+        connection.execute(text('DROP TABLE IF EXISTS %s' % table_name))
+        connection.execute(text('CREATE TEMPORARY TABLE %s (%s) ON COMMIT DROP' % (
+            table_name, ', '.join('%s %s' % column for column in column_definitions))))
+        # CSV has no difference between an empty string and NULL, and the keys are never NULL
+        count = copy_rows(connection, table_name, [column[0] for column in column_definitions], rows,
+                          not_null=[name for name, column_type in column_definitions if column_type == 'text'])
+        connection.execute(text('ANALYZE %s' % table_name))
+        return connection, count
+
+    def _warn_missing(self, connection, sql, kind):
+        missing = connection.execute(text(sql)).scalar()
+        if missing:
+            log.warning("Couldn't find %d %s", missing, kind)
+
+    def save_package_visits(self, data):
+        connection, count = self._load(
+            'ga_load_package_visits',
+            [('package_key', 'text'), ('visit_date', 'timestamp'), ('visits', 'integer'), ('entrances', 'integer')],
+            ((key, visit_date, values[0], values[1]) for key, visit_date, values in data.rows()))
+        self._warn_missing(connection, '''
+            SELECT count(DISTINCT s.package_key) FROM ga_load_package_visits s
+            WHERE NOT EXISTS (SELECT 1 FROM package p WHERE s.package_key IN (p.id, p.name))''', 'packages')
+        connection.execute(text('''
+            INSERT INTO package_stats (package_id, visit_date, visits, entrances, downloads)
+            SELECT p.id, s.visit_date, sum(s.visits), sum(s.entrances), 0
+            FROM ga_load_package_visits s JOIN package p ON s.package_key IN (p.id, p.name)
+            GROUP BY p.id, s.visit_date
+            ON CONFLICT (package_id, visit_date)
+            DO UPDATE SET visits = EXCLUDED.visits, entrances = EXCLUDED.entrances'''))
+        return count
+
+    def save_package_downloads(self, data):
+        connection, count = self._load(
+            'ga_load_package_downloads',
+            [('package_key', 'text'), ('visit_date', 'timestamp'), ('downloads', 'integer')],
+            ((key, visit_date, values[0]) for key, visit_date, values in data.rows()))
+        self._warn_missing(connection, '''
+            SELECT count(DISTINCT s.package_key) FROM ga_load_package_downloads s
+            WHERE NOT EXISTS (SELECT 1 FROM package p WHERE s.package_key IN (p.id, p.name))''', 'packages')
+        # Downloads are added to the existing value like PackageStats.update_downloads does
+        connection.execute(text('''
+            INSERT INTO package_stats (package_id, visit_date, visits, entrances, downloads)
+            SELECT p.id, s.visit_date, 0, 0, sum(s.downloads)
+            FROM ga_load_package_downloads s JOIN package p ON s.package_key IN (p.id, p.name)
+            GROUP BY p.id, s.visit_date
+            ON CONFLICT (package_id, visit_date)
+            DO UPDATE SET downloads = package_stats.downloads + EXCLUDED.downloads'''))
+        return count
+
+    def save_resource_downloads(self, data):
+        connection, count = self._load(
+            'ga_load_resource_downloads',
+            [('resource_id', 'text'), ('visit_date', 'timestamp'), ('visits', 'integer')],
+            ((key, visit_date, values[0]) for key, visit_date, values in data.rows()))
+        self._warn_missing(connection, '''
+            SELECT count(DISTINCT s.resource_id) FROM ga_load_resource_downloads s
+            WHERE NOT EXISTS (SELECT 1 FROM resource r WHERE r.id = s.resource_id)''', 'resources')
+        connection.execute(text('''
+            INSERT INTO resource_stats (resource_id, visit_date, visits)
+            SELECT s.resource_id, s.visit_date, s.visits
+            FROM ga_load_resource_downloads s JOIN resource r ON r.id = s.resource_id
+            ON CONFLICT (resource_id, visit_date) DO UPDATE SET visits = EXCLUDED.visits'''))
+        return count
+
+    def save_location_visits(self, data):
+        connection, count = self._load(
+            'ga_load_location_visits',
+            [('location_name', 'text'), ('date', 'timestamp'), ('visits', 'integer')],
+            ((key, visit_date, values[0]) for key, visit_date, values in data.rows()))
+        connection.execute(text('''
+            INSERT INTO audience_location (location_name)
+            SELECT DISTINCT s.location_name FROM ga_load_location_visits s
+            WHERE NOT EXISTS (SELECT 1 FROM audience_location l WHERE l.location_name = s.location_name)'''))
+        # The totals change by the difference of the loaded and the replaced visits. Loaded rows only
+        # replace rows of the same dates, so the span of dates can only grow
+        connection.execute(text('''
+            WITH loaded AS (
+                SELECT l.id AS location_id, sum(s.visits) AS visits, min(s.date) AS first_date,
+                       max(s.date) AS last_date
+                FROM ga_load_location_visits s JOIN audience_location l ON l.location_name = s.location_name
+                GROUP BY l.id
+            ), replaced AS (
+                SELECT d.location_id, sum(d.visits) AS visits
+                FROM audience_location_date d
+                JOIN audience_location l ON l.id = d.location_id
+                JOIN ga_load_location_visits s ON l.location_name = s.location_name AND d.date = s.date
+                GROUP BY d.location_id
+            )
+            INSERT INTO audience_location_totals (location_id, total_visits, first_date, last_date)
+            SELECT loaded.location_id, loaded.visits - coalesce(replaced.visits, 0), loaded.first_date,
+                   loaded.last_date
+            FROM loaded LEFT JOIN replaced ON replaced.location_id = loaded.location_id
+            ON CONFLICT (location_id) DO UPDATE SET
+                total_visits = audience_location_totals.total_visits + EXCLUDED.total_visits,
+                first_date = least(audience_location_totals.first_date, EXCLUDED.first_date),
+                last_date = greatest(audience_location_totals.last_date, EXCLUDED.last_date)'''))
+        # audience_location_date has no unique (location_id, date) to conflict on
+        connection.execute(text('''
+            DELETE FROM audience_location_date d
+            USING ga_load_location_visits s JOIN audience_location l ON l.location_name = s.location_name
+            WHERE d.location_id = l.id AND d.date = s.date'''))
+        connection.execute(text('''
+            INSERT INTO audience_location_date (location_id, date, visits)
+            SELECT l.id, s.date, s.visits
+            FROM ga_load_location_visits s JOIN audience_location l ON l.location_name = s.location_name'''))
+        return count
+
+    def save_search_terms(self, data):
+        connection, count = self._load(
+            'ga_load_search_terms',
+            [('search_term', 'text'), ('date', 'timestamp'), ('count', 'integer')],
+            ((key, visit_date, values[0]) for key, visit_date, values in data.rows()))
+        connection.execute(text('''
+            DELETE FROM search_terms t USING ga_load_search_terms s
+            WHERE t.search_term = s.search_term AND t.date = s.date'''))
+        connection.execute(text('''
+            INSERT INTO search_terms (search_term, date, count)
+            SELECT s.search_term, s.date, s.count FROM ga_load_search_terms s'''))
+        return count
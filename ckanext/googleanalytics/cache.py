@@ -0,0 +1,72 @@
+"""
+Small in-process caches, as Python 2 has no functools.lru_cache.
+"""
+import time
+import threading
+from collections import OrderedDict
+from functools import wraps
+
+_missing = object()
+
+
+class LRUCache(object):
+    """
+    Mapping that keeps at most ``maxsize`` of the most recently used entries,
+    each for at most ``ttl`` seconds if a ttl is given.
+    Safe to share between threads.
+    """
+
+    def __init__(self, maxsize=1024, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        with self.lock:
+            entry = self.data.pop(key, _missing)
+            if entry is _missing or (entry[0] is not None and entry[0] <= time.time()):
+                self.misses += 1
+                return default
+            # re-inserting moves the key to the most recently used end
+            self.data[key] = entry
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value):
+        expires = time.time() + self.ttl if self.ttl is not None else None
+        with self.lock:
+            self.data.pop(key, None)
+            self.data[key] = (expires, value)
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+    def __len__(self):
+        return len(self.data)
+
+
+def lru_memoize(maxsize=1024):
+    '''
+    Decorator memoizing a function of hashable positional arguments.
+    The cache is available as the ``cache`` attribute of the decorated function.
+    '''
+    def decorator(function):
+        cache = LRUCache(maxsize)
+
+        @wraps(function)
+        def wrapper(*args):
+            value = cache.get(args, _missing)
+            if value is _missing:
+                value = function(*args)
+                cache.set(args, value)
+            return value
+
+        wrapper.cache = cache
+        return wrapper
+    return decorator
@@ -1,19 +1,26 @@
 import os
 import re
+import time
 import logging
 import datetime
-from collections import OrderedDict
+from collections import OrderedDict, Counter
 
+import paste.script.command
 from pylons import config as pylonsconfig
 import ckan.model as model
 
 import ckan.plugins as p
-from ckanext.googleanalytics.model import PackageStats, ResourceStats, AudienceLocationDate, SearchStats
+from ckanext.googleanalytics.model import PackageStats, ResourceStats, AudienceLocationDate, AudienceLocationTotals, \
+    PackageStatsMonthly, ResourceStatsMonthly, SearchStats, get_last_ingest, set_last_ingest, get_compacted_before
+from ckanext.googleanalytics.metrics import IngestMetrics, timed
+from ckanext.googleanalytics.accumulator import StatsAccumulator
+from ckanext.googleanalytics.parsing import parse_page_path, decode_ga_date
+from ckanext.googleanalytics.ratelimit import RateScheduler
+from ckanext.googleanalytics import reporting_v4
 
 PACKAGE_URL = '/dataset/'  # XXX get from routes...
 DEFAULT_RESOURCE_URL_TAG = '/download/'
 
-RESOURCE_URL_REGEX = re.compile('/dataset/[a-z0-9-_]+/resource/([a-z0-9-_]+)')
 DATASET_EDIT_REGEX = re.compile('/dataset/edit/([a-z0-9-_]+)')
 
 
@@ -37,6 +44,58 @@ class GACommand(p.toolkit.CkanCommand):
          - Parses data from Google Analytics API and stores it in our database
           <credentials file> specifies the service credentials file
           [date] specifies start date for retrieving analytics data YYYY-MM-DD format
+
+       paster googleanalytics backfill <credentials_file> <start_date> [end_date] [--workers=N] [--window-days=N]
+         - Reloads the stats between start_date and end_date (inclusive,
+           YYYY-MM-DD, end date defaults to today). The date range is split
+           into windows of --window-days days (default 7) which --workers
+           processes (default number of CPUs) fetch and resolve into staging
+           tables. The staged rows then replace the stats of the whole range
+           in one transaction.
+
+       paster googleanalytics extract <credentials_file> <directory> [start_date] [end_date] [--window-days=N]
+         - Writes the raw rows of every query type and date window into
+           <directory> as gzipped NDJSON files listed in manifest.json. With a
+           start date the range is split into windows of --window-days days,
+           otherwise the same windows as loadanalytics would fetch are used.
+
+       paster googleanalytics load <directory> [--workers=N]
+         - Replays an archive written by extract through the resolvers and
+           save functions without contacting Google. Files are resolved in
+           --workers processes (default 1).
+
+       paster googleanalytics export <package|resource> <file> [start_date] [end_date] [--format=csv|ndjson]
+         - Writes the daily stats of datasets or resources with their names
+           into <file> (- for standard output), streaming the rows from the
+           database. Dates are inclusive, in YYYY-MM-DD format.
+
+       paster googleanalytics compact [--retention-years=N]
+         - Deletes the stats of purged datasets and resources and folds the
+           daily dataset and resource stats older than --retention-years
+           years (default googleanalytics.retention.years or 3) into monthly
+           rows. All time totals stay the same.
+
+       paster googleanalytics benchmark [start_date] [--rows-per-day=N] [--save]
+         - Runs all query types against the recorded or synthetic service and
+           reports rows/sec for fetching, each resolver and each save function.
+           Start date defaults to 30 days ago. Save functions are only run
+           with --save, which writes into the configured database.
+
+    Options::
+
+       --service=google|recorded|synthetic
+           Service that answers the GA queries, defaults to the
+           googleanalytics.service config option or google
+       --recorded-dir=DIR   Directory of recorded responses for --service=recorded
+       --record-dir=DIR     Save every live response into DIR for later replay
+       --rows-per-day=N     Volume of the synthetic service
+       --api-backend=v3|v4  Fetch with the Core Reporting API v3 (default) or
+                            with batched Reporting API v4 requests
+       --response-cache=DIR Cache responses for windows Google will no longer
+                            change in DIR, see googleanalytics.response_cache.dir
+       --metrics-json=FILE  Write per phase timings of loadanalytics as JSON
+       --metrics-prometheus=FILE
+           Write the same timings in Prometheus textfile collector format
     """
     summary = __doc__.split('\n')[0]
     usage = __doc__
@@ -44,8 +103,43 @@ class GACommand(p.toolkit.CkanCommand):
     TEST_HOST = None
     CONFIG = None
 
+    parser = paste.script.command.Command.standard_parser(verbose=True)
+    parser.add_option('-c', '--config', dest='config', help='Config file to use.')
+    parser.add_option('--service', dest='service', default=None,
+                      help='Service answering the GA queries: google, recorded or synthetic')
+    parser.add_option('--recorded-dir', dest='recorded_dir', default=None,
+                      help='Directory of recorded responses used by the recorded service')
+    parser.add_option('--record-dir', dest='record_dir', default=None,
+                      help='Directory where responses of the google service are recorded')
+    parser.add_option('--rows-per-day', dest='rows_per_day', type='int', default=None,
+                      help='Number of rows per day generated by the synthetic service')
+    parser.add_option('--metrics-json', dest='metrics_json', default=None,
+                      help='Write per phase timings of loadanalytics as JSON into this file')
+    parser.add_option('--metrics-prometheus', dest='metrics_prometheus', default=None,
+                      help='Write per phase timings of loadanalytics in Prometheus textfile format into this file')
+    parser.add_option('--workers', dest='workers', type='int', default=None,
+                      help='Number of worker processes used by backfill and load')
+    parser.add_option('--window-days', dest='window_days', type='int', default=7,
+                      help='Number of days fetched at once by backfill and extract')
+    parser.add_option('--api-backend', dest='api_backend', default=None,
+                      help='Reporting API used to fetch data: v3 (default) or v4 with batched requests')
+    parser.add_option('--response-cache', dest='response_cache', default=None,
+                      help='Directory caching responses for windows older than the settle horizon')
+    parser.add_option('--save', dest='save', action='store_true', default=False,
+                      help='Run the save functions in benchmark')
+    parser.add_option('--format', dest='format', default='csv',
+                      help='Format of export: csv or ndjson')
+    parser.add_option('--retention-years', dest='retention_years', type='int', default=None,
+                      help='Years of daily stats kept by compact')
+
     def __init__(self, name):
         super(GACommand, self).__init__(name)
+        # rows whose page path could not be parsed, by query type
+        self.malformed_rows = Counter()
+        self._bulk_loader = False
+        self._response_cache = False
+        self.scheduler = None
+        self.reporting_service = None
 
     def command(self):
         """
@@ -68,6 +162,18 @@ class GACommand(p.toolkit.CkanCommand):
             self.init_service(self.args)
         elif cmd == 'loadanalytics':
             self.load_analytics(self.args)
+        elif cmd == 'backfill':
+            self.backfill(self.args)
+        elif cmd == 'extract':
+            self.extract(self.args)
+        elif cmd == 'load':
+            self.load(self.args)
+        elif cmd == 'benchmark':
+            self.benchmark(self.args)
+        elif cmd == 'export':
+            self.export(self.args)
+        elif cmd == 'compact':
+            self.compact()
         # Development commands
         elif cmd == 'test':
             self.test_queries()
@@ -84,24 +190,57 @@ class GACommand(p.toolkit.CkanCommand):
         from ckanext.googleanalytics.model import init_tables
         init_tables(model.meta.engine)
 
-    def init_service(self, args):
-        from ga_auth import init_service
+    def _option(self, name, default=None):
+        options = getattr(self, 'options', None)
+        value = getattr(options, name, None)
+        return value if value is not None else default
+
+    def init_service(self, args, datasets=None):
+        from ga_auth import create_service, init_reporting_service
+
+        service_name = self._option('service', pylonsconfig.get('googleanalytics.service', 'google'))
+
+        credentialsfile = None
+        if service_name == 'google':
+            if len(args) == 1:
+                raise Exception("Missing credentials file")
+            credentialsfile = args[1]
+            if not os.path.exists(credentialsfile):
+                raise Exception('Cannot find the credentials file %s' % credentialsfile)
 
-        if len(args) == 1:
-            raise Exception("Missing credentials file")
-        credentialsfile = args[1]
-        if not os.path.exists(credentialsfile):
-            raise Exception('Cannot find the credentials file %s' % credentialsfile)
+        if service_name == 'google' and self.scheduler is None:
+            # Created once, so backfill workers forked later share it
+            self.scheduler = RateScheduler.from_config(pylonsconfig)
 
         try:
-            self.service = init_service(credentialsfile)
+            self.service = create_service(credentialsfile,
+                                          service_name=service_name,
+                                          recorded_dir=self._option('recorded_dir'),
+                                          record_dir=self._option('record_dir'),
+                                          rows_per_day=self._option('rows_per_day'),
+                                          datasets=datasets)
         except TypeError:
             print('Have you correctly run the init service task and '
                   'specified the correct file here')
             raise Exception('Unable to create a service')
 
+        if self.api_backend == 'v4':
+            # The v3 service is still used for the profile lookup
+            if service_name == 'google':
+                self.reporting_service = init_reporting_service(credentialsfile)
+            else:
+                self.reporting_service = self.service
+
         return self.service
 
+    @property
+    def api_backend(self):
+        backend = self._option('api_backend', pylonsconfig.get('googleanalytics.api_backend', 'v3'))
+        if backend not in reporting_v4.API_BACKENDS:
+            raise Exception('Unknown API backend "%s", expected one of: %s' % (
+                backend, ', '.join(reporting_v4.API_BACKENDS)))
+        return backend
+
     def load_analytics(self, args):
         """
         Parse data from Google Analytics API and store it
@@ -131,14 +270,27 @@ class GACommand(p.toolkit.CkanCommand):
         if not end_date:
             end_date = datetime.datetime.now()
 
+        cache = self.response_cache
+        cache_key = None
+        if cache is not None and cache.is_settled(end_date):
+            cache_key = cache.key(profile_id=self.profile_id, filters=filters, metrics=metrics, sort=sort,
+                                  dimensions=dimensions, start_date=start_date,
+                                  end_date=end_date.strftime("%Y-%m-%d"))
+
         end_date = end_date.strftime("%Y-%m-%d")
 
         start_index = 1
         max_results = 10000
 
+        if cache_key is not None:
+            results = cache.get(cache_key)
+            if results is not None:
+                print '%s -> %s (cached)' % (start_date, end_date)
+                return results
+
         print '%s -> %s' % (start_date, end_date)
 
-        results = self.service.data().ga().get(ids='ga:%s' % self.profile_id,
+        request = self.service.data().ga().get(ids='ga:%s' % self.profile_id,
                                                filters=filters,
                                                dimensions=dimensions,
                                                start_date=start_date,
@@ -147,9 +299,83 @@ class GACommand(p.toolkit.CkanCommand):
                                                max_results=max_results,
                                                metrics=metrics,
                                                sort=sort
-                                               ).execute()
+                                               )
+        if self.scheduler is not None:
+            results = self.scheduler.execute(request)
+        else:
+            results = request.execute()
+        if cache_key is not None:
+            cache.set(cache_key, results)
         return results
 
+    def ga_batch_query(self, queries, start_date, end_date):
+        """
+        Get raw data of up to five queries over the same window with one
+        Reporting API v4 batchGet (plus one per further page).
+
+        Returns a v3 style response for each query, like ga_query.
+        """
+        cache = self.response_cache
+        cache_key = None
+        if cache is not None and cache.is_settled(end_date):
+            cache_key = cache.key(profile_id=self.profile_id, api_backend='v4',
+                                  queries=[[query[key] for key in ('filters', 'metrics', 'sort', 'dimensions')]
+                                           for query in queries],
+                                  start_date=start_date.strftime("%Y-%m-%d"), end_date=end_date.strftime("%Y-%m-%d"))
+        start_date = start_date.strftime("%Y-%m-%d")
+        end_date = end_date.strftime("%Y-%m-%d")
+
+        if cache_key is not None:
+            results = cache.get(cache_key)
+            if results is not None:
+                print '%s -> %s (cached)' % (start_date, end_date)
+                return results
+
+        print '%s -> %s (%s)' % (start_date, end_date, ', '.join(query['type'] for query in queries))
+        execute = self.scheduler.execute if self.scheduler is not None else lambda request: request.execute()
+        results = reporting_v4.batch_get(self.reporting_service, self.profile_id, queries, start_date, end_date,
+                                         execute)
+        if cache_key is not None:
+            cache.set(cache_key, results)
+        return results
+
+    def fetch_window(self, queries, start_date, end_date):
+        """
+        Get raw data of several queries over the same window, in batches
+        with the v4 backend and one query at a time with v3
+        """
+        if self.api_backend == 'v4':
+            results = []
+            for offset in xrange(0, len(queries), reporting_v4.MAX_BATCH_SIZE):
+                results.extend(self.ga_batch_query(queries[offset:offset + reporting_v4.MAX_BATCH_SIZE],
+                                                   start_date, end_date))
+            return results
+        return [self.ga_query(start_date=start_date,
+                              end_date=end_date,
+                              filters=query['filters'],
+                              metrics=query['metrics'],
+                              sort=query['sort'],
+                              dimensions=query['dimensions'])
+                for query in queries]
+
+    @property
+    def response_cache(self):
+        '''
+        ResponseCache for settled windows, None if no cache directory is configured
+        '''
+        if self._response_cache is False:
+            from ckanext.googleanalytics import ga_cache
+            self._response_cache = None
+            directory = self._option('response_cache', pylonsconfig.get('googleanalytics.response_cache.dir'))
+            if directory:
+                self._response_cache = ga_cache.ResponseCache(
+                    directory,
+                    max_size=int(pylonsconfig.get('googleanalytics.response_cache.max_size',
+                                                  ga_cache.DEFAULT_MAX_SIZE)),
+                    settle_hours=int(pylonsconfig.get('googleanalytics.response_cache.settle_hours',
+                                                      ga_cache.DEFAULT_SETTLE_HOURS)))
+        return self._response_cache
+
     def parse_and_save(self, args):
         """Grab raw data from Google Analytics and save to the database"""
         from ga_auth import get_profile_id
@@ -164,6 +390,146 @@ class GACommand(p.toolkit.CkanCommand):
         if len(args) == 3:
             given_start_date = datetime.datetime.strptime(args[2], '%Y-%m-%d').date()
 
+        queries = self.get_queries(given_start_date)
+        metrics = IngestMetrics(model.meta.engine)
+        try:
+            with metrics.run():
+                if self.api_backend == 'v4':
+                    self.run_batched(queries, metrics)
+                else:
+                    # loop through queries, parse and save them to db
+                    for query in queries:
+                        self.run_query(query, metrics)
+            # The last date of each query is the earliest one loaded
+            self.finish_ingest(min(query['dates'][-1] for query in queries
+                                   if query['type'] in ('package', 'package_downloads')))
+        finally:
+            self.write_metrics(metrics)
+
+    def finish_ingest(self, since):
+        """
+        Reindex the datasets whose popularity changed with the stats loaded
+        from since on and record the time of the successful ingest
+        """
+        from ckanext.googleanalytics import search_index
+
+        if search_index.enabled():
+            search_index.reindex_changed(since, get_last_ingest())
+        set_last_ingest()
+
+    def run_query(self, query, metrics):
+        """Fetch, resolve and save all the windows of one query type"""
+        data = StatsAccumulator(query['columns'], merge=query['merge'])
+        record = metrics.query(query['type'])
+        self.log.info('performing analytics query of type: %s' % query['type'])
+        print 'Querying type: %s' % query['type']
+        retries = self.scheduler.retries if self.scheduler is not None else 0
+        for date, current in self.get_windows(query['dates']):
+            window = metrics.window(record, date, current)
+            # run query with current query values
+            with timed(window, 'fetch_seconds'):
+                results = self.ga_query(start_date=date,
+                                        end_date=current,
+                                        filters=query['filters'],
+                                        metrics=query['metrics'],
+                                        sort=query['sort'],
+                                        dimensions=query['dimensions'])
+            window['rows'] = len(results.get('rows', []))
+            # parse query
+            resolver = query['resolver']
+            with timed(window, 'resolve_seconds'):
+                data = resolver(results, data)
+            metrics.add_window_totals(record, window)
+
+        if self.scheduler is not None:
+            record['rate_limit_retries'] = self.scheduler.retries - retries
+        self.save_query(query, data, record, metrics)
+
+    def run_batched(self, queries, metrics):
+        """
+        Fetch the windows of all query types with batched v4 requests,
+        resolving as the responses arrive, then save each query type
+        """
+        records = OrderedDict()
+        data = {}
+        windows = OrderedDict()
+        now = datetime.datetime.now()
+        for query in queries:
+            records[query['type']] = metrics.query(query['type'])
+            data[query['type']] = StatsAccumulator(query['columns'], merge=query['merge'])
+            for window in self.get_windows(query['dates'], now):
+                windows.setdefault(window, []).append(query)
+
+        retries = self.scheduler.retries if self.scheduler is not None else 0
+        print 'Querying types: %s' % ', '.join(records)
+        for (date, current), window_queries in windows.iteritems():
+            for offset in xrange(0, len(window_queries), reporting_v4.MAX_BATCH_SIZE):
+                batch = window_queries[offset:offset + reporting_v4.MAX_BATCH_SIZE]
+                window_records = [metrics.window(records[query['type']], date, current) for query in batch]
+                started = time.time()
+                results = self.ga_batch_query(batch, date, current)
+                # One round trip serves the whole batch, so its time is shared evenly
+                fetch_seconds = (time.time() - started) / len(batch)
+                for query, window, result in zip(batch, window_records, results):
+                    window['fetch_seconds'] = fetch_seconds
+                    window['rows'] = len(result.get('rows', []))
+                    with timed(window, 'resolve_seconds'):
+                        data[query['type']] = query['resolver'](result, data[query['type']])
+                    metrics.add_window_totals(records[query['type']], window)
+        if self.scheduler is not None and self.scheduler.retries > retries:
+            self.log.info("Retried %d rate limited batch requests", self.scheduler.retries - retries)
+
+        for query in queries:
+            self.save_query(query, data[query['type']], records[query['type']], metrics)
+
+    def save_query(self, query, data, record, metrics):
+        """Save and commit the resolved rows of one query type"""
+        record['malformed_rows'] = self.malformed_rows[query['type']]
+        if record['malformed_rows']:
+            self.log.warning("Skipped %d rows with unrecognized page paths in query of type: %s",
+                             record['malformed_rows'], query['type'])
+
+        save_function = query['save']
+        print 'Saving type: %s' % query['type']
+        with metrics.count_statements(record):
+            with timed(record, 'save_seconds'):
+                save_function(data)
+            metrics.sample_memory(record)
+            with timed(record, 'commit_seconds'):
+                model.Session.commit()
+        metrics.finish_query(record)
+        print 'Saving done'
+        self.log.info("Successfully saved analytics query of type: %s" % query['type'])
+
+    def write_metrics(self, metrics):
+        json_file = self._option('metrics_json', pylonsconfig.get('googleanalytics.metrics.json_file'))
+        prometheus_file = self._option('metrics_prometheus', pylonsconfig.get('googleanalytics.metrics.prometheus_file'))
+        if json_file:
+            metrics.write_json(json_file)
+        if prometheus_file:
+            metrics.write_prometheus(prometheus_file)
+
+    def get_queries(self, given_start_date=None):
+        """
+        Returns the list of queries to send to analytics, with the dates
+        to query starting from given_start_date or the latest update
+        """
+        latest_update_dates = {
+            'package': PackageStats.get_latest_update_date,
+            'resource': ResourceStats.get_latest_update_date,
+            'visitorlocation': AudienceLocationDate.get_latest_update_date,
+            'package_downloads': PackageStats.get_latest_update_date,
+            'search_terms': SearchStats.get_latest_update_date,
+        }
+        queries = self.query_definitions()
+        for query in queries:
+            query['dates'] = self.get_dates_between_update(given_start_date, latest_update_dates[query['type']]())
+        return queries
+
+    def query_definitions(self):
+        """
+        Returns the list of queries to send to analytics, without dates
+        """
         botFilters = [
             'ga:browser!@StatusCake',
             'ga:browser!@Python',
@@ -179,79 +545,314 @@ class GACommand(p.toolkit.CkanCommand):
         # list of queries to send to analytics
         queries = [{
             'type': 'package',
-            'dates': self.get_dates_between_update(given_start_date, PackageStats.get_latest_update_date()),
             'filters': 'ga:pagePath=~%s,ga:pagePath=~%s' % (PACKAGE_URL, self.resource_url_tag),
             'metrics': 'ga:uniquePageviews, ga:entrances',
             'sort': 'ga:date',
             'dimensions': 'ga:pagePath, ga:date',
+            'columns': ('visits', 'entrances'),
+            'merge': 'sum',
             'resolver': self.resolver_type_package,
             'save': self.save_type_package,
         }, {
             'type': 'resource',
-            'dates': self.get_dates_between_update(given_start_date, ResourceStats.get_latest_update_date()),
             'filters': 'ga:pagePath=~%s' % self.resource_url_tag,
             'metrics': 'ga:uniquePageviews',
             'sort': 'ga:date',
             'dimensions': 'ga:pagePath, ga:date',
+            'columns': ('downloads',),
+            'merge': 'sum',
             'resolver': self.resolver_type_resource,
             'save': self.save_type_resource,
         }, {
             'type': 'visitorlocation',
-            'dates': self.get_dates_between_update(given_start_date, AudienceLocationDate.get_latest_update_date()),
             'filters': ";".join(botFilters),
             'metrics': 'ga:sessions',
             'sort': 'ga:date',
             'dimensions': 'ga:country, ga:date',
+            'columns': ('visits',),
+            'merge': 'replace',
             'resolver': self.resolver_type_visitorlocation,
             'save': self.save_type_visitorlocation,
         }, {
             'type': 'package_downloads',
-            'dates': self.get_dates_between_update(given_start_date, PackageStats.get_latest_update_date()),
             'filters': "ga:eventCategory==Resource;ga:eventAction==Download",
             'metrics': "ga:uniqueEvents",
             'sort': "ga:date",
             'dimensions': "ga:pagePath, ga:date, ga:eventCategory",
+            'columns': ('downloads',),
+            'merge': 'sum',
             'resolver': self.resolver_type_package_downloads,
             'save': self.save_type_package_downloads,
         }, {
             'type': 'search_terms',
-            'dates': self.get_dates_between_update(given_start_date, SearchStats.get_latest_update_date()),
             'filters': ";".join(botFilters),
             'metrics': "ga:searchUniques",
             'sort': "ga:date",
             'dimensions': "ga:searchKeyword, ga:date",
+            'columns': ('count',),
+            'merge': 'replace',
             'resolver': self.resolver_type_search_terms,
             'save': self.save_type_search_terms,
         }]
 
-        # loop through queries, parse and save them to db
+        return queries
+
+    def backfill(self, args):
+        """
+        Reload a historical date range with several worker processes
+        """
+        import multiprocessing
+        from ckanext.googleanalytics import backfill
+        from ga_auth import get_profile_id
+
+        if len(args) < 3:
+            raise Exception('Missing credentials file or start date')
+        if len(args) > 4:
+            raise Exception('Too many arguments')
+
+        start_date = datetime.datetime.strptime(args[2], '%Y-%m-%d').date()
+        end_date = datetime.date.today()
+        if len(args) == 4:
+            end_date = datetime.datetime.strptime(args[3], '%Y-%m-%d').date()
+        if end_date < start_date:
+            raise Exception('End date is before start date')
+
+        self.resource_url_tag = pylonsconfig.get('googleanalytics_resource_prefix', DEFAULT_RESOURCE_URL_TAG)
+        # Resolve the profile once, the workers build their own services
+        self.init_service(args)
+        self.profile_id = get_profile_id(self.service)
+        self.service = None
+        self.reporting_service = None
+
+        workers = self._option('workers') or multiprocessing.cpu_count()
+        totals = backfill.run(self, args[1], start_date, end_date, workers, self._option('window_days', 7))
+        self.finish_ingest(start_date)
+        for query_type, count in sorted(totals.items()):
+            print '%s: %d rows' % (query_type, count)
+
+    def extract(self, args):
+        """
+        Write raw rows from Google Analytics into an archive directory
+        """
+        from ckanext.googleanalytics.archive import ArchiveWriter
+        from ckanext.googleanalytics.backfill import split_windows
+        from ga_auth import get_profile_id
+
+        if len(args) < 3:
+            raise Exception('Missing credentials file or directory')
+        if len(args) > 5:
+            raise Exception('Too many arguments')
+
+        self.resource_url_tag = pylonsconfig.get('googleanalytics_resource_prefix', DEFAULT_RESOURCE_URL_TAG)
+        self.init_service(args)
+        self.profile_id = get_profile_id(self.service)
+
+        if len(args) >= 4:
+            start_date = datetime.datetime.strptime(args[3], '%Y-%m-%d').date()
+            end_date = datetime.date.today()
+            if len(args) == 5:
+                end_date = datetime.datetime.strptime(args[4], '%Y-%m-%d').date()
+            windows = split_windows(start_date, end_date, self._option('window_days', 7))
+            queries = [dict(query, windows=windows) for query in self.query_definitions()]
+        else:
+            queries = [dict(query, windows=self.get_windows(query['dates'])) for query in self.get_queries()]
+
+        writer = ArchiveWriter(args[2], self.profile_id)
         for query in queries:
-            data = {}
-            current = datetime.datetime.now()
-            self.log.info('performing analytics query of type: %s' % query['type'])
-            print 'Querying type: %s' % query['type']
-            for date in query['dates']:
-                # run query with current query values
+            print 'Extracting type: %s' % query['type']
+            for start_date, end_date in query['windows']:
+                results = self.ga_query(start_date=start_date,
+                                        end_date=end_date,
+                                        filters=query['filters'],
+                                        metrics=query['metrics'],
+                                        sort=query['sort'],
+                                        dimensions=query['dimensions'])
+                writer.write_window(query, start_date, end_date, results.get('rows', []))
+        writer.close()
+        print 'Extracted %d files into %s' % (len(writer.manifest['files']), args[2])
+
+    def load(self, args):
+        """
+        Resolve and save the rows of an archive written by extract
+        """
+        import multiprocessing
+        from ckanext.googleanalytics import archive
+
+        if len(args) != 2:
+            raise Exception('Expected the archive directory')
+
+        self.resource_url_tag = pylonsconfig.get('googleanalytics_resource_prefix', DEFAULT_RESOURCE_URL_TAG)
+        reader = archive.ArchiveReader(args[1])
+        workers = self._option('workers') or 1
+        pool = None
+        if workers > 1:
+            # Workers inherit this command on fork and use its resolvers
+            archive._command = self
+            model.Session.remove()
+            model.meta.engine.dispose()
+            pool = multiprocessing.Pool(processes=workers)
+
+        try:
+            for query in self.query_definitions():
+                # Describe the rows with the queries they were extracted with
+                query.update(reader.manifest['queries'].get(query['type'], {}))
+                entries = reader.entries(query['type'])
+                if not entries:
+                    continue
+                print 'Loading type: %s (%d files)' % (query['type'], len(entries))
+                for entry in entries:
+                    reader.verify(entry)
+
+                data = StatsAccumulator(query['columns'], merge=query['merge'])
+                if pool is not None:
+                    tasks = [(query['type'], query['columns'], query['merge'], reader.path(entry))
+                             for entry in entries]
+                    # imap keeps the file order, which matters for merge='replace'
+                    for file_data, malformed in pool.imap(archive.resolve_file_task, tasks):
+                        data.extend(file_data)
+                        self.malformed_rows[query['type']] += malformed
+                else:
+                    for entry in entries:
+                        archive.resolve_file(query['resolver'], reader.path(entry), data)
+
+                if self.malformed_rows[query['type']]:
+                    self.log.warning("Skipped %d rows with unrecognized page paths in query of type: %s",
+                                     self.malformed_rows[query['type']], query['type'])
+                query['save'](data)
+                model.Session.commit()
+                self.log.info("Successfully loaded analytics of type: %s" % query['type'])
+            if reader.manifest['files']:
+                self.finish_ingest(datetime.datetime.strptime(
+                    min(entry['start_date'] for entry in reader.manifest['files']), '%Y-%m-%d'))
+        finally:
+            if pool is not None:
+                pool.terminate()
+
+    def export(self, args):
+        """
+        Stream the daily stats of datasets or resources into a file
+        """
+        import sys
+        from ckanext.googleanalytics import export
+
+        if len(args) < 3:
+            raise Exception('Missing export kind or file')
+        if len(args) > 5:
+            raise Exception('Too many arguments')
+        start_date, end_date = [datetime.datetime.strptime(value, '%Y-%m-%d').date() if value else None
+                                for value in (args[3:] + [None, None])[:2]]
+
+        chunks = export.export_chunks(args[1], self._option('format', 'csv'), start_date, end_date)
+        out = sys.stdout if args[2] == '-' else open(args[2], 'wb')
+        try:
+            for chunk in chunks:
+                out.write(chunk)
+        finally:
+            if out is not sys.stdout:
+                out.close()
+
+    def compact(self):
+        """
+        Fold old daily stats into monthly rows and delete stats of purged datasets and resources
+        """
+        from ckanext.googleanalytics import compact
+
+        retention_years = self._option('retention_years', int(pylonsconfig.get(
+            'googleanalytics.retention.years', compact.DEFAULT_RETENTION_YEARS)))
+        if retention_years < 1:
+            raise Exception('Retention must be at least one year')
+        for name, count in compact.compact(retention_years).iteritems():
+            print("%s: %d rows" % (name, count))
+
+    def benchmark(self, args):
+        """
+        Run every query type against an offline service and report the
+        throughput of fetching, resolving and saving
+        """
+        from ga_auth import get_profile_id
+
+        service_name = self._option('service', 'synthetic')
+        if service_name == 'google':
+            raise Exception('Benchmark runs only against the recorded or synthetic service')
+        self.options.service = service_name
+
+        if len(args) > 2:
+            raise Exception('Too many arguments')
+        if len(args) == 2:
+            start_date = datetime.datetime.strptime(args[1], '%Y-%m-%d').date()
+        else:
+            start_date = datetime.date.today() - datetime.timedelta(days=30)
+
+        self.resource_url_tag = pylonsconfig.get('googleanalytics_resource_prefix', DEFAULT_RESOURCE_URL_TAG)
+        save = self._option('save', False)
+
+        datasets = None
+        if save:
+            # Use real datasets so that the save functions find what they look up
+            packages = model.Session.query(model.Package).filter(model.Package.state == 'active').limit(500).all()
+            datasets = [(package.name, [resource.id for resource in package.resources]) for package in packages]
+
+        self.init_service(args, datasets=datasets)
+        self.profile_id = get_profile_id(self.service)
+
+        def rate(count, seconds):
+            return '%d' % (count / seconds) if seconds > 0 else '-'
+
+        print '%-20s %10s %12s %12s %10s %12s' % ('type', 'rows', 'fetch/s', 'resolve/s', 'cells', 'save/s')
+        for query in self.get_queries(start_date):
+            data = StatsAccumulator(query['columns'], merge=query['merge'])
+            rows = 0
+            fetch_time = 0.0
+            resolve_time = 0.0
+            for date, current in self.get_windows(query['dates']):
+                started = time.time()
                 results = self.ga_query(start_date=date,
                                         end_date=current,
                                         filters=query['filters'],
                                         metrics=query['metrics'],
                                         sort=query['sort'],
                                         dimensions=query['dimensions'])
-                # parse query
-                resolver = query['resolver']
-                data = resolver(results, data)
-                current = date
+                fetch_time += time.time() - started
+                rows += len(results.get('rows', []))
+
+                started = time.time()
+                data = query['resolver'](results, data)
+                resolve_time += time.time() - started
+
+            started = time.time()
+            cells = len(data)
+            resolve_time += time.time() - started
+            save_rate = '-'
+            if save:
+                started = time.time()
+                query['save'](data)
+                model.Session.commit()
+                save_rate = rate(cells, time.time() - started)
 
-            save_function = query['save']
-            print 'Saving type: %s' % query['type']
-            save_function(data)
-            model.Session.commit()
-            print 'Saving done'
-            self.log.info("Successfully saved analytics query of type: %s" % query['type'])
+            print '%-20s %10d %12s %12s %10d %12s' % (query['type'], rows, rate(rows, fetch_time),
+                                                      rate(rows, resolve_time), cells, save_rate)
 
-    def get_dates_between_update(self, start_date, latest_date=None):
-        now = datetime.datetime.now()
+    def get_windows(self, dates, now=None):
+        '''
+        Pairs the dates returned by get_dates_between_update into (start, end)
+        windows, the first one ending now and each following one ending
+        where the previous one starts
+        '''
+        windows = []
+        current = now or datetime.datetime.now()
+        for date in dates:
+            windows.append((date, current))
+            current = date
+        return windows
+
+    def get_dates_between_update(self, start_date, latest_date=None, now=None):
+        '''
+        Start dates of the windows to fetch, newest first: the first day of
+        the current month, the first days of the months before it and the
+        floor date. The windows of past months are always whole calendar
+        months, so their response cache keys stay the same from run to run.
+        '''
+        now = now or datetime.datetime.now()
 
         # If there is no last valid value found from database then we make sure to grab all values from start. i.e. 2014
         floor_date = datetime.date(2014, 1, 1)
@@ -270,185 +871,158 @@ class GACommand(p.toolkit.CkanCommand):
         if current_month != datetime.date(floor_date.year, floor_date.month, 1):
             while current_month > datetime.date(floor_date.year, floor_date.month, floor_date.day):
                 dates.append(current_month)
-                current_month = current_month - datetime.timedelta(days=30)
+                current_month = (current_month - datetime.timedelta(days=1)).replace(day=1)
         dates.append(floor_date)
 
         return dates
 
+    @property
+    def bulk_loader(self):
+        '''
+        BulkLoader used by the save functions on PostgreSQL, None when the ORM is used
+        '''
+        if self._bulk_loader is False:
+            from ckanext.googleanalytics import bulkload
+            self._bulk_loader = None
+            if p.toolkit.asbool(pylonsconfig.get('googleanalytics.bulk_load', True)) and \
+                    bulkload.supports_bulk_load(model.meta.engine):
+                self._bulk_loader = bulkload.BulkLoader(model.Session)
+        return self._bulk_loader
+
+    def drop_compacted(self, data):
+        '''
+        Drops the rows of dates compact has folded into monthly rows, which
+        would be counted twice if saved again
+        '''
+        compacted_before = get_compacted_before()
+        if compacted_before is not None:
+            dropped = data.drop_before(compacted_before)
+            if dropped:
+                self.log.info("Skipped %d rows dated before %s, which are already compacted", dropped, compacted_before)
+
     def save_type_package(self, data):
-        for package_id_or_name, date_collection in data.items():
+        self.drop_compacted(data)
+        if self.bulk_loader:
+            return self.bulk_loader.save_package_visits(data)
+
+        for package_id_or_name, rows in data.groups():
             # this is a lot slower than by_name()
             item = model.Package.get(package_id_or_name)
             if not item:
                 self.log.warning("Couldn't find package %s" % package_id_or_name)
                 continue
 
-            for date, value in date_collection.iteritems():
-                PackageStats.update_visits(item.id, date, value["visits"], value["entrances"])
+            for date, (visits, entrances) in rows:
+                PackageStats.update_visits(item.id, date, visits, entrances)
 
     def save_type_resource(self, data):
-        for identifier, date_collection in data.items():
-            resource_id = identifier
+        self.drop_compacted(data)
+        if self.bulk_loader:
+            return self.bulk_loader.save_resource_downloads(data)
+
+        for resource_id, rows in data.groups():
             resource = model.Session.query(model.Resource).autoflush(True).filter_by(id=resource_id).first()
             if not resource:
                 self.log.warning("Couldn't find resource %s" % resource_id)
                 continue
-            for date, value in date_collection.iteritems():
-                ResourceStats.update_visits(resource.id, date, value["downloads"])
+            for date, (downloads,) in rows:
+                ResourceStats.update_visits(resource.id, date, downloads)
 
     def save_type_package_downloads(self, data):
-        for package_id_or_name, date_collection in data.items():
+        self.drop_compacted(data)
+        if self.bulk_loader:
+            return self.bulk_loader.save_package_downloads(data)
+
+        for package_id_or_name, rows in data.groups():
             package = model.Package.get(package_id_or_name)
 
             if not package:
                 self.log.warning("Couldn't find package %s" % package_id_or_name)
                 continue
 
-            for date, value in date_collection.iteritems():
-                PackageStats.update_downloads(package_id=package.id, visit_date=date, downloads=value["downloads"])
+            for date, (downloads,) in rows:
+                PackageStats.update_downloads(package_id=package.id, visit_date=date, downloads=downloads)
 
     def save_type_visitorlocation(self, data):
-        for location, visits_collection in data.items():
-            visits = visits_collection.get('visits', {})
-            for visit_date, count in visits.iteritems():
+        if self.bulk_loader:
+            return self.bulk_loader.save_location_visits(data)
+
+        for location, rows in data.groups():
+            for visit_date, (count,) in rows:
                 AudienceLocationDate.update_visits(location, visit_date, count)
                 self.log.info("Updated %s on %s with %s visits" % (location, visit_date, count))
 
     def save_type_search_terms(self, data):
-        for search_term, search_term_count_collection in data.iteritems():
-            for visit_date, search_count in search_term_count_collection.iteritems():
+        if self.bulk_loader:
+            return self.bulk_loader.save_search_terms(data)
+
+        for search_term, rows in data.groups():
+            for visit_date, (search_count,) in rows:
                 SearchStats.update_search_term_count(search_term, visit_date, search_count)
 
     def resolver_type_package(self, results, data):
         '''
-        formats results and returns a dictionary like:
-        {
-            'package_name_or_id': { 2019-02-24: { 'visits': 500,  'entrances': 400, 'downloads': 300 }},
-        }
+        adds the rows to data, a StatsAccumulator with columns (visits, entrances)
+        keyed by package name or id and date
         '''
-        if 'rows' in results:
-            for result in results.get('rows'):
-                path = result[0]
-                visit_date = datetime.datetime.strptime(result[1], "%Y%m%d").date()
-
-                splitPath = path.split('/')
-                path_with_vars = splitPath[splitPath.index('dataset') + 1]
-                package_id_or_name = path_with_vars.split('?')[0].split('&')[0]
-
-                visit_count = result[2]
-                entrance_count = result[3]
-
-                # add package_id_or_name if not already there
-                if package_id_or_name not in data:
-                    data.setdefault(package_id_or_name, {})
-
-                if visit_date not in data[package_id_or_name]:
-                    data[package_id_or_name].setdefault(visit_date, {"visits": 0, "entrances": 0})
+        for result in results.get('rows', []):
+            page = parse_page_path(result[0])
+            if page is None:
+                self.malformed_rows['package'] += 1
+                continue
 
-                # Adds visits in different languages together
-                data[package_id_or_name][visit_date]['visits'] += int(visit_count)
-                data[package_id_or_name][visit_date]['entrances'] += int(entrance_count)
+            # Adds visits in different languages together
+            data.add(page[1], decode_ga_date(result[1])[1], int(result[2]), int(result[3]))
 
         return data
 
     def resolver_type_resource(self, results, data):
         '''
-        formats results and returns a dictionary like:
-        {
-            'resource_id': { 2019-02-24: { 'downloads': 500 }},
-        }
+        adds the rows to data, a StatsAccumulator with columns (downloads,)
+        keyed by resource id and date
         '''
-        if 'rows' in results:
-            for result in results.get('rows'):
-                path = result[0]
-                visit_date = datetime.datetime.strptime(result[1], "%Y%m%d").date()
-
-                splitPath = path.split('/')
-                resource_id = splitPath[splitPath.index('resource') + 1]
-
-                download_count = result[2]
-
-                # add resource_id if not already there
-                if resource_id not in data:
-                    data.setdefault(resource_id, {})
-
-                if visit_date not in data[resource_id]:
-                    data[resource_id].setdefault(visit_date, {"downloads": 0})
+        for result in results.get('rows', []):
+            page = parse_page_path(result[0])
+            if page is None or page[0] != 'resource':
+                self.malformed_rows['resource'] += 1
+                continue
 
-                # Adds downloads in different languages together
-                data[resource_id][visit_date]['downloads'] += int(download_count)
+            # Adds downloads in different languages together
+            data.add(page[2], decode_ga_date(result[1])[1], int(result[2]))
 
         return data
 
     def resolver_type_package_downloads(self, results, data):
         '''
-        formats results and returns a dictionary like:
-        {
-            'package_name': { '2019-02-24': { 'downloads': 500 }, ...}, ...
-        }
+        adds the rows to data, a StatsAccumulator with columns (downloads,)
+        keyed by package name and date
         '''
-        if 'rows' in results:
-            for result in results.get('rows'):
-                path = result[0]
-                visit_date = datetime.datetime.strptime(result[1], "%Y%m%d").date()
-                downloads = result[3]
-
-                splitPath = path.split('/')
-                path_with_vars = splitPath[splitPath.index('dataset') + 1]
-                package_name = path_with_vars.split('?')[0].split('&')[0]
-
-                # add package if not already there
-                if package_name not in data:
-                    data.setdefault(package_name, {})
-
-                # add visit_date if not already there
-                if visit_date not in data[package_name]:
-                    data[package_name].setdefault(visit_date, {"downloads": 0})
+        for result in results.get('rows', []):
+            page = parse_page_path(result[0])
+            if page is None:
+                self.malformed_rows['package_downloads'] += 1
+                continue
 
-                # Set total downloads to
-                data[package_name][visit_date]['downloads'] += int(downloads)
+            data.add(page[1], decode_ga_date(result[1])[1], int(result[3]))
 
         return data
 
     def resolver_type_visitorlocation(self, results, data):
         '''
-        formats results and returns a dictionary like:
-        {
-            'Finland': { 'visits': { 2019-02-24: 500, ... } }
-        }
+        adds the rows to data, a StatsAccumulator with columns (visits,)
+        keyed by location name and date, later rows replacing earlier ones
         '''
-        if 'rows' in results:
-            for result in results.get('rows'):
-                location = result[0]
-                date = result[1]
-                count = result[2]
-
-                visit_date = datetime.datetime.strptime(date, "%Y%m%d").date()
-                # add location if not already in data
-                if location not in data:
-                    data.setdefault(location, {})["visits"] = {}
-                data[location]['visits'][visit_date] = int(count)
+        for location, date, count in results.get('rows', []):
+            data.add(location, decode_ga_date(date)[1], int(count))
         return data
 
     def resolver_type_search_terms(self, results, data):
         '''
-        formats results and returns a dictionary like:
-        {
-            'search_term_name': {2019-02-24: 500, ...},
-            'another_search_term': {2019-02-25: 600, ...}
-        }
+        adds the rows to data, a StatsAccumulator with columns (count,)
+        keyed by search term and date, later rows replacing earlier ones
         '''
-        if 'rows' in results:
-            for result in results.get('rows'):
-                search_term = result[0]
-                date = result[1]
-                search_count = result[2]
-
-                visit_date = datetime.datetime.strptime(date, "%Y%m%d").date()
-                if search_term not in data:
-                    data[search_term] = {visit_date: search_count}
-                else:
-                    data[search_term][visit_date] = search_count
+        for search_term, date, search_count in results.get('rows', []):
+            data.add(search_term, decode_ga_date(date)[1], int(search_count))
         return data
 
     def test_queries(self):
@@ -477,3 +1051,13 @@ class GACommand(p.toolkit.CkanCommand):
                 print("Executing '{0}'".format(query))
                 model.Session.execute(query)
                 model.Session.commit()
+
+        for table in (AudienceLocationTotals.__table__, PackageStatsMonthly.__table__,
+                      ResourceStatsMonthly.__table__):
+            if not table.exists(model.meta.engine):
+                print("Creating table '{0}'".format(table.name))
+                table.create(model.meta.engine)
+        # Also repairs totals that went out of step with audience_location_date
+        print("Computing location totals")
+        AudienceLocationTotals.rebuild()
+        model.Session.commit()
@@ -0,0 +1,92 @@
+"""
+Retention of the daily stats.
+
+Reports only need daily detail for recent windows, so package_stats and
+resource_stats rows older than the retention period are folded into
+monthly rows in package_stats_monthly and resource_stats_monthly, which
+the all time totals include. Stats of purged datasets and resources are
+deleted. Whole months are folded at a time and everything happens in one
+transaction. Location and search term stats are not compacted.
+
+The cutoff is recorded in system_info and never moves back. Ingest, load
+and backfill skip package and resource stats dated before it, which would
+otherwise be counted again on top of the monthly rows.
+"""
+import logging
+import datetime
+from collections import OrderedDict
+
+from sqlalchemy import text
+import ckan.model as model
+
+from ckanext.googleanalytics.model import get_compacted_before, set_compacted_before
+
+log = logging.getLogger(__name__)
+
+DEFAULT_RETENTION_YEARS = 3
+
+DELETE_ORPHANED = OrderedDict((
+    ('package_stats', '''
+        DELETE FROM package_stats s WHERE NOT EXISTS (SELECT 1 FROM package p WHERE p.id = s.package_id)'''),
+    ('package_stats_monthly', '''
+        DELETE FROM package_stats_monthly s WHERE NOT EXISTS (SELECT 1 FROM package p WHERE p.id = s.package_id)'''),
+    ('resource_stats', '''
+        DELETE FROM resource_stats s WHERE NOT EXISTS (SELECT 1 FROM resource r WHERE r.id = s.resource_id)'''),
+    ('resource_stats_monthly', '''
+        DELETE FROM resource_stats_monthly s WHERE NOT EXISTS (SELECT 1 FROM resource r WHERE r.id = s.resource_id)'''),
+))
+
+FOLD = OrderedDict((
+    ('package_stats', ('''
+        INSERT INTO package_stats_monthly (package_id, month, visits, entrances, downloads)
+        SELECT package_id, date_trunc('month', visit_date), coalesce(sum(visits), 0), coalesce(sum(entrances), 0),
+               coalesce(sum(downloads), 0)
+        FROM package_stats WHERE visit_date < :cutoff
+        GROUP BY package_id, date_trunc('month', visit_date)
+        ON CONFLICT (package_id, month) DO UPDATE SET
+            visits = package_stats_monthly.visits + EXCLUDED.visits,
+            entrances = package_stats_monthly.entrances + EXCLUDED.entrances,
+            downloads = package_stats_monthly.downloads + EXCLUDED.downloads''', '''
+        DELETE FROM package_stats WHERE visit_date < :cutoff''')),
+    ('resource_stats', ('''
+        INSERT INTO resource_stats_monthly (resource_id, month, visits)
+        SELECT resource_id, date_trunc('month', visit_date), coalesce(sum(visits), 0)
+        FROM resource_stats WHERE visit_date < :cutoff
+        GROUP BY resource_id, date_trunc('month', visit_date)
+        ON CONFLICT (resource_id, month) DO UPDATE SET
+            visits = resource_stats_monthly.visits + EXCLUDED.visits''', '''
+        DELETE FROM resource_stats WHERE visit_date < :cutoff''')),
+))
+
+
+def retention_cutoff(retention_years, today=None):
+    '''
+    First day of the oldest month whose daily stats are kept
+    '''
+    today = today or datetime.date.today()
+    return datetime.datetime(today.year - retention_years, today.month, 1)
+
+
+def compact(retention_years=DEFAULT_RETENTION_YEARS, today=None):
+    '''
+    Deletes the stats of purged datasets and resources and folds the daily
+    stats older than retention_years years into monthly rows
+
+    :return: OrderedDict of the number of rows deleted and folded, by table
+    '''
+    cutoff = retention_cutoff(retention_years, today)
+    compacted_before = get_compacted_before()
+    # Recorded before folding: if the fold fails, the daily rows are only left out of loads until the next compact
+    if compacted_before is None or compacted_before < cutoff.date():
+        set_compacted_before(cutoff)
+    counts = OrderedDict()
+    with model.meta.engine.begin() as connection:
+        # Orphans first, so that they are not folded
+        for table_name, sql in DELETE_ORPHANED.iteritems():
+            counts['%s orphaned' % table_name] = connection.execute(text(sql)).rowcount
+        for table_name, (fold_sql, delete_sql) in FOLD.iteritems():
+            connection.execute(text(fold_sql), cutoff=cutoff)
+            counts['%s folded' % table_name] = connection.execute(text(delete_sql), cutoff=cutoff).rowcount
+    log.info("Compacted stats older than %s: %s", cutoff.date(),
+             ', '.join('%d %s' % (count, name) for name, count in counts.iteritems()))
+    return counts
@@ -1,5 +1,8 @@
 import logging
-from ckan.lib.base import c
+import time
+import datetime
+from ckan.lib.base import c, request, response, BaseController
+import ckan.model as model
 
 import hashlib
 import plugin
@@ -12,7 +15,9 @@ import ckan.plugins as p
 log = logging.getLogger('ckanext.googleanalytics')
 
 
-def _post_analytics(user, request_obj_type, request_function, request_description, request_id, environ=None):
+def _post_analytics(user, request_obj_type, request_function, request_description, request_id, environ=None,
+                    sample_rate=None):
+    started = time.time()
     environ = environ or c.environ
     if config.get('googleanalytics.id') or config.get('googleanalytics.test_mode'):
         data_dict = {
@@ -28,7 +33,21 @@ def _post_analytics(user, request_obj_type, request_function, request_descriptio
             "ea": request_obj_type + request_function,
             "el": request_id,
         }
-        plugin.GoogleAnalyticsPlugin.analytics_queue.put(data_dict)
+        if sample_rate is not None and sample_rate < 1.0:
+            # Event value is the number of calls this hit stands for, so summing it scales sampled totals back up
+            data_dict["ev"] = plugin.sample_weight(sample_rate)
+            sample_rate_dimension = config.get('googleanalytics.api_actions.sample_rate_dimension')
+            if sample_rate_dimension:
+                data_dict[sample_rate_dimension] = str(sample_rate)
+        event_aggregator = plugin.GoogleAnalyticsPlugin.event_aggregator
+        if event_aggregator is not None and request_obj_type == 'action':
+            event_aggregator.add(data_dict, request_function)
+        else:
+            plugin.GoogleAnalyticsPlugin.analytics_queue.put((data_dict, request_function, time.time()))
+
+        tracking_metrics = plugin.GoogleAnalyticsPlugin.tracking_metrics
+        if tracking_metrics is not None:
+            tracking_metrics.record_overhead(request_function, time.time() - started)
 
 
 class GAApiController(ApiController):
@@ -36,10 +55,13 @@ class GAApiController(ApiController):
     # intercept API calls to record via google analytics
     def action(self, logic_function, ver=None):
         if c.environ['SERVER_NAME'] not in ('localhost', '127.0.0.1', '::1'):
-            request_query = c.environ.get('paste.parsed_dict_querystring', ({},))[0]
-            request_id = request_query.get('query', request_query.get('q', ''))
-            request_description = "CKAN API Request"
-            _post_analytics(c.user or 'anonymous', 'action', logic_function, request_description, request_id)
+            sample_rate = plugin.GoogleAnalyticsPlugin.api_action_sampler.sample(logic_function)
+            if sample_rate is not None:
+                request_query = c.environ.get('paste.parsed_dict_querystring', ({},))[0]
+                request_id = request_query.get('query', request_query.get('q', ''))
+                request_description = "CKAN API Request"
+                _post_analytics(c.user or 'anonymous', 'action', logic_function, request_description, request_id,
+                                sample_rate=sample_rate)
         return ApiController.action(self, logic_function, ver)
 
 
@@ -60,3 +82,120 @@ class GAResourceController(OptionalController):
         if c.environ['SERVER_NAME'] not in ('localhost', '127.0.0.1', '::1'):
             _post_analytics(c.user, "Resource", "Download", "CKAN Resource Download Request", resource_id)
         return OptionalController.resource_download(self, id, resource_id, filename)
+
+
+class GAExportController(BaseController):
+
+    def export(self, kind):
+        '''
+        Streams the daily stats of datasets (kind=package) or resources as
+        CSV or NDJSON (format=csv|ndjson), optionally limited to
+        start_date..end_date (YYYY-MM-DD) and one dataset (id)
+        '''
+        from ckanext.googleanalytics import export
+
+        context = {'model': model, 'user': c.user, 'auth_user_obj': c.userobj}
+        try:
+            p.toolkit.check_access('googleanalytics_export', context, {})
+        except p.toolkit.NotAuthorized:
+            p.toolkit.abort(403, p.toolkit._('Not authorized to export analytics'))
+
+        export_format = request.params.get('format', 'csv')
+        if kind not in export.EXPORT_KINDS or export_format not in export.EXPORT_FORMATS:
+            p.toolkit.abort(404)
+
+        try:
+            start_date, end_date = [datetime.datetime.strptime(request.params[name], '%Y-%m-%d').date()
+                                    if request.params.get(name) else None
+                                    for name in ('start_date', 'end_date')]
+        except ValueError:
+            p.toolkit.abort(400, p.toolkit._('Dates should be in YYYY-MM-DD format'))
+
+        package_id = None
+        if request.params.get('id'):
+            package = model.Package.get(request.params['id'])
+            if package is None:
+                p.toolkit.abort(404, p.toolkit._('Dataset not found'))
+            package_id = package.id
+
+        response.headers['Content-Type'] = export.CONTENT_TYPES[export_format]
+        response.headers['Content-Disposition'] = 'attachment; filename="%s_stats.%s"' % (kind, export_format)
+        # Returning an iterator makes Pylons send the chunks as they are produced
+        return export.export_chunks(kind, export_format, start_date, end_date, package_id)
+
+
+class GAReportController(BaseController):
+    PAGE_SIZES = (20, 50, 100)
+
+    def _time_period(self):
+        from ckanext.googleanalytics.reports import PERIODS
+
+        time_period = request.params.get('time', 'month')
+        if time_period not in PERIODS:
+            p.toolkit.abort(400, p.toolkit._('Unknown time period'))
+        return time_period
+
+    def dataset_table(self, report_name):
+        '''
+        All datasets of a dataset report, a page at a time. The next page
+        starts after the (visits, package id) given in ``after``.
+        '''
+        from ckanext.googleanalytics.model import PackageStats
+        from ckanext.googleanalytics.reports import DATASET_REPORTS, PERIODS, last_calendar_period
+
+        if report_name not in DATASET_REPORTS:
+            p.toolkit.abort(404)
+        descending = DATASET_REPORTS[report_name]
+        time_period = self._time_period()
+        try:
+            page_size = int(request.params.get('page_size', self.PAGE_SIZES[0]))
+        except ValueError:
+            page_size = None
+        if page_size not in self.PAGE_SIZES:
+            p.toolkit.abort(400, p.toolkit._('Unsupported page size'))
+        after = None
+        if request.params.get('after'):
+            try:
+                visits, package_id = request.params['after'].split(':', 1)
+                after = (int(visits), package_id)
+            except ValueError:
+                p.toolkit.abort(400, p.toolkit._('Invalid page'))
+
+        start_date, end_date = last_calendar_period(time_period)
+        datasets, next_key = PackageStats.get_total_visits_page(start_date, end_date, descending=descending,
+                                                                page_size=page_size, after=after)
+        return p.toolkit.render('report/dataset_table.html', extra_vars={
+            'report_name': report_name,
+            'descending': descending,
+            'time': time_period,
+            'periods': PERIODS,
+            'page_size': page_size,
+            'page_sizes': self.PAGE_SIZES,
+            'datasets': datasets,
+            'total': PackageStats.count_total_visits(start_date, end_date),
+            'first_page': after is None,
+            'next_after': '%d:%s' % next_key if next_key else None,
+        })
+
+    def dataset_table_download(self, report_name):
+        '''
+        Streams all datasets of a dataset report as CSV, JSON or NDJSON
+        (format=csv|json|ndjson). Also answers the downloads of
+        ckanext-report, as the stored reports only hold the top datasets.
+        '''
+        from ckanext.googleanalytics import export
+        from ckanext.googleanalytics.reports import DATASET_REPORTS, DATASET_TABLE_COLUMNS, dataset_table_rows
+
+        if report_name not in DATASET_REPORTS:
+            p.toolkit.abort(404)
+        time_period = self._time_period()
+        download_format = request.params.get('format', 'csv')
+        if download_format not in export.EXPORT_FORMATS:
+            p.toolkit.abort(400, p.toolkit._('Unsupported format'))
+
+        response.headers['Content-Type'] = export.CONTENT_TYPES[download_format]
+        response.headers['Content-Disposition'] = 'attachment; filename="%s_%s.%s"' % (
+            report_name, time_period, download_format)
+        # Returning an iterator makes Pylons send the chunks as they are produced
+        return export.format_chunks(download_format, DATASET_TABLE_COLUMNS,
+                                    dataset_table_rows(time_period, DATASET_REPORTS[report_name]))
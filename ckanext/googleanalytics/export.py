@@ -0,0 +1,160 @@
+"""
+Streaming export of the daily stats.
+
+Rows are read with a server side cursor on a connection of their own, in
+batches of EXPORT_BATCH, with the dataset and resource names joined in, and
+written out as CSV, JSON or NDJSON chunks as they arrive. The memory used does
+not depend on the number of rows exported.
+"""
+import csv
+import json
+import datetime
+from cStringIO import StringIO
+
+from sqlalchemy import select, and_
+import ckan.model as model
+
+from ckanext.googleanalytics.model import PackageStats, ResourceStats
+from ckanext.googleanalytics.bulkload import CsvStream
+
+EXPORT_KINDS = ('package', 'resource')
+EXPORT_FORMATS = ('csv', 'json', 'ndjson')
+CONTENT_TYPES = {
+    'csv': 'text/csv; charset=utf-8',
+    'json': 'application/json; charset=utf-8',
+    'ndjson': 'application/x-ndjson; charset=utf-8',
+}
+
+# Rows fetched from the cursor at a time
+EXPORT_BATCH = 5000
+
+# Bytes of output produced at a time
+CHUNK_SIZE = 65536
+
+
+def export_query(kind, start_date=None, end_date=None, package_id=None):
+    '''
+    Select of the daily stats of one kind with the names joined in
+
+    :return: (column names, select)
+    '''
+    package = model.package_table
+    if kind == 'package':
+        stats = PackageStats.__table__
+        columns = [stats.c.package_id, package.c.name.label('package_name'),
+                   package.c.title.label('package_title'), stats.c.visit_date, stats.c.visits,
+                   stats.c.entrances, stats.c.downloads]
+        from_obj = stats.join(package, package.c.id == stats.c.package_id)
+        order_by = [stats.c.visit_date, stats.c.package_id]
+    elif kind == 'resource':
+        stats = ResourceStats.__table__
+        resource = model.resource_table
+        columns = [stats.c.resource_id, resource.c.name.label('resource_name'), package.c.id.label('package_id'),
+                   package.c.name.label('package_name'), stats.c.visit_date, stats.c.visits]
+        from_obj = stats.join(resource, resource.c.id == stats.c.resource_id).join(
+            package, package.c.id == resource.c.package_id)
+        order_by = [stats.c.visit_date, stats.c.resource_id]
+    else:
+        raise ValueError('Unknown export "%s", expected one of: %s' % (kind, ', '.join(EXPORT_KINDS)))
+
+    conditions = []
+    if start_date is not None:
+        conditions.append(stats.c.visit_date >= start_date)
+    if end_date is not None:
+        conditions.append(stats.c.visit_date < end_date + datetime.timedelta(days=1))
+    if package_id is not None:
+        conditions.append(package.c.id == package_id)
+
+    query = select(columns).select_from(from_obj).order_by(*order_by)
+    if conditions:
+        query = query.where(and_(*conditions))
+    return [column.name for column in columns], query
+
+
+def stream_rows(query):
+    '''
+    Yields the rows of a select, fetched in batches with a server side cursor
+    '''
+    connection = model.meta.engine.connect()
+    try:
+        result = connection.execution_options(stream_results=True).execute(query)
+        while True:
+            rows = result.fetchmany(EXPORT_BATCH)
+            if not rows:
+                break
+            for row in rows:
+                yield row
+    finally:
+        connection.close()
+
+
+def csv_chunks(columns, rows):
+    header = StringIO()
+    csv.writer(header, lineterminator='\n').writerow(columns)
+    yield header.getvalue()
+
+    stream = CsvStream(rows)
+    while True:
+        chunk = stream.read(CHUNK_SIZE)
+        if not chunk:
+            break
+        yield chunk
+
+
+def _json_value(value):
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        return value.isoformat()
+    raise TypeError(repr(value))
+
+
+def ndjson_chunks(columns, rows):
+    out = StringIO()
+    for row in rows:
+        out.write(json.dumps(dict(zip(columns, row)), default=_json_value))
+        out.write('\n')
+        if out.tell() >= CHUNK_SIZE:
+            yield out.getvalue()
+            out = StringIO()
+    if out.tell():
+        yield out.getvalue()
+
+
+def json_chunks(columns, rows):
+    '''
+    Like ndjson_chunks, but the records make up one JSON array
+    '''
+    out = StringIO()
+    out.write('[')
+    separator = ''
+    for row in rows:
+        out.write(separator)
+        out.write(json.dumps(dict(zip(columns, row)), default=_json_value))
+        separator = ',\n'
+        if out.tell() >= CHUNK_SIZE:
+            yield out.getvalue()
+            out = StringIO()
+    out.write(']\n')
+    yield out.getvalue()
+
+
+def format_chunks(export_format, columns, rows):
+    '''
+    Yields rows with the given columns as chunks of CSV, JSON or NDJSON
+    '''
+    if export_format not in EXPORT_FORMATS:
+        raise ValueError('Unknown format "%s", expected one of: %s' % (export_format, ', '.join(EXPORT_FORMATS)))
+    if export_format == 'csv':
+        return csv_chunks(columns, rows)
+    if export_format == 'json':
+        return json_chunks(columns, rows)
+    return ndjson_chunks(columns, rows)
+
+
+def export_chunks(kind, export_format, start_date=None, end_date=None, package_id=None):
+    '''
+    Yields the exported stats as chunks of CSV, JSON or NDJSON
+    '''
+    if export_format not in EXPORT_FORMATS:
+        raise ValueError('Unknown format "%s", expected one of: %s' % (export_format, ', '.join(EXPORT_FORMATS)))
+    columns, query = export_query(kind, start_date, end_date, package_id)
+    return format_chunks(export_format, columns, stream_rows(query))
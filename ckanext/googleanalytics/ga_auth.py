@@ -1,8 +1,31 @@
+import os
+import tempfile
+
 from apiclient.discovery import build
 from oauth2client.service_account import ServiceAccountCredentials
 
 from pylons import config
 
+from ckanext.googleanalytics import ga_cache
+
+log = __import__('logging').getLogger(__name__)
+
+SERVICES = ('google', 'recorded', 'synthetic')
+
+
+def metadata_cache():
+    """
+    Cache of the discovery document and profile id configured with
+    googleanalytics.metadata_cache.dir and googleanalytics.metadata_cache.ttl
+    (seconds, 0 disables the cache). Returns None when disabled.
+    """
+    ttl = int(config.get('googleanalytics.metadata_cache.ttl', ga_cache.DEFAULT_METADATA_TTL))
+    if ttl <= 0:
+        return None
+    directory = config.get('googleanalytics.metadata_cache.dir') or os.path.join(
+        config.get('cache_dir') or tempfile.gettempdir(), 'googleanalytics')
+    return ga_cache.MetadataCache(directory, ttl=ttl)
+
 
 def get_service(api_name, api_version, scopes, key_file_location):
     """Get a service that communicates to a Google API.
@@ -20,8 +43,11 @@ def get_service(api_name, api_version, scopes, key_file_location):
     credentials = ServiceAccountCredentials.from_json_keyfile_name(
         key_file_location, scopes=scopes)
 
-    # Build the service object.
-    service = build(api_name, api_version, credentials=credentials, cache_discovery=False)
+    # Build the service object. The discovery document is fetched only when
+    # the cached copy has expired.
+    cache = metadata_cache()
+    service = build(api_name, api_version, credentials=credentials, cache_discovery=cache is not None,
+                    cache=cache)
 
     return service
 
@@ -46,6 +72,62 @@ def init_service(credentials_file):
     return service
 
 
+def init_reporting_service(credentials_file):
+    """
+    Given a file containing the service accounts credentials
+    will return a service object representing the Analytics Reporting API v4.
+    """
+    return get_service(
+        api_name='analyticsreporting',
+        api_version='v4',
+        scopes=['https://www.googleapis.com/auth/analytics.readonly'],
+        key_file_location=credentials_file)
+
+
+def create_service(credentials_file, service_name=None, recorded_dir=None, record_dir=None, rows_per_day=None,
+                   datasets=None):
+    """
+    Service factory used by the paster commands.
+
+    ``service_name`` (or ``googleanalytics.service`` in the config) selects
+    between the live Google service and the offline fakes in ga_fake:
+
+        google:    init_service(credentials_file), optionally recording every
+                   response to ``record_dir``
+        recorded:  responses saved earlier into ``recorded_dir``
+        synthetic: generated rows, ``rows_per_day`` rows for every day
+    """
+    import ga_fake
+
+    service_name = service_name or config.get('googleanalytics.service', 'google')
+    if service_name not in SERVICES:
+        raise ValueError('Unknown service "%s", expected one of: %s' % (service_name, ', '.join(SERVICES)))
+
+    if service_name == 'google':
+        service = init_service(credentials_file)
+        record_dir = record_dir or config.get('googleanalytics.service.record_dir')
+        if record_dir:
+            service = ga_fake.RecordingService(service, record_dir)
+        return service
+
+    if service_name == 'recorded':
+        recorded_dir = recorded_dir or config.get('googleanalytics.service.recorded_dir')
+        if not recorded_dir:
+            raise ValueError('Recorded service requires a directory of recorded responses')
+        source = ga_fake.RecordedResponses(recorded_dir)
+    else:
+        rows_per_day = int(rows_per_day or config.get('googleanalytics.service.rows_per_day',
+                                                      ga_fake.DEFAULT_ROWS_PER_DAY))
+        source = ga_fake.SyntheticResponses(
+            rows_per_day=rows_per_day,
+            datasets=datasets,
+            resource_url_tag=config.get('googleanalytics_resource_prefix', '/download/'))
+
+    return ga_fake.FakeService(source,
+                               account_name=config.get('googleanalytics.account'),
+                               web_property_id=config.get('googleanalytics.id'))
+
+
 def get_profile_id(service):
     """
     Get the profile ID for this user and the service specified by the
@@ -53,11 +135,13 @@ def get_profile_id(service):
     over all of the accounts available to the user who invoked the
     service to find one where the account name matches (in case the
     user has several).
-    """
-    accounts = service.management().accounts().list().execute()
 
-    if not accounts.get('items'):
-        return None
+    'googleanalytics.profile_id' skips the lookup, otherwise a found
+    profile ID is kept in the metadata cache.
+    """
+    profile_id = config.get('googleanalytics.profile_id')
+    if profile_id:
+        return profile_id
 
     # These values need to be set in the .ini file
     # Name of analytics account
@@ -65,17 +149,37 @@ def get_profile_id(service):
     # Id of analytics property or app
     webPropertyId = config.get('googleanalytics.id')
 
+    cache = metadata_cache()
+    cache_key = 'profile_id:%s:%s:%s' % (type(service).__name__, accountName, webPropertyId)
+    if cache is not None:
+        profile_id = cache.get(cache_key)
+        if profile_id:
+            return profile_id
+
+    accounts = service.management().accounts().list().execute()
+
+    if not accounts.get('items'):
+        return None
+
     # Get id for analytics account based on the name
+    accountId = None
     for acc in accounts.get('items'):
         if acc.get('name') == accountName:
             accountId = acc.get('id')
 
+    if accountId is None:
+        log.error('No Google Analytics account named "%s" found', accountName)
+        return None
+
     # Get all analytics views
     profiles = service.management().profiles().list(
         accountId=accountId, webPropertyId=webPropertyId).execute()
 
     # Return the first view id from analytics
     if profiles.get('items'):
-        return profiles.get('items')[0].get('id')
+        profile_id = profiles.get('items')[0].get('id')
+        if cache is not None:
+            cache.set(cache_key, profile_id)
+        return profile_id
 
     return None
@@ -0,0 +1,172 @@
+"""
+On-disk cache of Google Analytics API responses.
+
+Data for days older than the processing latency of Google Analytics does
+not change any more, so responses for windows that ended before the settle
+horizon are stored under a hash of the request and served from disk on
+later runs. Windows reaching into the last ``settle_hours`` hours are
+always fetched. When the cache grows over ``max_size`` bytes, the least
+recently used responses are removed.
+
+MetadataCache keeps what the service needs before any data is fetched,
+the API discovery document and the resolved profile id, for a fixed time.
+"""
+import os
+import json
+import gzip
+import hashlib
+import time
+import datetime
+
+log = __import__('logging').getLogger(__name__)
+
+DEFAULT_SETTLE_HOURS = 48
+DEFAULT_MAX_SIZE = 1024 * 1024 * 1024
+DEFAULT_METADATA_TTL = 24 * 60 * 60
+
+
+class ResponseCache(object):
+    def __init__(self, directory, max_size=DEFAULT_MAX_SIZE, settle_hours=DEFAULT_SETTLE_HOURS):
+        self.directory = directory
+        self.max_size = max_size
+        self.settle_hours = settle_hours
+        self._size = None
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    @staticmethod
+    def key(**request):
+        '''
+        Content address of a request, e.g. key(profile_id=.., filters=.., start_date=.., ...)
+        '''
+        return hashlib.sha256(json.dumps(request, sort_keys=True)).hexdigest()
+
+    def is_settled(self, end_date, now=None):
+        '''
+        True if the whole window up to end_date (inclusive) is older than the settle horizon
+        '''
+        if isinstance(end_date, datetime.datetime):
+            end_date = end_date.date()
+        end_of_window = datetime.datetime.combine(end_date + datetime.timedelta(days=1), datetime.time())
+        now = now or datetime.datetime.now()
+        return end_of_window <= now - datetime.timedelta(hours=self.settle_hours)
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], key + '.json.gz')
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with gzip.open(path, 'rb') as f:
+                response = json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+        try:
+            # mtime marks the last use for eviction
+            os.utime(path, None)
+        except OSError:
+            pass
+        return response
+
+    def set(self, key, response):
+        path = self._path(key)
+        if not os.path.isdir(os.path.dirname(path)):
+            try:
+                os.makedirs(os.path.dirname(path))
+            except OSError:
+                # created by a concurrent process
+                pass
+        try:
+            replaced_size = os.path.getsize(path)
+        except OSError:
+            replaced_size = 0
+        tmp_path = '%s.%d.tmp' % (path, os.getpid())
+        with gzip.open(tmp_path, 'wb') as f:
+            json.dump(response, f)
+        os.rename(tmp_path, path)
+
+        if self._size is None:
+            # Walks the directory, which already contains the new file
+            self.size()
+        else:
+            self._size += os.path.getsize(path) - replaced_size
+        if self._size > self.max_size:
+            self.evict()
+
+    def _files(self):
+        for root, dirs, files in os.walk(self.directory):
+            for name in files:
+                if name.endswith('.json.gz'):
+                    path = os.path.join(root, name)
+                    try:
+                        stat = os.stat(path)
+                    except OSError:
+                        continue
+                    yield stat.st_mtime, stat.st_size, path
+
+    def size(self):
+        if self._size is None:
+            self._size = sum(size for mtime, size, path in self._files())
+        return self._size
+
+    def evict(self):
+        '''
+        Removes least recently used responses until the cache is at 90% of max_size
+        '''
+        files = sorted(self._files())
+        total = sum(size for mtime, size, path in files)
+        target = self.max_size * 0.9
+        removed = 0
+        for mtime, size, path in files:
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+            removed += 1
+        self._size = total
+        log.info("Evicted %d cached responses, cache size now %d bytes", removed, total)
+
+
+class MetadataCache(object):
+    """
+    String values by key in files that expire ``ttl`` seconds after they
+    were written. Implements the get/set interface googleapiclient expects
+    from a discovery cache.
+    """
+
+    def __init__(self, directory, ttl=DEFAULT_METADATA_TTL):
+        self.directory = directory
+        self.ttl = ttl
+
+    def _path(self, key):
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        return os.path.join(self.directory, hashlib.sha256(key).hexdigest())
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            if os.path.getmtime(path) < time.time() - self.ttl:
+                return None
+            with open(path, 'rb') as f:
+                return f.read().decode('utf-8')
+        except (IOError, OSError):
+            return None
+
+    def set(self, key, value):
+        if isinstance(value, unicode):
+            value = value.encode('utf-8')
+        path = self._path(key)
+        tmp_path = '%s.%d.tmp' % (path, os.getpid())
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            with open(tmp_path, 'wb') as f:
+                f.write(value)
+            os.rename(tmp_path, path)
+        except (IOError, OSError) as e:
+            # Not being able to cache only costs a lookup on the next run
+            log.warning("Could not cache %s: %s", key, e)
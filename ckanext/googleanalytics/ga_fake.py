@@ -0,0 +1,280 @@
+"""
+Offline stand-ins for the Google Analytics service built by ga_auth.init_service.
+
+They implement just enough of the discovery based client for GACommand:
+``service.data().ga().get(...).execute()``, ``service.reports().batchGet(...)``
+of the Reporting API v4 and the management calls used by
+ga_auth.get_profile_id. Responses come either from recorded response files or
+from synthetically generated rows, so the ingest pipeline can be run and
+profiled without network access.
+"""
+import os
+import json
+import glob
+import random
+import hashlib
+import datetime
+
+from ckanext.googleanalytics import reporting_v4
+
+log = __import__('logging').getLogger(__name__)
+
+FAKE_PROFILE_ID = '0'
+
+DEFAULT_ROWS_PER_DAY = 1000
+DEFAULT_DATASETS = 500
+DEFAULT_RESOURCES_PER_DATASET = 3
+
+COUNTRIES = ['Finland', 'Sweden', 'Germany', 'United States', 'United Kingdom', 'France', 'Estonia', 'Norway',
+             'Russia', 'Netherlands', 'Japan', 'China', 'India', 'Spain', 'Italy', '(not set)']
+SEARCH_WORDS = ['population', 'map', 'weather', 'traffic', 'budget', 'election', 'school', 'health', 'energy',
+                'water', 'forest', 'income', 'tax', 'transport', 'covid', 'housing']
+LANGUAGES = ['', '/fi', '/sv', '/en_GB']
+
+
+def query_key(filters, metrics, dimensions):
+    '''
+    Returns a short stable identifier for a query, ignoring the date window.
+    '''
+    digest = hashlib.sha1(u'|'.join([filters or u'', metrics or u'', dimensions or u'']).encode('utf-8'))
+    return digest.hexdigest()[:12]
+
+
+def _split(value):
+    return [part.strip() for part in (value or '').split(',') if part.strip()]
+
+
+def _filter_rows_by_date(rows, date_column, start_date, end_date):
+    start = start_date.replace('-', '')
+    end = end_date.replace('-', '')
+    return [row for row in rows if start <= row[date_column] <= end]
+
+
+class FakeRequest(object):
+    """Mimics an apiclient HttpRequest, execute() returns a precomputed response"""
+
+    def __init__(self, response):
+        self.response = response
+
+    def execute(self, num_retries=0):
+        return self.response
+
+
+class FakeGa(object):
+    def __init__(self, source):
+        self.source = source
+
+    def get(self, **kwargs):
+        return FakeRequest(self.source.get(**kwargs))
+
+
+class FakeData(object):
+    def __init__(self, source):
+        self.source = source
+
+    def ga(self):
+        return FakeGa(self.source)
+
+
+class FakeReports(object):
+    """Answers v4 batchGet requests from the same source as the v3 calls"""
+
+    def __init__(self, source):
+        self.source = source
+
+    def _report(self, request):
+        params = reporting_v4.v3_params(request)
+        rows = self.source.get(start_index=1, max_results=None, **params).get('rows', [])
+        dimension_count = len(request.get('dimensions', []))
+        offset = int(request.get('pageToken') or 0)
+        page_size = request.get('pageSize', reporting_v4.PAGE_SIZE)
+        report = {
+            'data': {
+                'rows': [{'dimensions': row[:dimension_count], 'metrics': [{'values': row[dimension_count:]}]}
+                         for row in rows[offset:offset + page_size]],
+                'rowCount': len(rows),
+            },
+        }
+        if offset + page_size < len(rows):
+            report['nextPageToken'] = str(offset + page_size)
+        return report
+
+    def batchGet(self, body):
+        return FakeRequest({'reports': [self._report(request) for request in body['reportRequests']]})
+
+
+class FakeListResource(object):
+    def __init__(self, items):
+        self.items = items
+
+    def list(self, **kwargs):
+        return FakeRequest({'items': self.items})
+
+
+class FakeManagement(object):
+    def __init__(self, account_name, web_property_id):
+        self.account_name = account_name
+        self.web_property_id = web_property_id
+
+    def accounts(self):
+        return FakeListResource([{'id': FAKE_PROFILE_ID, 'name': self.account_name}])
+
+    def profiles(self):
+        return FakeListResource([{'id': FAKE_PROFILE_ID, 'webPropertyId': self.web_property_id}])
+
+
+class FakeService(object):
+    """
+    Service object with the same call chain as the Core Reporting API v3 client.
+    The actual responses are produced by ``source.get(**kwargs)``.
+    """
+
+    def __init__(self, source, account_name=None, web_property_id=None):
+        self.source = source
+        self.account_name = account_name
+        self.web_property_id = web_property_id
+
+    def data(self):
+        return FakeData(self.source)
+
+    def reports(self):
+        return FakeReports(self.source)
+
+    def management(self):
+        return FakeManagement(self.account_name, self.web_property_id)
+
+
+class RecordedResponses(object):
+    """
+    Serves responses previously saved by RecordingService.
+
+    Files are named ``<query key>_<start date>_<end date>.json``. A request with
+    a window that was recorded as such gets the recorded response back as is,
+    otherwise the rows of all recordings of the same query are combined and
+    filtered to the requested window.
+    """
+
+    def __init__(self, directory):
+        if not os.path.isdir(directory):
+            raise ValueError('Recorded responses directory %s does not exist' % directory)
+        self.directory = directory
+        self._rows_by_query = {}
+
+    def _path(self, key, start_date, end_date):
+        return os.path.join(self.directory, '%s_%s_%s.json' % (key, start_date, end_date))
+
+    def _all_rows(self, key):
+        if key not in self._rows_by_query:
+            rows = {}
+            for filename in sorted(glob.glob(os.path.join(self.directory, '%s_*.json' % key))):
+                with open(filename) as f:
+                    for row in json.load(f).get('rows', []):
+                        rows[tuple(row[:-1])] = row
+            self._rows_by_query[key] = sorted(rows.values(), key=lambda row: row[1])
+        return self._rows_by_query[key]
+
+    def get(self, filters=None, metrics=None, dimensions=None, start_date=None, end_date=None, **kwargs):
+        key = query_key(filters, metrics, dimensions)
+        path = self._path(key, start_date, end_date)
+        if os.path.exists(path):
+            with open(path) as f:
+                return json.load(f)
+
+        rows = _filter_rows_by_date(self._all_rows(key), 1, start_date, end_date)
+        if not rows:
+            log.warning("No recorded rows for query %s between %s and %s", key, start_date, end_date)
+            return {'totalResults': 0}
+        return {'rows': rows, 'totalResults': len(rows)}
+
+
+class SyntheticResponses(object):
+    """
+    Generates plausible rows for the queries GACommand sends.
+
+    The row layout follows the requested dimensions and metrics, and the same
+    request always produces the same rows. ``rows_per_day`` controls the
+    volume; dataset names and resource ids are generated unless real ones are
+    given in ``datasets`` as ``[(name, [resource_id, ...]), ...]``.
+    """
+
+    def __init__(self, rows_per_day=DEFAULT_ROWS_PER_DAY, datasets=None, resource_url_tag='/download/', seed=0):
+        self.rows_per_day = rows_per_day
+        self.resource_url_tag = resource_url_tag
+        self.seed = seed
+        if not datasets:
+            datasets = [('dataset-%d' % i,
+                         ['%08d-0000-0000-0000-%012d' % (i, j) for j in range(DEFAULT_RESOURCES_PER_DATASET)])
+                        for i in range(DEFAULT_DATASETS)]
+        self.datasets = datasets
+
+    def _dimension_value(self, dimension, rnd, filters):
+        if dimension == 'ga:pagePath':
+            name, resources = rnd.choice(self.datasets)
+            language = rnd.choice(LANGUAGES)
+            if resources and (self.resource_url_tag in (filters or '') and 'dataset' not in (filters or '') or
+                              rnd.random() < 0.3):
+                return '%s/dataset/%s/resource/%s%s' % (language, name, rnd.choice(resources),
+                                                        self.resource_url_tag.rstrip('/'))
+            return '%s/dataset/%s' % (language, name)
+        elif dimension == 'ga:country':
+            return rnd.choice(COUNTRIES)
+        elif dimension == 'ga:searchKeyword':
+            return ' '.join(rnd.sample(SEARCH_WORDS, rnd.randint(1, 2)))
+        elif dimension == 'ga:eventCategory':
+            return 'Resource'
+        return '(not set)'
+
+    def get(self, filters=None, metrics=None, dimensions=None, start_date=None, end_date=None,
+            start_index=1, max_results=None, **kwargs):
+        dimension_list = _split(dimensions)
+        metric_list = _split(metrics)
+        key = query_key(filters, metrics, dimensions)
+
+        day = datetime.datetime.strptime(start_date, '%Y-%m-%d').date()
+        last_day = datetime.datetime.strptime(end_date, '%Y-%m-%d').date()
+        rows = []
+        while day <= last_day:
+            date_value = day.strftime('%Y%m%d')
+            rnd = random.Random('%s-%s-%s' % (self.seed, key, date_value))
+            for i in range(self.rows_per_day):
+                row = []
+                for dimension in dimension_list:
+                    if dimension == 'ga:date':
+                        row.append(date_value)
+                    else:
+                        row.append(self._dimension_value(dimension, rnd, filters))
+                for metric in metric_list:
+                    row.append(str(rnd.randint(0, 50)))
+                rows.append(row)
+            day += datetime.timedelta(days=1)
+
+        if max_results:
+            rows = rows[start_index - 1:start_index - 1 + max_results]
+        return {'rows': rows, 'totalResults': len(rows)}
+
+
+class RecordingService(object):
+    """
+    Wraps a live service and saves every ``data().ga().get()`` response in a
+    format RecordedResponses can serve later.
+    """
+
+    def __init__(self, service, directory):
+        self.service = service
+        self.directory = directory
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def data(self):
+        return FakeData(self)
+
+    def management(self):
+        return self.service.management()
+
+    def get(self, **kwargs):
+        response = self.service.data().ga().get(**kwargs).execute()
+        key = query_key(kwargs.get('filters'), kwargs.get('metrics'), kwargs.get('dimensions'))
+        path = os.path.join(self.directory, '%s_%s_%s.json' % (key, kwargs.get('start_date'), kwargs.get('end_date')))
+        with open(path, 'w') as f:
+            json.dump(response, f)
+        return response
@@ -0,0 +1,46 @@
+"""
+Template helpers showing stats on dataset pages.
+
+Results are kept in a process level LRU cache for at most
+``googleanalytics.helper_cache.ttl`` seconds, and keyed by the time of the
+last ingest so that newly loaded stats show up as soon as the ingest
+finishes.
+"""
+from ckanext.googleanalytics.cache import LRUCache
+from ckanext.googleanalytics.model import PackageStats, get_last_ingest
+
+DEFAULT_CACHE_SIZE = 1000
+DEFAULT_CACHE_TTL = 300
+
+# How long the last ingest time is trusted before it is read from the database again
+GENERATION_TTL = 30
+
+_visits_cache = LRUCache(DEFAULT_CACHE_SIZE, ttl=DEFAULT_CACHE_TTL)
+_generation_cache = LRUCache(1, ttl=GENERATION_TTL)
+
+
+def configure(config):
+    global _visits_cache
+    _visits_cache = LRUCache(int(config.get('googleanalytics.helper_cache.size', DEFAULT_CACHE_SIZE)),
+                             ttl=int(config.get('googleanalytics.helper_cache.ttl', DEFAULT_CACHE_TTL)))
+
+
+def ingest_generation():
+    generation = _generation_cache.get('last_ingest')
+    if generation is None:
+        generation = get_last_ingest() or 0
+        _generation_cache.set('last_ingest', generation)
+    return generation
+
+
+def googleanalytics_dataset_visits(package_id):
+    '''
+    Total visits and downloads of a dataset and its daily visits of the
+    last 30 days, like the googleanalytics_dataset_visits action
+    '''
+    key = (package_id, ingest_generation())
+    visits = _visits_cache.get(key)
+    if visits is None:
+        visits = PackageStats.get_all_visits(package_id)
+        _visits_cache.set(key, visits)
+    return visits
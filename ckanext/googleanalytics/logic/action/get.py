@@ -1,6 +1,10 @@
+from sqlalchemy import or_
+
 from ckanext.googleanalytics.model import PackageStats
 from ckan.plugins import toolkit
-from ckan.model import Package
+from ckan.model import Package, Session
+
+MAX_DATASETS_VISITS = 1000
 
 
 @toolkit.side_effect_free
@@ -16,3 +20,62 @@ def googleanalytics_dataset_visits(context=None, data_dict=None):
     """
     package = Package.get(data_dict['id'])
     return PackageStats.get_all_visits(package.id)
+
+
+@toolkit.side_effect_free
+def googleanalytics_datasets_visits(context=None, data_dict=None):
+    """
+    Fetch the visit and download totals of several datasets at once, e.g.
+    for the datasets of a search result page
+
+    :param ids: Dataset ids or names, as a list or comma separated
+    :type ids: list of strings
+    :param sparklines: Also return the daily visits and downloads of the
+        last 30 days like googleanalytics_dataset_visits (optional, default False)
+    :type sparklines: boolean
+
+    :returns: {"count": .., "download_count": .., ["visits": [..]]} by the given id or name,
+        datasets that are not found are left out
+    :rtype: dictionary
+    """
+    ids = data_dict.get('ids')
+    if isinstance(ids, basestring):
+        ids = [value.strip() for value in ids.split(',') if value.strip()]
+    if not ids:
+        raise toolkit.ValidationError({'ids': ['Missing value']})
+    if len(ids) > MAX_DATASETS_VISITS:
+        raise toolkit.ValidationError({'ids': ['At most %d datasets at a time' % MAX_DATASETS_VISITS]})
+    sparklines = toolkit.asbool(data_dict.get('sparklines', False))
+
+    packages = (Session.query(Package.id, Package.name)
+                .filter(or_(Package.id.in_(ids), Package.name.in_(ids)))
+                .all())
+    package_ids = {}
+    for package_id, name in packages:
+        package_ids[package_id] = package_id
+        package_ids[name] = package_id
+
+    visits = PackageStats.get_all_visits_for_packages(list(set(package_ids.values())),
+                                                      num_days=30 if sparklines else None)
+    return dict((key, visits[package_ids[key]]) for key in ids if key in package_ids)
+
+
+@toolkit.side_effect_free
+def googleanalytics_tracking_stats(context=None, data_dict=None):
+    """
+    Latency percentiles of the API and download tracking, by logic function.
+    Only available to sysadmins and when googleanalytics.tracking_metrics is enabled.
+
+    :returns: overhead added to requests and queue wait before sending, in milliseconds
+    :rtype: dictionary
+    """
+    toolkit.check_access('googleanalytics_tracking_stats', context, data_dict)
+
+    from ckanext.googleanalytics.plugin import GoogleAnalyticsPlugin
+    tracking_metrics = GoogleAnalyticsPlugin.tracking_metrics
+    if tracking_metrics is None:
+        raise toolkit.ObjectNotFound('Tracking metrics are not enabled')
+
+    result = tracking_metrics.summary()
+    result['queue_size'] = GoogleAnalyticsPlugin.analytics_queue.qsize()
+    return result
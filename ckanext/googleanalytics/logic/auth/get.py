@@ -0,0 +1,8 @@
+def googleanalytics_tracking_stats(context, data_dict):
+    # Only sysadmins, who skip auth functions altogether
+    return {'success': False}
+
+
+def googleanalytics_export(context, data_dict):
+    # Only sysadmins, who skip auth functions altogether
+    return {'success': False}
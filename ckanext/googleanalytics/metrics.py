@@ -0,0 +1,279 @@
+"""
+Instrumentation for the loadanalytics ingest and the request tracking.
+
+IngestMetrics records, per query type and date window, how long fetching
+from Google and resolving the rows took and how many rows were received,
+and per query type how long saving and committing took, how many SQL
+statements were issued and the highest resident memory sampled at the end
+of its windows and of saving. The result can be written as JSON and in
+the Prometheus textfile collector format.
+
+TrackingMetrics records the overhead the API and download tracking adds to
+each request and how long the hits wait in the queue before being sent.
+"""
+import os
+import json
+import math
+import time
+import datetime
+import threading
+from collections import deque
+from contextlib import contextmanager
+
+from sqlalchemy import event
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+log = __import__('logging').getLogger(__name__)
+
+PROMETHEUS_PREFIX = 'ckanext_googleanalytics_ingest'
+
+# (field, metric name, help) of the per query type values exported to Prometheus
+PROMETHEUS_QUERY_METRICS = [
+    ('fetch_seconds', 'fetch_seconds', 'Time spent waiting for the Google Analytics API'),
+    ('rows', 'rows', 'Rows received from the Google Analytics API'),
+    ('rate_limit_retries', 'rate_limit_retries', 'Requests retried after a rate limit error'),
+    ('malformed_rows', 'malformed_rows', 'Rows skipped because their page path was not recognized'),
+    ('resolve_seconds', 'resolve_seconds', 'Time spent resolving received rows'),
+    ('save_seconds', 'save_seconds', 'Time spent in the save function, including lookups and flushes'),
+    ('db_statements', 'db_statements', 'SQL statements issued while saving and committing'),
+    ('commit_seconds', 'commit_seconds', 'Time spent committing the saved rows'),
+    ('peak_memory_bytes', 'peak_memory_bytes',
+     'Highest resident memory sampled at the end of each window and of saving the query type'),
+]
+
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+
+
+def resident_memory_bytes():
+    '''
+    Current resident memory of the process, None where /proc is not available
+    '''
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * PAGE_SIZE
+    except (IOError, IndexError, ValueError):
+        return None
+
+
+def process_peak_memory_bytes():
+    '''
+    Peak resident memory over the whole lifetime of the process
+    '''
+    if resource is None:
+        return None
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+@contextmanager
+def timed(record, key):
+    '''
+    Adds the time spent inside the block to ``record[key]``
+    '''
+    started = time.time()
+    try:
+        yield
+    finally:
+        record[key] = record.get(key, 0.0) + time.time() - started
+
+
+class IngestMetrics(object):
+    def __init__(self, engine=None):
+        self.engine = engine
+        self.statements = 0
+        self.queries = []
+        self.started = None
+        self.finished = None
+        self.succeeded = False
+
+    def _count_statement(self, *args, **kwargs):
+        self.statements += 1
+
+    @contextmanager
+    def run(self):
+        '''
+        Wraps a whole ingest, counting statements issued on the engine
+        '''
+        self.started = time.time()
+        if self.engine is not None:
+            event.listen(self.engine, 'before_cursor_execute', self._count_statement)
+        try:
+            yield self
+            self.succeeded = True
+        finally:
+            if self.engine is not None:
+                event.remove(self.engine, 'before_cursor_execute', self._count_statement)
+            self.finished = time.time()
+
+    def query(self, query_type):
+        record = {'type': query_type, 'windows': [], 'fetch_seconds': 0.0, 'rows': 0, 'resolve_seconds': 0.0,
+                  'save_seconds': 0.0, 'commit_seconds': 0.0, 'db_statements': 0, 'peak_memory_bytes': None}
+        self.queries.append(record)
+        return record
+
+    @staticmethod
+    def window(query_record, start_date, end_date):
+        record = {'start_date': start_date.isoformat(), 'end_date': end_date.isoformat(),
+                  'fetch_seconds': 0.0, 'rows': 0, 'resolve_seconds': 0.0}
+        query_record['windows'].append(record)
+        return record
+
+    @staticmethod
+    def sample_memory(record):
+        '''
+        Raises ``record['peak_memory_bytes']`` to the current resident memory
+        '''
+        memory = resident_memory_bytes()
+        if memory is not None and memory > (record.get('peak_memory_bytes') or 0):
+            record['peak_memory_bytes'] = memory
+        return memory
+
+    @classmethod
+    def add_window_totals(cls, query_record, window_record):
+        for key in ('fetch_seconds', 'rows', 'resolve_seconds'):
+            query_record[key] += window_record[key]
+        window_record['memory_bytes'] = cls.sample_memory(query_record)
+
+    @contextmanager
+    def count_statements(self, record):
+        before = self.statements
+        try:
+            yield
+        finally:
+            record['db_statements'] += self.statements - before
+
+    def finish_query(self, record):
+        self.sample_memory(record)
+        log.info("Analytics query %(type)s: %(rows)d rows, fetch %(fetch_seconds).2fs, "
+                 "resolve %(resolve_seconds).2fs, save %(save_seconds).2fs, commit %(commit_seconds).2fs, "
+                 "%(db_statements)d statements" % record)
+
+    def as_dict(self):
+        return {
+            'started': datetime.datetime.utcfromtimestamp(self.started).isoformat() if self.started else None,
+            'finished': datetime.datetime.utcfromtimestamp(self.finished).isoformat() if self.finished else None,
+            'duration_seconds': (self.finished - self.started) if self.started and self.finished else None,
+            'succeeded': self.succeeded,
+            'db_statements': self.statements,
+            'process_peak_memory_bytes': process_peak_memory_bytes(),
+            'queries': self.queries,
+        }
+
+    def as_prometheus(self):
+        lines = []
+
+        def metric(name, help_text, values):
+            full_name = '%s_%s' % (PROMETHEUS_PREFIX, name)
+            lines.append('# HELP %s %s' % (full_name, help_text))
+            lines.append('# TYPE %s gauge' % full_name)
+            for labels, value in values:
+                if value is None:
+                    continue
+                label_text = ','.join('%s="%s"' % item for item in labels)
+                lines.append('%s%s %s' % (full_name, '{%s}' % label_text if label_text else '', str(value)))
+
+        for field, name, help_text in PROMETHEUS_QUERY_METRICS:
+            metric(name, help_text, [((('type', q['type']),), q.get(field)) for q in self.queries])
+
+        data = self.as_dict()
+        metric('duration_seconds', 'Duration of the whole ingest', [((), data['duration_seconds'])])
+        metric('success', 'Whether the ingest finished without errors', [((), 1 if self.succeeded else 0)])
+        metric('last_run_timestamp_seconds', 'Time when the ingest finished', [((), self.finished)])
+        return '\n'.join(lines) + '\n'
+
+    @staticmethod
+    def _write_atomic(path, content):
+        # The textfile collector may read at any time, so never expose a partial file
+        tmp_path = '%s.%d.tmp' % (path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            f.write(content)
+        os.rename(tmp_path, path)
+
+    def write_json(self, path):
+        self._write_atomic(path, json.dumps(self.as_dict(), indent=2, sort_keys=True))
+        log.info("Wrote ingest metrics to %s", path)
+
+    def write_prometheus(self, path):
+        self._write_atomic(path, self.as_prometheus())
+        log.info("Wrote ingest metrics to %s", path)
+
+
+def percentile(sorted_values, percent):
+    '''
+    Nearest-rank percentile of an already sorted list
+    '''
+    if not sorted_values:
+        return None
+    index = int(math.ceil(percent / 100.0 * len(sorted_values))) - 1
+    return sorted_values[max(0, min(index, len(sorted_values) - 1))]
+
+
+class LatencyHistogram(object):
+    """Keeps the latest samples and the total count of one measured value"""
+
+    def __init__(self, max_samples):
+        self.samples = deque(maxlen=max_samples)
+        self.count = 0
+
+    def add(self, seconds):
+        self.samples.append(seconds)
+        self.count += 1
+
+    def summary(self):
+        values = sorted(self.samples)
+        result = {'count': self.count}
+        for name, percent in (('p50', 50), ('p90', 90), ('p99', 99), ('max', 100)):
+            value = percentile(values, percent)
+            result[name + '_ms'] = round(value * 1000, 3) if value is not None else None
+        return result
+
+
+class TrackingMetrics(object):
+    """
+    Latency of the request tracking, by logic function.
+
+    ``overhead`` is the time _post_analytics adds to a request and
+    ``queue_wait`` the time a hit waits in the queue before a sender thread
+    picks it up. Percentiles are computed over the latest ``max_samples``
+    samples of each logic function. If ``log_interval`` is set, a summary is
+    logged at most once per that many seconds.
+    """
+
+    def __init__(self, max_samples=1000, log_interval=0):
+        self.max_samples = max_samples
+        self.log_interval = log_interval
+        self.overhead = {}
+        self.queue_wait = {}
+        self.lock = threading.Lock()
+        self.last_logged = time.time()
+
+    def _add(self, histograms, key, seconds):
+        with self.lock:
+            histogram = histograms.get(key)
+            if histogram is None:
+                histogram = histograms[key] = LatencyHistogram(self.max_samples)
+            histogram.add(seconds)
+        self._maybe_log()
+
+    def record_overhead(self, key, seconds):
+        self._add(self.overhead, key, seconds)
+
+    def record_queue_wait(self, key, seconds):
+        self._add(self.queue_wait, key, seconds)
+
+    def summary(self):
+        with self.lock:
+            return {
+                'overhead': dict((key, h.summary()) for key, h in self.overhead.iteritems()),
+                'queue_wait': dict((key, h.summary()) for key, h in self.queue_wait.iteritems()),
+            }
+
+    def _maybe_log(self):
+        if not self.log_interval or time.time() - self.last_logged < self.log_interval:
+            return
+        self.last_logged = time.time()
+        log.info("Google Analytics tracking latency: %s", json.dumps(self.summary(), sort_keys=True))
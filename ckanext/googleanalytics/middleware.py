@@ -0,0 +1,160 @@
+"""
+HTTP caching of the analytics API actions and report pages.
+
+The actions only change when new stats are loaded, so they get an ETag
+and a Last-Modified derived from the time of the last successful ingest.
+Report pages also change when ckanext-report regenerates them, so the
+time they were last generated is part of their validators. Conditional
+requests are answered with 304 Not Modified without calling CKAN.
+Anonymous responses are also marked cacheable for
+``googleanalytics.cache_control.max_age`` seconds. Pages show who is
+logged in, so the ETag of a logged in user's response is tied to the
+user's credentials and only an If-None-Match of that user validates.
+"""
+import re
+import time
+import hashlib
+from email.utils import formatdate, parsedate_tz, mktime_tz
+
+log = __import__('logging').getLogger(__name__)
+
+DEFAULT_MAX_AGE = 600
+
+# How long the last ingest time is trusted before it is read from the database again
+LAST_INGEST_TTL = 30
+
+CACHED_PATHS = re.compile(
+    r'^(/[a-z]{2}(_[A-Z]{2})?)?'
+    r'(/api(/\d+)?/action/googleanalytics_(dataset_visits|datasets_visits)'
+    r'|/report/(?P<report>google-analytics-[a-z-]+))/?$')
+
+AUTH_TKT_COOKIE = re.compile(r'(?:^|;)\s*auth_tkt="?([^";]*)')
+
+# Headers of the response replaced by the middleware
+REPLACED_HEADERS = ('cache-control', 'pragma', 'expires', 'etag', 'last-modified')
+
+
+def read_last_ingest():
+    '''
+    Reads the time of the last ingest before CKAN handles the request
+    '''
+    import ckan.model as model
+    from ckanext.googleanalytics.model import get_last_ingest
+    try:
+        return get_last_ingest()
+    finally:
+        # Leave no session behind for the request that follows
+        model.Session.remove()
+
+
+def read_report_generated(report_name):
+    import ckan.model as model
+    from ckanext.googleanalytics.model import get_report_generated
+    try:
+        return get_report_generated(report_name)
+    finally:
+        model.Session.remove()
+
+
+def credentials(environ):
+    '''
+    The API key or login cookie sent with the request, None for anonymous requests
+    '''
+    api_key = environ.get('HTTP_AUTHORIZATION') or environ.get('HTTP_X_CKAN_API_KEY')
+    if api_key:
+        return api_key
+    match = AUTH_TKT_COOKIE.search(environ.get('HTTP_COOKIE', ''))
+    if match:
+        return match.group(1)
+    return None
+
+
+def is_anonymous(environ):
+    return credentials(environ) is None
+
+
+class AnalyticsCacheMiddleware(object):
+    def __init__(self, app, max_age=DEFAULT_MAX_AGE, last_ingest=None, report_generated=None):
+        '''
+        :param last_ingest: function returning the time of the last ingest as
+            a unix timestamp, or None if nothing has been loaded yet
+        :param report_generated: function returning the time a report was
+            last generated as a unix timestamp, or None
+        '''
+        self.app = app
+        self.max_age = max_age
+        self._read_last_ingest = last_ingest or read_last_ingest
+        self._read_report_generated = report_generated or read_report_generated
+        self._last_ingest = None
+        self._last_ingest_read = 0
+
+    def last_ingest(self):
+        now = time.time()
+        if now - self._last_ingest_read > LAST_INGEST_TTL:
+            try:
+                self._last_ingest = self._read_last_ingest()
+            except Exception:
+                log.exception("Could not read the time of the last ingest")
+                self._last_ingest = None
+            self._last_ingest_read = now
+        return self._last_ingest
+
+    def _not_modified(self, environ, etag, last_modified):
+        '''
+        :param last_modified: None if If-Modified-Since must not be used
+        '''
+        if_none_match = environ.get('HTTP_IF_NONE_MATCH')
+        if if_none_match:
+            return if_none_match.strip() == '*' or etag in [tag.strip() for tag in if_none_match.split(',')]
+        if_modified_since = environ.get('HTTP_IF_MODIFIED_SINCE')
+        if if_modified_since and last_modified is not None:
+            parsed = parsedate_tz(if_modified_since)
+            return parsed is not None and mktime_tz(parsed) >= last_modified
+        return False
+
+    def __call__(self, environ, start_response):
+        match = CACHED_PATHS.match(environ.get('PATH_INFO', ''))
+        if environ.get('REQUEST_METHOD') not in ('GET', 'HEAD') or not match:
+            return self.app(environ, start_response)
+
+        last_ingest = self.last_ingest()
+        if last_ingest is None:
+            return self.app(environ, start_response)
+        version = '%d' % last_ingest
+        last_modified = last_ingest
+
+        if match.group('report'):
+            # Not read through a cache: a refreshed report must not validate even for a moment
+            try:
+                generated = self._read_report_generated(match.group('report'))
+            except Exception:
+                log.exception("Could not read when the report was generated")
+                generated = None
+            if generated is None:
+                return self.app(environ, start_response)
+            version += '-%d' % generated
+            last_modified = max(last_modified, generated)
+
+        user = credentials(environ)
+        anonymous = user is None
+        # Pages show who is logged in, so a copy cached by one user must not validate for anyone else
+        etag = '"ga-%s-%s"' % (version, 'anon' if anonymous else hashlib.sha1(user).hexdigest()[:16])
+        headers = [('ETag', etag), ('Last-Modified', formatdate(last_modified, usegmt=True))]
+        if anonymous:
+            headers.append(('Cache-Control', 'public, max-age=%d' % self.max_age))
+        else:
+            headers.append(('Cache-Control', 'private, max-age=0, must-revalidate'))
+
+        # If-Modified-Since says nothing about whose copy it is, so logged in users need a matching ETag
+        if_modified_since = last_modified if anonymous else None
+        if self._not_modified(environ, etag, if_modified_since):
+            start_response('304 Not Modified', headers)
+            return []
+
+        def _start_response(status, response_headers, exc_info=None):
+            if status.startswith('200'):
+                response_headers = [header for header in response_headers
+                                    if header[0].lower() not in REPLACED_HEADERS] + headers
+            return start_response(status, response_headers, exc_info)
+
+        return self.app(environ, _start_response)
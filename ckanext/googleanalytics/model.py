@@ -1,6 +1,7 @@
+import time
 from datetime import date, datetime, timedelta
 
-from sqlalchemy import types, func, Column, ForeignKey, not_, desc
+from sqlalchemy import types, func, Column, ForeignKey, not_, desc, case, or_, and_, tuple_, select, text, exists
 from sqlalchemy.orm import relationship
 from sqlalchemy.ext.declarative import declarative_base
 
@@ -168,6 +169,121 @@ class PackageStats(Base):
 
         return datasets
 
+    @classmethod
+    def _total_visits_subquery(cls, start_date, end_date):
+        return (model.Session.query(
+            cls.package_id.label('package_id'),
+            model.Package.title.label('package_title'),
+            model.Package.name.label('package_name'),
+            func.sum(cls.visits).label('visits'),
+            func.sum(cls.entrances).label('entrances'),
+            func.sum(cls.downloads).label('downloads'))
+            .join(model.Package, cls.package_id == model.Package.id)
+            .filter(model.Package.state == 'active')
+            .filter(model.Package.private == False)  # noqa: E712
+            .filter(cls.visit_date >= start_date)
+            .filter(cls.visit_date <= end_date)
+            .group_by(cls.package_id, model.Package.title, model.Package.name)
+            .subquery())
+
+    @classmethod
+    def get_total_visits_page(cls, start_date, end_date, descending=True, page_size=20, after=None):
+        '''
+        One page of get_total_visits, ordered by (visits, package_id) and
+        starting after the (visits, package_id) of the last row of the
+        previous page instead of an offset.
+
+        :return: ([{ visits, entrances, downloads, package_id, package_name }, ...], key of the next page or None)
+        '''
+        totals = cls._total_visits_subquery(start_date, end_date)
+        visits = func.coalesce(totals.c.visits, 0)
+        key = tuple_(visits, totals.c.package_id)
+        query = model.Session.query(totals.c.package_id, totals.c.package_title, totals.c.package_name, visits,
+                                    totals.c.entrances, totals.c.downloads)
+        if after is not None:
+            query = query.filter(key < tuple_(*after) if descending else key > tuple_(*after))
+        if descending:
+            query = query.order_by(desc(visits), desc(totals.c.package_id))
+        else:
+            query = query.order_by(visits, totals.c.package_id)
+        # One extra row tells whether there is a next page
+        rows = query.limit(page_size + 1).all()
+
+        datasets = []
+        for package_id, package_title, package_name, package_visits, entrances, downloads in rows[:page_size]:
+            datasets.append({
+                "package_name": package_title or package_name,
+                "package_id": package_id,
+                "visits": package_visits,
+                "entrances": entrances or 0,
+                "downloads": downloads or 0,
+            })
+        next_key = None
+        if len(rows) > page_size:
+            next_key = (datasets[-1]["visits"], datasets[-1]["package_id"])
+        return datasets, next_key
+
+    @classmethod
+    def count_total_visits(cls, start_date, end_date):
+        '''
+        Number of datasets get_total_visits returns for the time span
+        '''
+        return (model.Session.query(func.count(func.distinct(cls.package_id)))
+                .join(model.Package, cls.package_id == model.Package.id)
+                .filter(model.Package.state == 'active')
+                .filter(model.Package.private == False)  # noqa: E712
+                .filter(cls.visit_date >= start_date)
+                .filter(cls.visit_date <= end_date)
+                .scalar())
+
+    @classmethod
+    def get_total_visits_by_periods(cls, periods):
+        '''
+        Like get_total_visits for several time spans at once, with one query
+        summing the rows of each span with conditional aggregates.
+
+        :param periods: {period: (start_date, end_date)}
+        :return: {period: [{ visits, entrances, downloads, package_id, package_name, organization_name }, ...]}
+            with the datasets of each period ordered by visits, most visited first
+        '''
+        periods = periods.items()
+        columns = [cls.package_id, model.Package.title, model.Package.name, model.Group.name]
+        for period, (start_date, end_date) in periods:
+            in_period = and_(cls.visit_date >= start_date, cls.visit_date <= end_date)
+            columns.extend([func.sum(case([(in_period, 1)], else_=0)),
+                            func.sum(case([(in_period, cls.visits)], else_=0)),
+                            func.sum(case([(in_period, cls.entrances)], else_=0)),
+                            func.sum(case([(in_period, cls.downloads)], else_=0))])
+
+        rows = (model.Session.query(*columns)
+                .join(model.Package, cls.package_id == model.Package.id)
+                .outerjoin(model.Group, model.Package.owner_org == model.Group.id)
+                .filter(model.Package.state == 'active')
+                .filter(model.Package.private == False)  # noqa: E712
+                .filter(cls.visit_date >= min(start_date for period, (start_date, end_date) in periods))
+                .filter(cls.visit_date <= max(end_date for period, (start_date, end_date) in periods))
+                .group_by(cls.package_id, model.Package.title, model.Package.name, model.Group.name)
+                .all())
+
+        results = dict((period, []) for period, dates in periods)
+        for row in rows:
+            for i, (period, dates) in enumerate(periods):
+                row_count, visits, entrances, downloads = row[4 + 4 * i:8 + 4 * i]
+                # Datasets without any stats in the period are left out like in get_total_visits
+                if not row_count:
+                    continue
+                results[period].append({
+                    "package_name": row[1] or row[2],
+                    "package_id": row[0],
+                    "organization_name": row[3],
+                    "visits": visits or 0,
+                    "entrances": entrances or 0,
+                    "downloads": downloads or 0,
+                })
+        for datasets in results.itervalues():
+            datasets.sort(key=lambda dataset: (dataset["visits"], dataset["package_id"]), reverse=True)
+        return results
+
     @classmethod
     def get_visits_during_year(cls, resource_id, year):
         '''
@@ -195,12 +311,16 @@ class PackageStats(Base):
             cls.visit_date >= start_date).all()
         # Returns the total number of visits since the beginning of all times
         total_visits = model.Session.query(func.sum(cls.visits)).filter(cls.package_id == package_id).scalar()
+        total_downloads = model.Session.query(func.sum(cls.downloads)).filter(cls.package_id == package_id).scalar()
+        monthly = PackageStatsMonthly.get_totals([package_id]).get(package_id)
+        if monthly is not None:
+            total_visits = (total_visits or 0) + monthly[0]
+            total_downloads = (total_downloads or 0) + monthly[1]
         visits = {}
 
         if total_visits is not None:
             visits = PackageStats.convert_to_dict(package_visits, total_visits)
 
-        total_downloads = model.Session.query(func.sum(cls.downloads)).filter(cls.package_id == package_id).scalar()
         visits['total_downloads'] = total_downloads if total_downloads else 0
 
         return visits
@@ -236,40 +356,125 @@ class PackageStats(Base):
         return dictat
 
     @classmethod
-    def get_all_visits(cls, dataset_id):
-
-        visits_dict = PackageStats.get_last_visits_by_id(dataset_id)
+    def get_all_visits(cls, dataset_id, num_days=30):
+        '''
+        Total visits and downloads of a dataset and its daily visits and
+        downloads of the last num_days days, with one query grouping the
+        older rows into a single bucket
+        '''
+        start_date = datetime.now() - timedelta(num_days)
+        day = case([(cls.visit_date >= start_date, cls.visit_date)])
+        rows = (model.Session.query(day, func.sum(cls.visits), func.sum(cls.downloads))
+                .filter(cls.package_id == dataset_id)
+                .group_by(day)
+                .all())
+
+        daily = {}
+        count = 0
+        download_count = 0
+        for visit_date, visits, downloads in rows:
+            count += visits or 0
+            download_count += downloads or 0
+            if visit_date is not None:
+                daily[visit_date.date()] = (visits or 0, downloads or 0)
+        monthly_visits, monthly_downloads = PackageStatsMonthly.get_totals([dataset_id]).get(dataset_id, (0, 0))
+        count += monthly_visits
+        download_count += monthly_downloads
 
         visit_list = []
-        visits = visits_dict.get('packages', [])
-        count = visits_dict.get('tot_visits', 0)
-
         now = datetime.now() - timedelta(days=1)
 
         # Creates a date object for the last 30 days in the format (YEAR, MONTH, DAY)
-        for d in range(0, 30):
-            curr = now - timedelta(d)
-            visit_list.append({'year': curr.year, 'month': curr.month, 'day': curr.day, 'visits': 0, "downloads": 0})
-
-        for t in visits:
-            visit_date_str = t['visit_date']
-            if visit_date_str is not None:
-                visit_date = datetime.strptime(visit_date_str, "%d-%m-%Y")
-                # Build temporary match
-                visit_item = next((x for x in visit_list if
-                                   x['year'] == visit_date.year and x['month'] == visit_date.month and x[
-                                       'day'] == visit_date.day), None)
-                if visit_item:
-                    visit_item['visits'] = t['visits']
-                    visit_item['downloads'] = t['downloads']
+        for d in range(0, num_days):
+            curr = (now - timedelta(d)).date()
+            visits, downloads = daily.get(curr, (0, 0))
+            visit_list.append({'year': curr.year, 'month': curr.month, 'day': curr.day, 'visits': visits,
+                               "downloads": downloads})
 
         results = {
             "visits": visit_list,
             "count": count,
-            "download_count": visits_dict['total_downloads']
+            "download_count": download_count
         }
         return results
 
+    @classmethod
+    def get_all_visits_for_packages(cls, package_ids, num_days=None):
+        '''
+        Totals of several packages like get_all_visits, with one grouped query
+        for the totals and one for the daily visits instead of several
+        queries per package.
+
+        :param package_ids: list of package ids
+        :param num_days: also return the daily visits and downloads of the last num_days days
+        :return: {package_id: {"count": .., "download_count": .., "visits": [..]}}
+        '''
+        results = dict((package_id, {"count": 0, "download_count": 0}) for package_id in package_ids)
+        if not package_ids:
+            return results
+
+        totals = (model.Session.query(cls.package_id,
+                                      func.sum(cls.visits).label('total_visits'),
+                                      func.sum(cls.downloads).label('total_downloads'))
+                  .filter(cls.package_id.in_(package_ids))
+                  .group_by(cls.package_id)
+                  .all())
+        for row in totals:
+            results[row.package_id]["count"] = row.total_visits or 0
+            results[row.package_id]["download_count"] = row.total_downloads or 0
+        for package_id, (visits, downloads) in PackageStatsMonthly.get_totals(package_ids).iteritems():
+            results[package_id]["count"] += visits
+            results[package_id]["download_count"] += downloads
+
+        if num_days:
+            now = datetime.now() - timedelta(days=1)
+            days = [(now - timedelta(d)).date() for d in range(0, num_days)]
+            daily = {}
+            rows = (model.Session.query(cls.package_id, cls.visit_date, cls.visits, cls.downloads)
+                    .filter(cls.package_id.in_(package_ids))
+                    .filter(cls.visit_date >= datetime.now() - timedelta(num_days))
+                    .all())
+            for row in rows:
+                daily[(row.package_id, row.visit_date.date())] = row
+            for package_id, result in results.iteritems():
+                visit_list = []
+                for day in days:
+                    row = daily.get((package_id, day))
+                    visit_list.append({'year': day.year, 'month': day.month, 'day': day.day,
+                                       'visits': row.visits if row else 0,
+                                       'downloads': row.downloads if row else 0})
+                result["visits"] = visit_list
+
+        return results
+
+    @classmethod
+    def get_popularity(cls, package_id, recent_days):
+        '''
+        All time visits and downloads and the visits of the last recent_days days, with one query
+        '''
+        recent_start = _days_ago(recent_days)
+        row = (model.Session.query(func.sum(cls.visits),
+                                   func.sum(case([(cls.visit_date >= recent_start, cls.visits)], else_=0)),
+                                   func.sum(cls.downloads))
+               .filter(cls.package_id == package_id)
+               .one())
+        monthly_visits, monthly_downloads = PackageStatsMonthly.get_totals([package_id]).get(package_id, (0, 0))
+        return {'views_total': (row[0] or 0) + monthly_visits, 'views_recent': row[1] or 0,
+                'downloads_total': (row[2] or 0) + monthly_downloads}
+
+    @classmethod
+    def get_changed_package_ids(cls, since, recent_days, previous_ingest=None):
+        '''
+        Packages whose get_popularity may have changed: those with stats
+        loaded from since on, and those with visits that have dropped out of
+        the recent days since the previous ingest (a unix timestamp)
+        '''
+        changed = cls.visit_date >= since
+        if previous_ingest is not None:
+            dropped_from = datetime.fromtimestamp(previous_ingest) - timedelta(days=recent_days + 1)
+            changed = or_(changed, and_(cls.visit_date >= dropped_from, cls.visit_date < _days_ago(recent_days)))
+        return [row[0] for row in model.Session.query(cls.package_id).filter(changed).distinct()]
+
     @classmethod
     def as_dict(cls, pkg):
         result = {}
@@ -408,6 +613,7 @@ class ResourceStats(Base):
             cls.visit_date >= start_date).all()
         # Returns the total number of visits since the beggining of all times
         total_visits = model.Session.query(func.sum(cls.visits)).filter(cls.resource_id == resource_id).scalar()
+        total_visits = ResourceStatsMonthly.add_totals(total_visits, [resource_id])
         visits = {}
         if total_visits is not None:
             visits = ResourceStats.convert_to_dict(resource_visits, total_visits)
@@ -415,27 +621,38 @@ class ResourceStats(Base):
 
     @classmethod
     def get_top(cls, limit=20):
-        resource_stats = []
-        # TODO: Reimplement in more efficient manner if needed (using RANK OVER and PARTITION in raw sql)
-        unique_resources = model.Session.query(cls.resource_id, func.count(cls.visits)).group_by(cls.resource_id).order_by(
-            func.count(cls.visits).desc()).limit(limit).all()
-        # Adding last date associated to this package stat and filtering out private and deleted packages
-        if unique_resources is not None:
-            for resource in unique_resources:
-                resource_id = resource[0]
-                visits = resource[1]
-                # TODO: Check if associated resource is private
-                resource = model.Session.query(model.Resource).filter(model.Resource.id == resource_id).filter_by(
-                    state='active').first()
-                if resource is None:
-                    continue
-
-                last_date = model.Session.query(func.max(cls.visit_date)).filter(cls.resource_id == resource_id).first()
-
-                rs = ResourceStats(resource_id=resource_id, visit_date=last_date[0], visits=visits)
-                resource_stats.append(rs)
-        dictat = ResourceStats.convert_to_dict(resource_stats, None)
-        return dictat
+        '''
+        Active resources with the most days with downloads, with the last
+        download date and the resource and dataset names, in one query
+        '''
+        # TODO: Check if associated resource is private
+        rows = (model.Session.query(cls.resource_id,
+                                    func.count(cls.visits),
+                                    func.max(cls.visit_date),
+                                    model.Resource.description,
+                                    model.Resource.format,
+                                    model.Package.title,
+                                    model.Package.name)
+                .join(model.Resource, model.Resource.id == cls.resource_id)
+                .join(model.Package, model.Package.id == model.Resource.package_id)
+                .filter(model.Resource.state == 'active')
+                .group_by(cls.resource_id, model.Resource.description, model.Resource.format,
+                          model.Package.title, model.Package.name)
+                .order_by(func.count(cls.visits).desc())
+                .limit(limit)
+                .all())
+
+        resources = []
+        for resource_id, visits, last_date, description, resource_format, package_title, package_name in rows:
+            resources.append({
+                'resource_name': description or resource_format,
+                'resource_id': resource_id,
+                'package_name': package_title or package_name,
+                'package_id': package_name,
+                'visits': visits,
+                'visit_date': last_date.strftime("%d-%m-%Y"),
+            })
+        return {"resources": resources}
 
     @classmethod
     def as_dict(cls, res):
@@ -468,7 +685,8 @@ class ResourceStats(Base):
         resource = model.Session.query(model.Resource).filter(model.Resource.url == url).first()
         start_date = datetime.now() - timedelta(num_days)
         # Returns the total number of visits since the beggining of all times for the associated resource to the given url
-        total_visits = model.Session.query(func.sum(cls.visits)).filter(cls.resource_id == resource.id).first().scalar()
+        total_visits = model.Session.query(func.sum(cls.visits)).filter(cls.resource_id == resource.id).scalar()
+        total_visits = ResourceStatsMonthly.add_totals(total_visits, [resource.id])
         resource_stats = model.Session.query(cls).filter(cls.resource_id == resource.id).filter(
             cls.visit_date >= start_date).all()
         visits = ResourceStats.convert_to_dict(resource_stats, total_visits)
@@ -484,6 +702,7 @@ class ResourceStats(Base):
         resource_stats = model.Session.query(cls).filter(cls.resource_id.in_(subquery)).filter(
             cls.visit_date >= start_date).all()
         total_visits = model.Session.query(func.sum(cls.visits)).filter(cls.resource_id.in_(subquery)).scalar()
+        total_visits = ResourceStatsMonthly.add_totals(total_visits, subquery)
         visits = ResourceStats.convert_to_dict(resource_stats, total_visits)
 
         return visits
@@ -545,6 +764,61 @@ class ResourceStats(Base):
             return result.visit_date
 
 
+class PackageStatsMonthly(Base):
+    """
+    Stats of packages by month, folded from the package_stats rows older
+    than the retention period by the compact command. All time totals
+    include them.
+    """
+    __tablename__ = 'package_stats_monthly'
+
+    package_id = Column(types.UnicodeText, nullable=False, primary_key=True)
+    month = Column(types.DateTime, nullable=False, primary_key=True)
+    visits = Column(types.Integer, default=0)
+    entrances = Column(types.Integer, default=0)
+    downloads = Column(types.Integer, default=0)
+
+    @classmethod
+    def get_totals(cls, package_ids):
+        '''
+        :param package_ids: list of package ids
+        :return: {package_id: (visits, downloads)} of the packages with monthly stats
+        '''
+        if not package_ids:
+            return {}
+        rows = (model.Session.query(cls.package_id, func.sum(cls.visits), func.sum(cls.downloads))
+                .filter(cls.package_id.in_(package_ids))
+                .group_by(cls.package_id)
+                .all())
+        return dict((package_id, (visits or 0, downloads or 0)) for package_id, visits, downloads in rows)
+
+
+class ResourceStatsMonthly(Base):
+    """
+    Stats of resources by month, folded from the resource_stats rows older
+    than the retention period by the compact command. All time totals
+    include them.
+    """
+    __tablename__ = 'resource_stats_monthly'
+
+    resource_id = Column(types.UnicodeText, nullable=False, primary_key=True)
+    month = Column(types.DateTime, nullable=False, primary_key=True)
+    visits = Column(types.Integer, default=0)
+
+    @classmethod
+    def add_totals(cls, total_visits, resource_ids):
+        '''
+        Adds the monthly visits of resource_ids, a list or a subquery of
+        resource ids, to the sum of their daily visits
+
+        :return: the all time total, None if neither table has stats of the resources
+        '''
+        monthly_visits = model.Session.query(func.sum(cls.visits)).filter(cls.resource_id.in_(resource_ids)).scalar()
+        if monthly_visits is None:
+            return total_visits
+        return (total_visits or 0) + monthly_visits
+
+
 class AudienceLocation(Base):
     """
     Contains stats for different visitors locations
@@ -619,9 +893,13 @@ class AudienceLocationDate(Base):
         if location_by_date is None:
             location_by_date = AudienceLocationDate(location_id=location.id, date=visit_date, visits=visits)
             model.Session.add(location_by_date)
+            previous_visits = 0
         else:
+            previous_visits = location_by_date.visits or 0
             location_by_date.visits = visits
 
+        AudienceLocationTotals.update_visits(location.id, visit_date, (visits or 0) - previous_visits)
+
         log.debug("Number of visits updated for location %s" % location_name)
         model.Session.flush()
         return True
@@ -726,21 +1004,22 @@ class AudienceLocationDate(Base):
             }
         ]
         '''
-        locations = model.Session.query(cls.location_id, func.sum(cls.visits).label('total_visits')) \
-            .group_by(cls.location_id) \
-            .order_by(func.sum(cls.visits).desc()) \
+        locations = model.Session.query(AudienceLocation.location_name, AudienceLocationTotals.total_visits) \
+            .join(AudienceLocationTotals, AudienceLocationTotals.location_id == AudienceLocation.id) \
+            .order_by(AudienceLocationTotals.total_visits.desc()) \
             .limit(limit) \
             .all()
 
-        result = cls.convert_list_to_dicts(locations)
-        all_visits = AudienceLocationDate.get_total_visits().get('total_visits', 0)
+        result = [{'location_name': location_name, 'total_visits': total_visits}
+                  for location_name, total_visits in locations]
+        all_visits = AudienceLocationTotals.get_total_visits()
         result.append({
             'location_name': 'Other',
             'total_visits': all_visits - sum(x.get('total_visits', 0) for x in result)
         })
 
         for r in result:
-            r['percent_visits'] = 100.0 * r.get('total_visits', 0.0) / all_visits
+            r['percent_visits'] = 100.0 * r.get('total_visits', 0.0) / all_visits if all_visits else 0.0
 
         return result
 
@@ -783,6 +1062,79 @@ class AudienceLocationDate(Base):
 
         return results
 
+    @classmethod
+    def get_location_report(cls, home_location, window_start, window_end, months_start, months_end, limit=20):
+        '''
+        Everything the location report shows. The all time figures come from
+        AudienceLocationTotals, the last month and the monthly series from two
+        grouped queries instead of a scan of the table for every figure
+
+        :param home_location: location compared to the rest of the world
+        :param window_start, window_end: span of the second home vs. rest comparison, e.g. last month
+        :param months_start, months_end: span of sessions_by_month, the export covers everything up to months_end
+        :return: dict like:
+        {
+            first_date,
+            top_locations: [{ location_name, total_visits, percent_visits }, ..., Other],
+            home_vs_world_all: [{ location_name, total_visits }, Other],
+            home_vs_world_window: [{ location_name, total_visits }, Other],
+            sessions_by_month: [{ combined_date, date, visits }, ...],
+            sessions_by_month_all: [{ combined_date, date, visits }, ...],
+        }
+        '''
+        totals = AudienceLocationTotals.get_all()
+        all_visits = sum(location['total_visits'] for location in totals)
+        home_all = sum(location['total_visits'] for location in totals if location['location_name'] == home_location)
+
+        top_locations = [{'location_name': location['location_name'], 'total_visits': location['total_visits']}
+                         for location in totals[:limit]]
+        top_locations.append({
+            'location_name': 'Other',
+            'total_visits': all_visits - sum(x['total_visits'] for x in top_locations)
+        })
+        for location in top_locations:
+            location['percent_visits'] = 100.0 * location['total_visits'] / all_visits if all_visits else 0.0
+
+        is_home = AudienceLocation.location_name == home_location
+        window = (model.Session.query(func.sum(cls.visits), func.sum(case([(is_home, cls.visits)], else_=0)))
+                  .join(AudienceLocation, cls.location_id == AudienceLocation.id)
+                  .filter(cls.date >= window_start)
+                  .filter(cls.date <= window_end)
+                  .one())
+        window_visits, home_window = window[0] or 0, window[1] or 0
+
+        year = func.extract('year', cls.date)
+        month = func.extract('month', cls.date)
+        in_months = cls.date >= months_start
+        months = (model.Session.query(year, month, func.max(cls.date), func.sum(cls.visits),
+                                      func.sum(case([(in_months, cls.visits)], else_=0)),
+                                      func.sum(case([(in_months, 1)], else_=0)))
+                  .filter(cls.date <= months_end)
+                  .group_by(year, month)
+                  .order_by(year, month)
+                  .all())
+
+        sessions_by_month = []
+        sessions_by_month_all = []
+        for month_year, month_number, last_date, visits, visits_in_months, rows_in_months in months:
+            combined_date = '%d-%d' % (month_number, month_year)
+            # Labelled with the last day of the month with stats, like special_total_by_months
+            sessions_by_month_all.append({'combined_date': combined_date, 'date': str(last_date), 'visits': visits})
+            if rows_in_months:
+                sessions_by_month.append({'combined_date': combined_date, 'date': str(last_date),
+                                          'visits': visits_in_months})
+
+        return {
+            'first_date': min(location['first_date'] for location in totals) if totals else None,
+            'top_locations': top_locations,
+            'home_vs_world_all': [{'location_name': home_location, 'total_visits': home_all},
+                                  {'location_name': 'Other', 'total_visits': all_visits - home_all}],
+            'home_vs_world_window': [{'location_name': home_location, 'total_visits': home_window},
+                                     {'location_name': 'Other', 'total_visits': window_visits - home_window}],
+            'sessions_by_month': sessions_by_month,
+            'sessions_by_month_all': sessions_by_month_all,
+        }
+
     @classmethod
     def get_location_name_by_id(cls, location_id):
         location = model.Session.query(AudienceLocation).filter(AudienceLocation.id == location_id).first()
@@ -828,6 +1180,122 @@ class AudienceLocationDate(Base):
         return visits
 
 
+class AudienceLocationTotals(Base):
+    """
+    Running totals of AudienceLocationDate by location, kept up to date by
+    every function writing audience_location_date so that all time figures
+    don't need to sum the whole table
+    """
+    __tablename__ = 'audience_location_totals'
+
+    location_id = Column(types.Integer, ForeignKey('audience_location.id'), primary_key=True)
+    total_visits = Column(types.BigInteger, nullable=False, default=0)
+    first_date = Column(types.DateTime)
+    last_date = Column(types.DateTime)
+
+    # PostgreSQL 9.5+ only, like the rest of the bulk paths using it
+    ADD_VISITS = text('''
+        INSERT INTO audience_location_totals (location_id, total_visits)
+        VALUES (:location_id, :visits)
+        ON CONFLICT (location_id) DO UPDATE SET
+            total_visits = audience_location_totals.total_visits + EXCLUDED.total_visits''')
+
+    @classmethod
+    def update_visits(cls, location_id, visit_date, visits):
+        '''
+        Adds the change of the visits of one location and date to the totals in
+        the session, for the ORM path which only adds and updates rows
+
+        :param visits: change of the visits of the location on visit_date
+        '''
+        if not isinstance(visit_date, datetime):
+            visit_date = datetime(visit_date.year, visit_date.month, visit_date.day)
+        totals = model.Session.query(cls).get(location_id)
+        if totals is None:
+            model.Session.add(cls(location_id=location_id, total_visits=visits, first_date=visit_date,
+                                  last_date=visit_date))
+            return
+        totals.total_visits = (totals.total_visits or 0) + visits
+        # Rows are never removed here, so the span can only grow
+        totals.first_date = min(totals.first_date or visit_date, visit_date)
+        totals.last_date = max(totals.last_date or visit_date, visit_date)
+
+    @classmethod
+    def add_visits(cls, connection, deltas):
+        '''
+        Adds changes of audience_location_date to the totals and recomputes
+        the dates of the changed locations. Call after the changes.
+
+        :param connection: connection of the transaction changing the visits
+        :param deltas: list of dicts like { location_id, visits } where visits is the change of the location's
+            visits
+        '''
+        if deltas:
+            connection.execute(cls.ADD_VISITS, deltas)
+            cls.refresh_dates(connection, [delta['location_id'] for delta in deltas])
+
+    @classmethod
+    def refresh_dates(cls, connection, location_ids):
+        '''
+        Recomputes first_date and last_date of the given locations from
+        audience_location_date and drops the totals of locations left
+        without any rows, like rebuild would
+        '''
+        table = cls.__table__
+        location_date_table = AudienceLocationDate.__table__
+        of_location = location_date_table.c.location_id == table.c.location_id
+        connection.execute(table.update()
+                           .where(table.c.location_id.in_(location_ids))
+                           .values(first_date=select([func.min(location_date_table.c.date)])
+                                   .where(of_location).as_scalar(),
+                                   last_date=select([func.max(location_date_table.c.date)])
+                                   .where(of_location).as_scalar()))
+        connection.execute(table.delete().where(and_(table.c.location_id.in_(location_ids),
+                                                     not_(exists().where(of_location)))))
+
+    @classmethod
+    def rebuild(cls, connection=None):
+        '''
+        Recomputes the totals from audience_location_date
+        '''
+        connection = connection or model.Session
+        location_date_table = AudienceLocationDate.__table__
+        connection.execute(cls.__table__.delete())
+        connection.execute(cls.__table__.insert().from_select(
+            ['location_id', 'total_visits', 'first_date', 'last_date'],
+            select([location_date_table.c.location_id, func.coalesce(func.sum(location_date_table.c.visits), 0),
+                    func.min(location_date_table.c.date), func.max(location_date_table.c.date)])
+            .where(location_date_table.c.location_id != None)  # noqa: E711
+            .group_by(location_date_table.c.location_id)))
+
+    @classmethod
+    def get_all(cls):
+        '''
+        Totals of all locations, most visited first
+
+        returns list of dicts like:
+        [
+            {
+                location_name
+                total_visits
+                first_date
+                last_date
+            }
+        ]
+        '''
+        rows = model.Session.query(AudienceLocation.location_name, cls.total_visits, cls.first_date, cls.last_date) \
+            .join(cls, cls.location_id == AudienceLocation.id) \
+            .order_by(cls.total_visits.desc()) \
+            .all()
+        return [{'location_name': location_name, 'total_visits': total_visits,
+                 'first_date': first_date, 'last_date': last_date}
+                for location_name, total_visits, first_date, last_date in rows]
+
+    @classmethod
+    def get_total_visits(cls):
+        return model.Session.query(func.coalesce(func.sum(cls.total_visits), 0)).scalar()
+
+
 class SearchStats(Base):
     """
     Contains stats for search terms
@@ -886,6 +1354,52 @@ class SearchStats(Base):
         return sorted(search_term_list, key=lambda search_term: search_term["count"], reverse=True)[:limit]
 
 
+def _days_ago(days):
+    start = date.today() - timedelta(days=days)
+    return datetime(start.year, start.month, start.day)
+
+
+LAST_INGEST_KEY = 'googleanalytics.last_ingest'
+
+
+def get_last_ingest():
+    '''
+    Time of the last successful ingest as a unix timestamp, None if stats have never been loaded
+    '''
+    value = model.get_system_info(LAST_INGEST_KEY)
+    return int(value) if value else None
+
+
+def get_report_generated(report_name):
+    '''
+    Time any options of a report were last generated by ckanext-report as a
+    unix timestamp, None if the report has not been generated
+    '''
+    from ckanext.report.model import DataCache
+    created = model.Session.query(func.max(DataCache.created)).filter(DataCache.object_id == report_name).scalar()
+    return int(time.mktime(created.timetuple())) if created is not None else None
+
+
+def set_last_ingest(timestamp=None):
+    model.set_system_info(LAST_INGEST_KEY, str(int(timestamp or time.time())))
+
+
+COMPACTED_BEFORE_KEY = 'googleanalytics.compacted_before'
+
+
+def get_compacted_before():
+    '''
+    Date before which the package and resource stats have been folded into
+    monthly rows by compact, None if they have never been compacted
+    '''
+    value = model.get_system_info(COMPACTED_BEFORE_KEY)
+    return datetime.strptime(value, '%Y-%m-%d').date() if value else None
+
+
+def set_compacted_before(cutoff):
+    model.set_system_info(COMPACTED_BEFORE_KEY, cutoff.strftime('%Y-%m-%d'))
+
+
 def maybe_negate(value, inputvalue, negate=False):
     if negate:
         return not_(value == inputvalue)
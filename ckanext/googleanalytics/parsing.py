@@ -0,0 +1,55 @@
+"""
+Parsing of the values Google Analytics returns in report rows.
+"""
+import re
+import datetime
+
+from ckanext.googleanalytics.cache import lru_memoize
+
+# Dataset name or id and optional resource id from a page path, with or without
+# a language prefix, e.g. /fi/dataset/<name>/resource/<id>/download/file.csv?x=1
+PAGE_PATH_REGEX = re.compile(r'/dataset/([^/?&#]+)(?:/resource/([^/?&#]+))?')
+
+PAGE_PATH_CACHE_SIZE = 100000
+
+
+@lru_memoize(PAGE_PATH_CACHE_SIZE)
+def parse_page_path(path):
+    '''
+    Classifies a ga:pagePath value.
+
+    :param path: page path as reported by Google Analytics
+    :return: ('resource', dataset, resource_id) for resource pages and downloads,
+        ('dataset', dataset, None) for other dataset pages or None if the path
+        does not point to a dataset
+    '''
+    match = PAGE_PATH_REGEX.search(path)
+    if match is None:
+        return None
+    dataset, resource_id = match.groups()
+    if resource_id:
+        return 'resource', dataset, resource_id
+    return 'dataset', dataset, None
+
+
+# About 30 years of distinct days
+DATE_CACHE_SIZE = 12000
+
+_decoded_dates = {}
+
+
+def decode_ga_date(value):
+    '''
+    Decodes a ga:date value (YYYYMMDD) by slicing instead of strptime.
+    Called for every row, so memoized in a plain dict that is emptied when full.
+
+    :return: (date, proleptic Gregorian ordinal of the date)
+    '''
+    try:
+        return _decoded_dates[value]
+    except KeyError:
+        decoded = datetime.date(int(value[0:4]), int(value[4:6]), int(value[6:8]))
+        if len(_decoded_dates) >= DATE_CACHE_SIZE:
+            _decoded_dates.clear()
+        _decoded_dates[value] = decoded, decoded.toordinal()
+        return _decoded_dates[value]
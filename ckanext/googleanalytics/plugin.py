@@ -1,7 +1,11 @@
+import atexit
 import logging
+import random
+import time
 
 import urllib
 import urllib2
+import urlparse
 
 import commands
 import paste.deploy.converters as converters
@@ -16,6 +20,12 @@ import Queue
 
 log = logging.getLogger(__name__)
 
+# Pending coalesced events that trigger sending before the interval is over
+DEFAULT_MAX_PENDING = 10000
+
+# Seconds the sender threads get at exit for the last coalesced events
+SHUTDOWN_TIMEOUT = 5
+
 
 class GoogleAnalyticsException(Exception):
     pass
@@ -24,15 +34,18 @@ class GoogleAnalyticsException(Exception):
 class AnalyticsPostThread(threading.Thread):
     """Threaded Url POST"""
 
-    def __init__(self, queue, test_mode=False):
+    def __init__(self, queue, test_mode=False, tracking_metrics=None):
         threading.Thread.__init__(self)
         self.queue = queue
         self.test_mode = test_mode
+        self.tracking_metrics = tracking_metrics
 
     def run(self):
         while True:
             # grabs host from queue
-            data_dict = self.queue.get()
+            data_dict, metric_key, enqueued = self.queue.get()
+            if self.tracking_metrics is not None:
+                self.tracking_metrics.record_queue_wait(metric_key, time.time() - enqueued)
 
             data = urllib.urlencode(data_dict)
             # send analytics
@@ -51,16 +64,146 @@ class AnalyticsPostThread(threading.Thread):
             self.queue.task_done()
 
 
+class EventAggregator(threading.Thread):
+    """
+    Coalesces repeated API events before they are sent.
+
+    Events with the same client id, action and label seen during
+    ``interval`` seconds are combined into one hit whose event value is the
+    sum of their event values, i.e. the number of calls it stands for.
+    Pending events are sent early when there are ``max_pending`` of them,
+    and when the process exits.
+    """
+
+    def __init__(self, queue, interval, max_pending=DEFAULT_MAX_PENDING):
+        threading.Thread.__init__(self)
+        self.queue = queue
+        self.interval = interval
+        self.max_pending = max_pending
+        self.pending = {}
+        self.lock = threading.Lock()
+
+    def add(self, data_dict, metric_key):
+        key = (data_dict['cid'], data_dict['ea'], data_dict['el'])
+        with self.lock:
+            pending = self.pending.get(key)
+            if pending is None:
+                data_dict.setdefault('ev', 1)
+                self.pending[key] = (data_dict, metric_key, time.time())
+            else:
+                pending[0]['ev'] += data_dict.get('ev', 1)
+            full = len(self.pending) >= self.max_pending
+        if full:
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            pending, self.pending = self.pending, {}
+
+        now = time.time()
+        for data_dict, metric_key, first_seen in pending.itervalues():
+            # Queue time makes Google Analytics date the hit to the first call it stands for
+            data_dict['qt'] = int((now - first_seen) * 1000)
+            self.queue.put((data_dict, metric_key, now))
+
+    def shutdown(self, timeout=SHUTDOWN_TIMEOUT):
+        '''
+        Sends the pending events and waits up to timeout seconds for the sender threads to post them
+        '''
+        self.flush()
+        deadline = time.time() + timeout
+        while self.queue.unfinished_tasks and time.time() < deadline:
+            time.sleep(0.05)
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            self.flush()
+
+
+def sample_weight(rate):
+    '''
+    Number of calls a hit sampled with rate stands for
+
+    :raises ValueError: unless rate is 1/n for a whole number n, other rates can't be scaled back up exactly
+    '''
+    if not 0.0 < rate <= 1.0:
+        raise ValueError('Sample rate %r is not between 0 and 1' % rate)
+    weight = int(round(1.0 / rate))
+    if abs(weight - 1.0 / rate) > 1e-6:
+        raise ValueError('Sample rate %r is not 1/n for a whole number n, e.g. 0.5, 0.25 or 0.1' % rate)
+    return weight
+
+
+def is_report_download(environ, match):
+    '''
+    Routes condition matching the CSV and JSON downloads of ckanext-report
+    '''
+    return urlparse.parse_qs(environ.get('QUERY_STRING', '')).get('format', [None])[0] in ('csv', 'json')
+
+
+class ApiActionSampler(object):
+    """
+    Decides which API action calls are sent to Google Analytics.
+
+    Actions in ``deny`` are never sent and, if ``allow`` is not empty, only
+    the actions in it are sent. The rest are sampled with the rate given for
+    the action in ``sample_rates`` or ``default_rate``. Rates other than 0
+    must be 1/n for a whole number n, so that each sampled hit stands for a
+    whole number of calls.
+    """
+
+    def __init__(self, allow=None, deny=None, default_rate=1.0, sample_rates=None):
+        self.allow = set(allow or [])
+        self.deny = set(deny or [])
+        self.default_rate = default_rate
+        self.sample_rates = sample_rates or {}
+        for rate in [default_rate] + self.sample_rates.values():
+            if rate != 0.0:
+                sample_weight(rate)
+
+    @classmethod
+    def from_config(cls, config):
+        sample_rates = {}
+        for item in p.toolkit.aslist(config.get('googleanalytics.api_actions.sample_rates', '')):
+            action, _sep, rate = item.partition(':')
+            sample_rates[action] = float(rate)
+        return cls(allow=p.toolkit.aslist(config.get('googleanalytics.api_actions.allow', '')),
+                   deny=p.toolkit.aslist(config.get('googleanalytics.api_actions.deny', '')),
+                   default_rate=float(config.get('googleanalytics.api_actions.sample_rate', 1.0)),
+                   sample_rates=sample_rates)
+
+    def sample_rate(self, logic_function):
+        if logic_function in self.deny or (self.allow and logic_function not in self.allow):
+            return 0.0
+        return self.sample_rates.get(logic_function, self.default_rate)
+
+    def sample(self, logic_function):
+        '''
+        Returns the sample rate if this call should be sent, otherwise None
+        '''
+        rate = self.sample_rate(logic_function)
+        if rate >= 1.0 or (rate > 0.0 and random.random() < rate):
+            return min(rate, 1.0)
+        return None
+
+
 class GoogleAnalyticsPlugin(p.SingletonPlugin, DefaultTranslation):
     p.implements(p.IConfigurable, inherit=True)
     p.implements(p.IRoutes, inherit=True)
     p.implements(p.IConfigurer, inherit=True)
     p.implements(p.ITemplateHelpers)
     p.implements(p.IActions, inherit=True)
+    p.implements(p.IAuthFunctions)
     p.implements(IReport)
     p.implements(p.ITranslation)
+    p.implements(p.IMiddleware, inherit=True)
+    p.implements(p.IPackageController, inherit=True)
 
     analytics_queue = Queue.Queue()
+    tracking_metrics = None
+    api_action_sampler = ApiActionSampler()
+    event_aggregator = None
 
     def configure(self, config):
         '''Load config settings for this extension from config file.
@@ -94,11 +237,32 @@ class GoogleAnalyticsPlugin(p.SingletonPlugin, DefaultTranslation):
         self.track_events = converters.asbool(
             config.get('googleanalytics.track_events', False))
 
+        GoogleAnalyticsPlugin.api_action_sampler = ApiActionSampler.from_config(config)
+
+        from ckanext.googleanalytics import helpers
+        helpers.configure(config)
+
         p.toolkit.add_resource('fanstatic_library', 'ckanext-googleanalytics')
 
+        if converters.asbool(config.get('googleanalytics.tracking_metrics', False)):
+            from ckanext.googleanalytics.metrics import TrackingMetrics
+            GoogleAnalyticsPlugin.tracking_metrics = TrackingMetrics(
+                max_samples=int(config.get('googleanalytics.tracking_metrics.max_samples', 1000)),
+                log_interval=int(config.get('googleanalytics.tracking_metrics.log_interval', 300)))
+
+        coalesce_interval = int(config.get('googleanalytics.api_actions.coalesce_interval', 0))
+        if coalesce_interval > 0:
+            aggregator = EventAggregator(self.analytics_queue, coalesce_interval, max_pending=int(
+                config.get('googleanalytics.api_actions.coalesce_max_pending', DEFAULT_MAX_PENDING)))
+            aggregator.setDaemon(True)
+            aggregator.start()
+            atexit.register(aggregator.shutdown)
+            GoogleAnalyticsPlugin.event_aggregator = aggregator
+
         # spawn a pool of 5 threads, and pass them queue instance
         for i in range(5):
-            t = AnalyticsPostThread(self.analytics_queue, test_mode=test_mode)
+            t = AnalyticsPostThread(self.analytics_queue, test_mode=test_mode,
+                                    tracking_metrics=self.tracking_metrics)
             t.setDaemon(True)
             t.start()
 
@@ -111,7 +275,30 @@ class GoogleAnalyticsPlugin(p.SingletonPlugin, DefaultTranslation):
     # IActions
     def get_actions(self):
         from ckanext.googleanalytics.logic.action import get as action_get
-        return {'googleanalytics_dataset_visits': action_get.googleanalytics_dataset_visits}
+        return {'googleanalytics_dataset_visits': action_get.googleanalytics_dataset_visits,
+                'googleanalytics_datasets_visits': action_get.googleanalytics_datasets_visits,
+                'googleanalytics_tracking_stats': action_get.googleanalytics_tracking_stats}
+
+    # IMiddleware
+    def make_middleware(self, app, config):
+        if not converters.asbool(config.get('googleanalytics.http_cache', True)):
+            return app
+        from ckanext.googleanalytics.middleware import AnalyticsCacheMiddleware, DEFAULT_MAX_AGE
+        return AnalyticsCacheMiddleware(
+            app, max_age=int(config.get('googleanalytics.cache_control.max_age', DEFAULT_MAX_AGE)))
+
+    # IPackageController
+    def before_index(self, pkg_dict):
+        from ckanext.googleanalytics import search_index
+        if search_index.enabled():
+            pkg_dict.update(search_index.popularity_fields(pkg_dict['id']))
+        return pkg_dict
+
+    # IAuthFunctions
+    def get_auth_functions(self):
+        from ckanext.googleanalytics.logic.auth import get as auth_get
+        return {'googleanalytics_tracking_stats': auth_get.googleanalytics_tracking_stats,
+                'googleanalytics_export': auth_get.googleanalytics_export}
 
     def before_map(self, map):
         '''Add new routes that this extension's controllers handle.
@@ -129,6 +316,18 @@ class GoogleAnalyticsPlugin(p.SingletonPlugin, DefaultTranslation):
             m.connect('/dataset/{id}/resource/{resource_id}/download', action='resource_download')
             m.connect('/dataset/{id}/resource/{resource_id}/download/{filename}', action='resource_download')
 
+        map.connect('/analytics/export/{kind}', controller='ckanext.googleanalytics.controller:GAExportController',
+                    action='export')
+        map.connect('/analytics/report/{report_name}', controller='ckanext.googleanalytics.controller:GAReportController',
+                    action='dataset_table')
+        map.connect('/analytics/report/{report_name}/download',
+                    controller='ckanext.googleanalytics.controller:GAReportController', action='dataset_table_download')
+        # The stored dataset reports only hold their top datasets, so their downloads are streamed from the stats
+        map.connect('/report/{report_name}', controller='ckanext.googleanalytics.controller:GAReportController',
+                    action='dataset_table_download',
+                    requirements={'report_name': 'google-analytics-dataset(-least-popular)?'},
+                    conditions=dict(function=is_report_download))
+
         return map
 
     def after_map(self, map):
@@ -149,7 +348,9 @@ class GoogleAnalyticsPlugin(p.SingletonPlugin, DefaultTranslation):
         '''Return the CKAN 2.0 template helper functions this plugin provides.
         See ITemplateHelpers.
         '''
-        return {'googleanalytics_header': self.googleanalytics_header}
+        from ckanext.googleanalytics import helpers
+        return {'googleanalytics_header': self.googleanalytics_header,
+                'googleanalytics_dataset_visits': helpers.googleanalytics_dataset_visits}
 
     def googleanalytics_header(self):
         '''Render the googleanalytics_header snippet for CKAN 2.0 templates.
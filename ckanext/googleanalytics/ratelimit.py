@@ -0,0 +1,191 @@
+"""
+Pacing of Google Analytics API requests.
+
+RateScheduler is a token bucket shared by every request of a command,
+including the worker processes of backfill forked after it was created. It
+keeps the request rate under the per profile queries per second limit,
+the number of requests in flight under the concurrency limit and counts
+requests against the daily quota. Requests rejected because of rate limits
+or transient backend errors are retried with exponential backoff and
+jitter. The allowed rate adapts to the responses: it is halved on every
+rate limit error (429, or 403 with a rate limit reason) and grows back
+slowly with every successful request, so parallel fetches settle at the
+highest rate the quota allows. The number of requests allowed in flight
+shrinks and grows with the rate. Backend errors (500, 503) are retried
+without slowing down.
+"""
+import json
+import time
+import random
+import multiprocessing
+
+log = __import__('logging').getLogger(__name__)
+
+# Limits of the Core Reporting API for one view (profile)
+DEFAULT_QPS = 10.0
+DEFAULT_MAX_CONCURRENT = 10
+DEFAULT_DAILY_QUOTA = 10000
+DEFAULT_MAX_RETRIES = 5
+
+# Additive increase (queries per second) after a success, multiplicative decrease after a rate limit error
+RATE_INCREASE = 0.1
+RATE_DECREASE = 0.5
+MIN_QPS = 0.1
+
+BACKOFF_SECONDS = 1.0
+MAX_BACKOFF_SECONDS = 64.0
+
+RATE_LIMIT_STATUS = 429
+SERVER_ERROR_STATUSES = (500, 503)
+RATE_LIMIT_REASONS = ('rateLimitExceeded', 'userRateLimitExceeded')
+
+
+class QuotaExceeded(Exception):
+    pass
+
+
+def error_reasons(error):
+    '''
+    Reasons listed in the JSON body of an HttpError
+    '''
+    try:
+        content = json.loads(getattr(error, 'content', None) or '{}')
+    except (TypeError, ValueError):
+        return []
+    return [item.get('reason') for item in content.get('error', {}).get('errors', [])]
+
+
+def error_status(error):
+    '''
+    HTTP status of an HttpError, None for other errors
+    '''
+    try:
+        return int(getattr(getattr(error, 'resp', None), 'status', None))
+    except (TypeError, ValueError):
+        return None
+
+
+def is_rate_limited(error):
+    '''
+    True if the request was rejected because of a rate limit
+    '''
+    status = error_status(error)
+    if status == RATE_LIMIT_STATUS:
+        return True
+    if status == 403:
+        return any(reason in RATE_LIMIT_REASONS for reason in error_reasons(error))
+    return False
+
+
+def is_retryable(error):
+    '''
+    True if the request failed because of a rate limit or a transient
+    backend error and should be tried again later
+    '''
+    return is_rate_limited(error) or error_status(error) in SERVER_ERROR_STATUSES
+
+
+class RateScheduler(object):
+    def __init__(self, qps=DEFAULT_QPS, max_concurrent=DEFAULT_MAX_CONCURRENT, daily_quota=DEFAULT_DAILY_QUOTA,
+                 max_retries=DEFAULT_MAX_RETRIES, backoff_seconds=BACKOFF_SECONDS):
+        self.max_qps = float(qps)
+        self.max_concurrent = max_concurrent
+        self.daily_quota = daily_quota
+        self.max_retries = max_retries
+        self.backoff_seconds = backoff_seconds
+
+        # Shared with forked worker processes
+        self._lock = multiprocessing.Lock()
+        self._rate = multiprocessing.RawValue('d', self.max_qps)
+        self._tokens = multiprocessing.RawValue('d', 1.0)
+        self._refilled = multiprocessing.RawValue('d', time.time())
+        self._in_flight = multiprocessing.RawValue('i', 0)
+        self._day = multiprocessing.RawValue('i', 0)
+        self._used = multiprocessing.RawValue('i', 0)
+
+        # Counters of this process
+        self.retries = 0
+        self.wait_seconds = 0.0
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(qps=float(config.get('googleanalytics.rate_limit.qps', DEFAULT_QPS)),
+                   max_concurrent=int(config.get('googleanalytics.rate_limit.max_concurrent',
+                                                 DEFAULT_MAX_CONCURRENT)),
+                   daily_quota=int(config.get('googleanalytics.rate_limit.daily_quota', DEFAULT_DAILY_QUOTA)),
+                   max_retries=int(config.get('googleanalytics.rate_limit.max_retries', DEFAULT_MAX_RETRIES)))
+
+    @property
+    def rate(self):
+        return self._rate.value
+
+    @property
+    def concurrency(self):
+        '''
+        Requests allowed in flight, max_concurrent scaled down with the rate
+        '''
+        return max(1, int(round(self.max_concurrent * self._rate.value / self.max_qps)))
+
+    def _refill(self, now):
+        rate = self._rate.value
+        self._tokens.value = min(max(1.0, rate), self._tokens.value + (now - self._refilled.value) * rate)
+        self._refilled.value = now
+
+    def acquire(self):
+        '''
+        Blocks until a request may be sent
+        '''
+        started = time.time()
+        while True:
+            with self._lock:
+                now = time.time()
+                self._refill(now)
+                # The quota resets at midnight Pacific time, counting UTC days is close enough
+                today = int(now // 86400)
+                if self._day.value != today:
+                    self._day.value = today
+                    self._used.value = 0
+                if self.daily_quota and self._used.value >= self.daily_quota:
+                    raise QuotaExceeded('Daily quota of %d requests used' % self.daily_quota)
+                if self._tokens.value >= 1.0 and self._in_flight.value < self.concurrency:
+                    self._tokens.value -= 1.0
+                    self._in_flight.value += 1
+                    self._used.value += 1
+                    self.wait_seconds += now - started
+                    return
+                wait = max((1.0 - self._tokens.value) / self._rate.value, 0.01)
+            time.sleep(wait)
+
+    def release(self, rate_limited=False):
+        with self._lock:
+            self._in_flight.value -= 1
+            if rate_limited:
+                self._rate.value = max(MIN_QPS, self._rate.value * RATE_DECREASE)
+                # Pause everyone until the next token
+                self._tokens.value = 0.0
+            else:
+                self._rate.value = min(self.max_qps, self._rate.value + RATE_INCREASE)
+
+    def execute(self, request):
+        '''
+        Executes an API request, retrying it after rate limit errors
+        '''
+        attempt = 0
+        while True:
+            self.acquire()
+            try:
+                result = request.execute()
+            except Exception as e:
+                self.release(rate_limited=is_rate_limited(e))
+                if not is_retryable(e) or attempt >= self.max_retries:
+                    raise
+                backoff = min(MAX_BACKOFF_SECONDS, self.backoff_seconds * 2 ** attempt)
+                delay = backoff / 2 + random.uniform(0, backoff / 2)
+                attempt += 1
+                self.retries += 1
+                log.warning("Google Analytics request failed (%s), retry %d/%d in %.1fs at %.2f qps",
+                            e, attempt, self.max_retries, delay, self.rate)
+                time.sleep(delay)
+            else:
+                self.release()
+                return result
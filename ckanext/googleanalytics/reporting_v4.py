@@ -0,0 +1,98 @@
+"""
+Fetch backend for the Analytics Reporting API v4.
+
+``reports.batchGet`` answers up to five report requests with the same date
+range in one call, so all query types of a window are fetched together.
+The queries keep their Core Reporting API v3 form (v4 accepts the v3
+filter syntax in ``filtersExpression``) and the reports are converted
+back into v3 style ``{'rows': [...]}`` responses, so the resolvers work
+with either backend.
+"""
+
+API_BACKENDS = ('v3', 'v4')
+
+# Report requests batchGet accepts in one call
+MAX_BATCH_SIZE = 5
+
+# Largest page size the API allows
+PAGE_SIZE = 100000
+
+
+def _split(value):
+    return [part.strip() for part in (value or '').split(',') if part.strip()]
+
+
+def report_request(view_id, query, start_date, end_date, page_token=None, page_size=PAGE_SIZE):
+    '''
+    Converts a query of GACommand.query_definitions into a v4 ReportRequest
+    '''
+    request = {
+        'viewId': view_id,
+        'dateRanges': [{'startDate': start_date, 'endDate': end_date}],
+        'metrics': [{'expression': metric} for metric in _split(query['metrics'])],
+        'dimensions': [{'name': dimension} for dimension in _split(query['dimensions'])],
+        'pageSize': page_size,
+    }
+    if query.get('filters'):
+        request['filtersExpression'] = query['filters']
+    if query.get('sort'):
+        request['orderBys'] = [{'fieldName': field.lstrip('-'),
+                                'sortOrder': 'DESCENDING' if field.startswith('-') else 'ASCENDING'}
+                               for field in _split(query['sort'])]
+    if page_token:
+        request['pageToken'] = page_token
+    return request
+
+
+def v3_params(request):
+    '''
+    Core Reporting API v3 parameters equivalent to a v4 ReportRequest
+    '''
+    return {
+        'ids': 'ga:%s' % request['viewId'],
+        'start_date': request['dateRanges'][0]['startDate'],
+        'end_date': request['dateRanges'][0]['endDate'],
+        'metrics': ', '.join(metric['expression'] for metric in request.get('metrics', [])),
+        'dimensions': ', '.join(dimension['name'] for dimension in request.get('dimensions', [])),
+        'filters': request.get('filtersExpression'),
+        'sort': ','.join(('-' if order.get('sortOrder') == 'DESCENDING' else '') + order['fieldName']
+                         for order in request.get('orderBys', [])) or None,
+    }
+
+
+def report_rows(report):
+    '''
+    Rows of a v4 report in the v3 layout: dimension values followed by metric values
+    '''
+    return [row.get('dimensions', []) + row['metrics'][0]['values']
+            for row in report.get('data', {}).get('rows', [])]
+
+
+def batch_get(service, view_id, queries, start_date, end_date, execute, page_size=PAGE_SIZE):
+    '''
+    Fetches all pages of up to MAX_BATCH_SIZE queries over the same date range
+
+    :param execute: function executing an API request, e.g. RateScheduler.execute
+    :return: a v3 style response for each query, in the order of the queries
+    '''
+    if len(queries) > MAX_BATCH_SIZE:
+        raise ValueError('batchGet accepts at most %d report requests' % MAX_BATCH_SIZE)
+
+    results = [{'rows': []} for _ in queries]
+    # (index of the query, page token) of the reports with pages left
+    pending = [(index, None) for index in range(len(queries))]
+    while pending:
+        body = {'reportRequests': [report_request(view_id, queries[index], start_date, end_date, page_token,
+                                                  page_size)
+                                   for index, page_token in pending]}
+        response = execute(service.reports().batchGet(body=body))
+        next_pending = []
+        for (index, page_token), report in zip(pending, response.get('reports', [])):
+            results[index]['rows'].extend(report_rows(report))
+            if report.get('nextPageToken'):
+                next_pending.append((index, report['nextPageToken']))
+        pending = next_pending
+
+    for result in results:
+        result['totalResults'] = len(result['rows'])
+    return results
@@ -1,6 +1,30 @@
 from ckan.common import OrderedDict
 from ckanext.googleanalytics.model import PackageStats, ResourceStats, AudienceLocationDate, SearchStats
-from datetime import datetime, timedelta
+from ckanext.googleanalytics.cache import LRUCache
+from ckanext.googleanalytics.helpers import ingest_generation
+from datetime import date, datetime, timedelta
+from pylons import config
+
+PERIODS = ['week', 'month', 'year']
+
+# Location compared to the rest of the world in the location report
+DEFAULT_HOME_COUNTRY = 'Finland'
+
+# Largest number of resources the resource report shows
+TOP_RESOURCES = 50
+
+# Results shared by the options of a report family, valid until the next ingest or day
+_report_cache = LRUCache(16)
+
+# Dataset reports and whether they list the most visited datasets first
+DATASET_REPORTS = OrderedDict((
+    ('google-analytics-dataset', True),
+    ('google-analytics-dataset-least-popular', False),
+))
+DATASET_TABLE_COLUMNS = ['package_id', 'package_name', 'visits', 'entrances', 'downloads']
+
+# Datasets read at a time when a dataset report is downloaded
+DOWNLOAD_PAGE_SIZE = 1000
 
 
 def last_week():
@@ -35,25 +59,70 @@ def last_calendar_period(period):
         raise ValueError("The period parameter should be either 'week', 'month' or 'year'")
 
 
-def google_analytics_dataset_report(time):
+def cached_report_data(family, compute):
     '''
-    Generates report based on google analytics data. number of views per package
+    Computes the data of all options of a report family once per ingest and day
+    '''
+    key = (family, ingest_generation(), date.today())
+    data = _report_cache.get(key)
+    if data is None:
+        data = compute()
+        _report_cache.set(key, data)
+    return data
+
+
+def datasets_by_period():
+    '''
+    Dataset totals of all periods, most visited first, see PackageStats.get_total_visits_by_periods
     '''
+    return cached_report_data('datasets', lambda: PackageStats.get_total_visits_by_periods(
+        dict((period, last_calendar_period(period)) for period in PERIODS)))
+
+
+def dataset_table_rows(time, descending=True):
+    '''
+    Rows of all datasets of a dataset report, read a page at a time
+
+    :return: iterator of lists of the DATASET_TABLE_COLUMNS
+    '''
+    import ckan.model as model
 
     start_date, end_date = last_calendar_period(time)
+    after = None
+    try:
+        while True:
+            datasets, after = PackageStats.get_total_visits_page(start_date, end_date, descending=descending,
+                                                                 page_size=DOWNLOAD_PAGE_SIZE, after=after)
+            for dataset in datasets:
+                yield [dataset[column] for column in DATASET_TABLE_COLUMNS]
+            if after is None:
+                break
+    finally:
+        # Streamed after the request has removed its session
+        model.Session.remove()
+
+
+def google_analytics_dataset_report(time):
+    '''
+    Generates report based on google analytics data. number of views per package
+    '''
+    if time not in PERIODS:
+        raise ValueError("The period parameter should be either 'week', 'month' or 'year'")
 
     # get package objects corresponding to popular GA content
-    top_packages = PackageStats.get_total_visits(start_date=start_date, end_date=end_date, limit=None)
+    top_packages = datasets_by_period()[time]
     top_20 = top_packages[:20]
 
+    # Only the top of the table is stored with the report, GAReportController
+    # pages through and downloads all of it
     return {
-        'table': top_packages,
-        'top': top_20
+        'top': top_20,
+        'total': len(top_packages),
     }
 
 
 def google_analytics_dataset_option_combinations():
-    options = ['week', 'month', 'year']
+    options = PERIODS
     for option in options:
         yield {'time': option}
 
@@ -74,20 +143,23 @@ def google_analytics_dataset_least_popular_report(time):
     Generates report based on google analytics data. number of views per package
     '''
 
-    start_date, end_date = last_calendar_period(time)
+    if time not in PERIODS:
+        raise ValueError("The period parameter should be either 'week', 'month' or 'year'")
 
     # get package objects corresponding to popular GA content
-    top_packages = PackageStats.get_total_visits(start_date=start_date, end_date=end_date, limit=None, descending=False)
+    top_packages = sorted(datasets_by_period()[time], key=lambda dataset: (dataset['visits'], dataset['package_id']))
     top_20 = top_packages[:20]
 
+    # Only the top of the table is stored with the report, GAReportController
+    # pages through and downloads all of it
     return {
-        'table': top_packages,
-        'top': top_20
+        'top': top_20,
+        'total': len(top_packages),
     }
 
 
 def google_analytics_dataset_least_popular_option_combinations():
-    options = ['week', 'month', 'year']
+    options = PERIODS
     for option in options:
         yield {'time': option}
 
@@ -107,11 +179,11 @@ def google_analytics_resource_report(last):
     '''
     Generates report based on google analytics data. number of views per package
     '''
-    # get resource objects corresponding to popular GA content
-    top_resources = ResourceStats.get_top(limit=last)
+    # get resource objects corresponding to popular GA content, the top 50 is shared by all options
+    top_resources = cached_report_data('resources', lambda: ResourceStats.get_top(limit=TOP_RESOURCES))
 
     return {
-        'table': top_resources.get("resources")
+        'table': top_resources.get("resources")[:int(last)]
     }
 
 
@@ -132,36 +204,31 @@ googleanalytics_resource_report_info = {
 }
 
 
+def home_country():
+    return config.get('googleanalytics.home_country', DEFAULT_HOME_COUNTRY)
+
+
 def google_analytics_location_report():
     '''
     Generates report based on google analytics data. number of sessions per location
     '''
-
-    top_locations = AudienceLocationDate.get_total_top_locations(20)
-
     last_month_end = datetime.today().replace(day=1) - timedelta(days=1)
     last_month_start = last_month_end.replace(day=1)
-    finland_vs_world_last_month = AudienceLocationDate.special_total_location_to_rest(last_month_start, last_month_end,
-                                                                                      'Finland')
-
-    finland_vs_world_all = AudienceLocationDate.special_total_location_to_rest(datetime(2000, 1, 1), datetime.today(),
-                                                                               'Finland')
-
-    sessions_by_month = AudienceLocationDate.special_total_by_months()
 
-    data_for_export = AudienceLocationDate.special_total_by_months(datetime(2000, 1, 1), last_month_end)
-
-    first_date = AudienceLocationDate.get_first_date()
+    report = AudienceLocationDate.get_location_report(home_country(), last_month_start, last_month_end,
+                                                      last_month_end - timedelta(days=365), last_month_end,
+                                                      limit=20)
+    first_date = report['first_date']
 
     # first item in table list will be available for export
     return {
-        'table': data_for_export,
+        'table': report['sessions_by_month_all'],
         'data': {
             'first_date': first_date.date().isoformat() if first_date is not None else '-',
-            'top_locations': top_locations,
-            'finland_vs_world_last_month': finland_vs_world_last_month,
-            'finland_vs_world_all': finland_vs_world_all,
-            'sessions_by_month': sessions_by_month,
+            'top_locations': report['top_locations'],
+            'home_vs_world_last_month': report['home_vs_world_window'],
+            'home_vs_world_all': report['home_vs_world_all'],
+            'sessions_by_month': report['sessions_by_month'],
         }
     }
 
@@ -177,9 +244,26 @@ googleanalytics_location_report_info = {
 }
 
 
-def google_analytics_organizations_with_most_popular_datasets(time):
-    start_date, end_date = last_calendar_period(time)
-    most_popular_organizations = PackageStats.get_organizations_with_most_popular_datasets(start_date, end_date)
+def google_analytics_organizations_with_most_popular_datasets(time, limit=20):
+    if time not in PERIODS:
+        raise ValueError("The period parameter should be either 'week', 'month' or 'year'")
+
+    organization_stats = {}
+    for dataset in datasets_by_period()[time]:
+        if not dataset['organization_name']:
+            continue
+        stats = organization_stats.setdefault(dataset['organization_name'],
+                                              {"visits": 0, "downloads": 0, "entrances": 0})
+        for key in ("visits", "downloads", "entrances"):
+            stats[key] += dataset[key]
+
+    most_popular_organizations = sorted(
+        [{"organization_name": organization_name,
+          "total_visits": stats["visits"],
+          "total_downloads": stats["downloads"],
+          "total_entrances": stats["entrances"]}
+         for organization_name, stats in organization_stats.iteritems()],
+        key=lambda organization: organization["total_visits"], reverse=True)[:limit]
     return {
         'table': most_popular_organizations
     }
@@ -0,0 +1,56 @@
+"""
+Popularity fields of the dataset search index, off unless
+``googleanalytics.index_popularity`` is set.
+
+before_index adds ``views_total``, ``views_recent`` and ``downloads_total``
+to every indexed dataset. They are indexed as zero padded strings by the
+catch-all dynamic field of the CKAN Solr schema, so they sort numerically,
+e.g. ``package_search?sort=views_recent desc``. After an ingest only the
+datasets whose counts may have changed are reindexed.
+"""
+from pylons import config
+import paste.deploy.converters as converters
+
+from ckanext.googleanalytics.model import PackageStats
+
+log = __import__('logging').getLogger(__name__)
+
+DEFAULT_RECENT_DAYS = 30
+
+# Digits of the indexed counts
+PADDING = 12
+
+
+def enabled():
+    return converters.asbool(config.get('googleanalytics.index_popularity', False))
+
+
+def recent_days():
+    return int(config.get('googleanalytics.views_recent_days', DEFAULT_RECENT_DAYS))
+
+
+def popularity_fields(package_id):
+    return dict((field, '%0*d' % (PADDING, value))
+                for field, value in PackageStats.get_popularity(package_id, recent_days()).iteritems())
+
+
+def reindex_changed(since, previous_ingest=None):
+    '''
+    Reindexes the datasets with stats loaded from since on or with visits
+    that have dropped out of views_recent since the previous ingest
+
+    :return: number of datasets reindexed
+    '''
+    from ckan.lib import search
+    import ckan.logic as logic
+
+    package_ids = PackageStats.get_changed_package_ids(since, recent_days(), previous_ingest)
+    log.info("Reindexing popularity of %d datasets", len(package_ids))
+    for package_id in package_ids:
+        try:
+            search.rebuild(package_id, defer_commit=True)
+        except logic.NotFound:
+            # Stats of a purged dataset
+            continue
+    search.commit()
+    return len(package_ids)
@@ -0,0 +1,38 @@
+import datetime
+from unittest import TestCase
+
+import ckan.model as model
+from ckan.tests import helpers, factories
+
+from ckanext.googleanalytics.model import init_tables
+
+
+class DatabaseTestCase(TestCase):
+    """
+    Starts every test with empty CKAN and Google Analytics tables
+    """
+
+    def setUp(self):
+        # reset_db drops every table it finds, including the stats tables
+        helpers.reset_db()
+        init_tables(model.meta.engine)
+
+    def tearDown(self):
+        model.Session.remove()
+
+    @staticmethod
+    def create_dataset(name, **kwargs):
+        return factories.Dataset(name=name, **kwargs)
+
+    @staticmethod
+    def create_organization(**kwargs):
+        return factories.Organization(**kwargs)
+
+    @staticmethod
+    def create_resource(dataset, **kwargs):
+        return factories.Resource(package_id=dataset['id'], **kwargs)
+
+
+def days_ago(days):
+    today = datetime.date.today()
+    return datetime.datetime(today.year, today.month, today.day) - datetime.timedelta(days=days)
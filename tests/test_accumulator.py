@@ -0,0 +1,75 @@
+import datetime
+from unittest import TestCase
+
+from ckanext.googleanalytics import accumulator
+from ckanext.googleanalytics.accumulator import StatsAccumulator
+
+DAY = datetime.date(2019, 2, 24)
+
+
+class TestStatsAccumulator(TestCase):
+    def test_sum_merges_same_cell(self):
+        data = StatsAccumulator(('visits', 'entrances'))
+        data.add('b', DAY.toordinal() + 1, 1, 1)
+        data.add('a', DAY.toordinal(), 5, 2)
+        data.add('b', DAY.toordinal(), 3, 0)
+        data.add('a', DAY.toordinal(), 10, 1)
+        self.assertEquals(len(data), 3)
+        self.assertEquals(list(data.groups()), [
+            ('b', [(DAY, (3, 0)), (DAY + datetime.timedelta(days=1), (1, 1))]),
+            ('a', [(DAY, (15, 3))]),
+        ])
+
+    def test_replace_keeps_latest(self):
+        data = StatsAccumulator(('visits',), merge='replace')
+        data.add('Finland', DAY.toordinal(), 5)
+        data.add('Finland', DAY.toordinal(), 7)
+        self.assertEquals(list(data.rows()), [('Finland', DAY, (7,))])
+
+    def test_compacts_while_adding(self):
+        threshold = accumulator.COMPACT_THRESHOLD
+        accumulator.COMPACT_THRESHOLD = 10
+        try:
+            data = StatsAccumulator(('downloads',))
+            for i in range(100):
+                data.add('resource-%d' % (i % 3), DAY.toordinal(), 1)
+            self.assertTrue(len(data.date_column) < 100)
+            self.assertEquals(sorted((row[0], row[2]) for row in data.rows()),
+                              [('resource-0', (34,)), ('resource-1', (33,)), ('resource-2', (33,))])
+        finally:
+            accumulator.COMPACT_THRESHOLD = threshold
+
+    def test_extend_keeps_order(self):
+        first = StatsAccumulator(('visits',), merge='replace')
+        first.add('Finland', DAY.toordinal(), 5)
+        second = StatsAccumulator(('visits',), merge='replace')
+        second.add('Finland', DAY.toordinal(), 7)
+        second.add('Sweden', DAY.toordinal(), 1)
+        first.extend(second)
+        self.assertEquals(list(first.rows()), [('Finland', DAY, (7,)), ('Sweden', DAY, (1,))])
+
+    def test_drop_before(self):
+        data = StatsAccumulator(('visits', 'entrances'))
+        data.add('a', DAY.toordinal() - 1, 1, 0)
+        data.add('b', DAY.toordinal(), 2, 1)
+        data.add('a', DAY.toordinal() + 1, 3, 1)
+        self.assertEquals(data.drop_before(DAY), 1)
+        self.assertEquals(list(data.rows()), [('a', DAY + datetime.timedelta(days=1), (3, 1)),
+                                              ('b', DAY, (2, 1))])
+        self.assertEquals(data.drop_before(DAY), 0)
+        # Cells added afterwards are merged as usual
+        data.add('b', DAY.toordinal(), 1, 0)
+        self.assertEquals(len(data), 2)
+
+    def test_compacts_only_new_cells(self):
+        data = StatsAccumulator(('visits',))
+        data.add('b', DAY.toordinal(), 1)
+        data.add('a', DAY.toordinal(), 2)
+        self.assertEquals(len(data), 2)
+        date_column = data.date_column
+        list(data.rows())
+        self.assertTrue(data.date_column is date_column)
+        # Rows follow the order the keys were first added in
+        self.assertEquals([row[0] for row in data.rows()], ['b', 'a'])
+        data.add('a', DAY.toordinal(), 3)
+        self.assertEquals(list(data.rows()), [('b', DAY, (1,)), ('a', DAY, (5,))])
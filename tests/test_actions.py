@@ -0,0 +1,79 @@
+from unittest import TestCase
+
+import ckan.model as model
+from ckan.plugins import toolkit
+
+from fixtures import DatabaseTestCase, days_ago
+from ckanext.googleanalytics.logic.action import get as action_get
+from ckanext.googleanalytics.metrics import TrackingMetrics
+from ckanext.googleanalytics.model import PackageStats
+from ckanext.googleanalytics.plugin import GoogleAnalyticsPlugin
+
+
+class TestTrackingStats(TestCase):
+    def setUp(self):
+        self.tracking_metrics = GoogleAnalyticsPlugin.tracking_metrics
+
+    def tearDown(self):
+        GoogleAnalyticsPlugin.tracking_metrics = self.tracking_metrics
+
+    def test_disabled(self):
+        GoogleAnalyticsPlugin.tracking_metrics = None
+        self.assertRaises(toolkit.ObjectNotFound, action_get.googleanalytics_tracking_stats,
+                          {'ignore_auth': True}, {})
+
+    def test_summary(self):
+        GoogleAnalyticsPlugin.tracking_metrics = TrackingMetrics()
+        GoogleAnalyticsPlugin.tracking_metrics.record_overhead('package_show', 0.002)
+        result = action_get.googleanalytics_tracking_stats({'ignore_auth': True}, {})
+        self.assertEquals(result['overhead']['package_show']['count'], 1)
+        self.assertEquals(result['queue_wait'], {})
+        self.assertEquals(result['queue_size'], GoogleAnalyticsPlugin.analytics_queue.qsize())
+
+
+class TestDatasetsVisits(DatabaseTestCase):
+    def setUp(self):
+        super(TestDatasetsVisits, self).setUp()
+        self.dataset_a = self.create_dataset('dataset-a')
+        self.dataset_b = self.create_dataset('dataset-b')
+        self.dataset_c = self.create_dataset('dataset-c')
+        for package_id, days, visits, downloads in [(self.dataset_a['id'], 1, 3, 1),
+                                                    (self.dataset_a['id'], 2, 4, 0),
+                                                    (self.dataset_a['id'], 400, 10, 5),
+                                                    (self.dataset_b['id'], 1, 7, 2)]:
+            model.Session.add(PackageStats(package_id=package_id, visit_date=days_ago(days), visits=visits,
+                                           entrances=0, downloads=downloads))
+        model.Session.commit()
+
+    def test_get_all_visits_for_packages(self):
+        package_ids = [self.dataset_a['id'], self.dataset_b['id'], self.dataset_c['id']]
+        results = PackageStats.get_all_visits_for_packages(package_ids, num_days=30)
+        for package_id in package_ids:
+            expected = PackageStats.get_all_visits(package_id)
+            self.assertEquals(results[package_id]['count'], expected['count'])
+            self.assertEquals(results[package_id]['download_count'], expected['download_count'])
+            self.assertEquals(results[package_id]['visits'], expected['visits'])
+        self.assertEquals(results[self.dataset_a['id']]['count'], 17)
+        self.assertEquals(results[self.dataset_c['id']]['count'], 0)
+
+    def test_totals_only(self):
+        results = PackageStats.get_all_visits_for_packages([self.dataset_b['id']])
+        self.assertEquals(results, {self.dataset_b['id']: {'count': 7, 'download_count': 2}})
+        self.assertEquals(PackageStats.get_all_visits_for_packages([]), {})
+
+    def test_action_by_id_and_name(self):
+        result = action_get.googleanalytics_datasets_visits(
+            {}, {'ids': '%s, dataset-b,missing' % self.dataset_a['id']})
+        self.assertEquals(sorted(result.keys()), sorted([self.dataset_a['id'], 'dataset-b']))
+        self.assertEquals(result[self.dataset_a['id']], {'count': 17, 'download_count': 6})
+        self.assertEquals(result['dataset-b'], {'count': 7, 'download_count': 2})
+
+    def test_action_sparklines(self):
+        result = action_get.googleanalytics_datasets_visits({}, {'ids': ['dataset-a'], 'sparklines': 'true'})
+        self.assertEquals(len(result['dataset-a']['visits']), 30)
+        self.assertEquals(sum(day['visits'] for day in result['dataset-a']['visits']), 7)
+
+    def test_action_validation(self):
+        self.assertRaises(toolkit.ValidationError, action_get.googleanalytics_datasets_visits, {}, {'ids': ''})
+        self.assertRaises(toolkit.ValidationError, action_get.googleanalytics_datasets_visits, {},
+                          {'ids': ['x'] * (action_get.MAX_DATASETS_VISITS + 1)})
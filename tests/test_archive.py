@@ -0,0 +1,42 @@
+import shutil
+import datetime
+import tempfile
+
+import ckan.model as model
+
+from fixtures import DatabaseTestCase
+from test_commands import SyntheticCommand
+from ckanext.googleanalytics.model import PackageStats, ResourceStats
+from ckanext.googleanalytics.archive import ArchiveReader
+
+
+class TestExtractAndLoad(DatabaseTestCase):
+    def setUp(self):
+        super(TestExtractAndLoad, self).setUp()
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        super(TestExtractAndLoad, self).tearDown()
+
+    def test_extract_and_load(self):
+        dataset = self.create_dataset('annakarenina')
+        resource = self.create_resource(dataset)
+        datasets = [(dataset['name'], [resource['id']])]
+        archive_directory = self.directory + '/archive'
+
+        SyntheticCommand(datasets).extract(['extract', 'credentials.json', archive_directory,
+                                            '2019-03-01', '2019-03-07'])
+        reader = ArchiveReader(archive_directory)
+        self.assertTrue(reader.entries('package'))
+        self.assertTrue('/download/' in reader.manifest['queries']['resource']['filters'])
+
+        # A fresh command, like a separate paster run
+        SyntheticCommand(datasets).load(['load', archive_directory])
+        model.Session.remove()
+
+        visits = PackageStats.get_total_visits(datetime.datetime(2019, 3, 1), datetime.datetime(2019, 3, 7),
+                                               limit=None)
+        self.assertEquals([dataset_visits['package_id'] for dataset_visits in visits], [dataset['id']])
+        self.assertTrue(visits[0]['visits'] > 0)
+        self.assertTrue(ResourceStats.get_last_visits_by_id(resource['id'], num_days=100000)['tot_visits'] > 0)
@@ -0,0 +1,135 @@
+from datetime import date, datetime
+from unittest import TestCase
+
+import ckan.model as model
+
+from fixtures import DatabaseTestCase
+from ckanext.googleanalytics import backfill
+from ckanext.googleanalytics.accumulator import StatsAccumulator
+from ckanext.googleanalytics.model import PackageStats, ResourceStats, AudienceLocationDate, \
+    AudienceLocationTotals, SearchStats
+
+DAYS = [datetime(2019, 3, day) for day in (1, 2, 3, 4)]
+
+
+class TestSplitWindows(TestCase):
+    def test_single_day(self):
+        self.assertEquals(backfill.split_windows(date(2019, 3, 1), date(2019, 3, 1), 7),
+                          [(date(2019, 3, 1), date(2019, 3, 1))])
+
+    def test_shorter_than_window(self):
+        self.assertEquals(backfill.split_windows(date(2019, 3, 1), date(2019, 3, 3), 7),
+                          [(date(2019, 3, 1), date(2019, 3, 3))])
+
+    def test_exact_multiple(self):
+        self.assertEquals(backfill.split_windows(date(2019, 3, 1), date(2019, 3, 14), 7),
+                          [(date(2019, 3, 1), date(2019, 3, 7)), (date(2019, 3, 8), date(2019, 3, 14))])
+
+    def test_remainder(self):
+        self.assertEquals(backfill.split_windows(date(2019, 3, 1), date(2019, 3, 9), 7),
+                          [(date(2019, 3, 1), date(2019, 3, 7)), (date(2019, 3, 8), date(2019, 3, 9))])
+
+    def test_empty(self):
+        self.assertEquals(backfill.split_windows(date(2019, 3, 2), date(2019, 3, 1), 7), [])
+
+
+class BackfillTestCase(DatabaseTestCase):
+    def setUp(self):
+        super(BackfillTestCase, self).setUp()
+        self.dataset = self.create_dataset('dataset')
+        self.resource = self.create_resource(self.dataset)
+        self.staging = backfill.StagingTables()
+        self.staging.create()
+
+    def tearDown(self):
+        self.staging.drop()
+        super(BackfillTestCase, self).tearDown()
+
+    @staticmethod
+    def accumulator(columns, rows):
+        data = StatsAccumulator(columns)
+        for row in rows:
+            data.add(row[0], row[1].toordinal(), *row[2:])
+        return data
+
+
+class TestStagingRows(BackfillTestCase):
+    def test_package_names_to_ids(self):
+        data = self.accumulator(('visits', 'entrances'), [('dataset', DAYS[0], 3, 1),
+                                                          (self.dataset['id'], DAYS[1], 4, 2),
+                                                          ('missing', DAYS[0], 5, 0)])
+        rows = list(backfill._staging_rows('package', data))
+        self.assertEquals(sorted((row['package_id'], row['visit_date'], row['visits'], row['entrances'],
+                                  row['downloads']) for row in rows),
+                          [(self.dataset['id'], DAYS[0], 3, 1, 0), (self.dataset['id'], DAYS[1], 4, 2, 0)])
+
+        downloads = self.accumulator(('downloads',), [('dataset', DAYS[0], 7), ('missing', DAYS[0], 1)])
+        self.assertEquals([(row['package_id'], row['visits'], row['downloads'])
+                           for row in backfill._staging_rows('package_downloads', downloads)],
+                          [(self.dataset['id'], 0, 7)])
+
+    def test_unknown_resources(self):
+        data = self.accumulator(('visits',), [(self.resource['id'], DAYS[0], 2), ('missing', DAYS[0], 9)])
+        self.assertEquals(list(backfill._staging_rows('resource', data)),
+                          [{'resource_id': self.resource['id'], 'visit_date': DAYS[0], 'visits': 2}])
+
+    def test_stage_counts_rows(self):
+        data = self.accumulator(('visits',), [(self.resource['id'], DAYS[0], 2), ('missing', DAYS[0], 9)])
+        self.assertEquals(backfill.stage(self.staging, 'resource', data), 1)
+
+    def test_runs_use_own_tables(self):
+        other = backfill.StagingTables()
+        self.assertNotEquals(other.run_id, self.staging.run_id)
+        self.assertNotEquals(other.package_stats.name, self.staging.package_stats.name)
+        self.assertEquals(backfill.StagingTables(self.staging.run_id).search_terms.name,
+                          self.staging.search_terms.name)
+
+
+class TestMergeStaging(BackfillTestCase):
+    def setUp(self):
+        super(TestMergeStaging, self).setUp()
+        for day in DAYS:
+            model.Session.add(PackageStats(package_id=self.dataset['id'], visit_date=day, visits=1, entrances=1,
+                                           downloads=1))
+            model.Session.add(ResourceStats(resource_id=self.resource['id'], visit_date=day, visits=1))
+            model.Session.add(SearchStats(search_term=u'term', date=day, count=1))
+        model.Session.commit()
+        for day in DAYS:
+            AudienceLocationDate.update_visits('Finland', day, 1)
+        AudienceLocationDate.update_visits('Sweden', DAYS[1], 4)
+        model.Session.commit()
+
+    def test_replaces_range(self):
+        backfill.stage(self.staging, 'package', self.accumulator(('visits', 'entrances'),
+                                                                 [('dataset', DAYS[1], 10, 5)]))
+        backfill.stage(self.staging, 'package_downloads', self.accumulator(('downloads',),
+                                                                           [('dataset', DAYS[1], 2)]))
+        backfill.stage(self.staging, 'resource', self.accumulator(('visits',), [(self.resource['id'], DAYS[2], 20)]))
+        backfill.stage(self.staging, 'visitorlocation', self.accumulator(('visits',), [('Finland', DAYS[1], 30),
+                                                                                       ('Norway', DAYS[2], 3)]))
+        backfill.stage(self.staging, 'search_terms', self.accumulator(('count',), [(u'other', DAYS[2], 40)]))
+        backfill.merge_staging(self.staging, DAYS[1].date(), DAYS[2].date())
+        model.Session.remove()
+
+        # Days 2 and 3 are replaced, the first and last day are left alone
+        self.assertEquals(sorted((row.visit_date, row.visits, row.entrances, row.downloads)
+                                 for row in model.Session.query(PackageStats)),
+                          [(DAYS[0], 1, 1, 1), (DAYS[1], 10, 5, 2), (DAYS[3], 1, 1, 1)])
+        self.assertEquals(sorted((row.visit_date, row.visits) for row in model.Session.query(ResourceStats)),
+                          [(DAYS[0], 1), (DAYS[2], 20), (DAYS[3], 1)])
+        self.assertEquals(sorted((row.search_term, row.date, row.count) for row in model.Session.query(SearchStats)),
+                          [(u'other', DAYS[2], 40), (u'term', DAYS[0], 1), (u'term', DAYS[3], 1)])
+        self.assertEquals(sorted((row.location.location_name, row.date, row.visits)
+                                 for row in model.Session.query(AudienceLocationDate)),
+                          [('Finland', DAYS[0], 1), ('Finland', DAYS[1], 30), ('Finland', DAYS[3], 1),
+                           ('Norway', DAYS[2], 3)])
+
+        totals = AudienceLocationTotals.get_all()
+        self.assertEquals([(location['location_name'], location['total_visits']) for location in totals],
+                          [('Finland', 32), ('Norway', 3), ('Sweden', 0)])
+        AudienceLocationTotals.rebuild()
+        model.Session.commit()
+        rebuilt = dict((location['location_name'], location) for location in AudienceLocationTotals.get_all())
+        for location in totals:
+            if location['total_visits']:
+                self.assertEquals(location, rebuilt[location['location_name']])
@@ -0,0 +1,62 @@
+import datetime
+from unittest import TestCase
+
+from ckanext.googleanalytics.bulkload import CsvStream, copy_rows
+
+
+class FakeCursor(object):
+    def __init__(self):
+        self.statements = []
+
+    def copy_expert(self, sql, stream, size):
+        content = ''
+        while True:
+            chunk = stream.read(size)
+            if not chunk:
+                break
+            content += chunk
+        self.statements.append((sql, content))
+
+    def close(self):
+        pass
+
+
+class FakeConnection(object):
+    def __init__(self):
+        self.connection = self
+        self.cursor_object = FakeCursor()
+
+    def cursor(self):
+        return self.cursor_object
+
+
+class TestCsvStream(TestCase):
+    def test_reads_in_chunks(self):
+        rows = [(u'\xe4', datetime.datetime(2019, 3, 1), 1), ('a,b', None, 2)]
+        stream = CsvStream(rows)
+        content = ''
+        while True:
+            chunk = stream.read(4)
+            if not chunk:
+                break
+            content += chunk
+        self.assertEquals(content, '\xc3\xa4,2019-03-01T00:00:00,1\n"a,b",,2\n')
+        self.assertEquals(stream.row_count, 2)
+
+
+class TestCopyRows(TestCase):
+    def test_empty_keys_are_not_null(self):
+        connection = FakeConnection()
+        count = copy_rows(connection, 'ga_load_search_terms', ['search_term', 'date', 'count'],
+                          [('', datetime.datetime(2019, 3, 1), 3)], not_null=['search_term'])
+        self.assertEquals(count, 1)
+        sql, content = connection.cursor_object.statements[0]
+        self.assertEquals(sql, 'COPY ga_load_search_terms (search_term, date, count) FROM STDIN '
+                               'WITH (FORMAT csv, FORCE_NOT_NULL (search_term))')
+        self.assertEquals(content, ',2019-03-01T00:00:00,3\n')
+
+    def test_without_not_null(self):
+        connection = FakeConnection()
+        copy_rows(connection, 'ga_load_location_visits', ['location_name'], [('Finland',)])
+        sql, content = connection.cursor_object.statements[0]
+        self.assertEquals(sql, 'COPY ga_load_location_visits (location_name) FROM STDIN WITH (FORMAT csv)')
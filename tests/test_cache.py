@@ -0,0 +1,24 @@
+from unittest import TestCase
+
+from ckanext.googleanalytics.cache import LRUCache
+
+
+class TestLRUCache(TestCase):
+    def test_evicts_least_recently_used(self):
+        cache = LRUCache(2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        self.assertEquals(cache.get('a'), 1)
+        cache.set('c', 3)
+        self.assertEquals(cache.get('b'), None)
+        self.assertEquals(cache.get('a'), 1)
+        self.assertEquals(cache.get('c'), 3)
+
+    def test_expires(self):
+        cache = LRUCache(2, ttl=-1)
+        cache.set('a', 1)
+        self.assertEquals(cache.get('a'), None)
+        self.assertEquals(len(cache), 0)
+        cache = LRUCache(2, ttl=60)
+        cache.set('a', 1)
+        self.assertEquals(cache.get('a'), 1)
@@ -0,0 +1,81 @@
+import sys
+import logging
+import datetime
+from cStringIO import StringIO
+from unittest import TestCase
+
+from fixtures import DatabaseTestCase
+from ckanext.googleanalytics.commands import GACommand
+from ckanext.googleanalytics.model import PackageStats
+
+
+class SyntheticCommand(GACommand):
+    """GACommand answering queries with synthetic rows about the given datasets"""
+
+    def __init__(self, datasets):
+        super(SyntheticCommand, self).__init__('googleanalytics')
+        self.datasets = datasets
+        self.options = GACommand.parser.parse_args([])[0]
+        self.options.service = 'synthetic'
+        self.options.rows_per_day = 5
+        self.log = logging.getLogger('ckanext.googleanalytics')
+
+    def init_service(self, args, datasets=None):
+        return super(SyntheticCommand, self).init_service(args, datasets=self.datasets)
+
+
+class TestBenchmark(DatabaseTestCase):
+    def test_reports_rates(self):
+        dataset = self.create_dataset('annakarenina')
+        resource = self.create_resource(dataset)
+        command = SyntheticCommand([(dataset['name'], [resource['id']])])
+        command.options.save = True
+
+        stdout, sys.stdout = sys.stdout, StringIO()
+        try:
+            command.benchmark(['benchmark', (datetime.date.today() - datetime.timedelta(days=3)).isoformat()])
+            output = sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+
+        query_types = [query['type'] for query in command.query_definitions()]
+        lines = [line.split() for line in output.splitlines()]
+        self.assertTrue(['type', 'rows', 'fetch/s', 'resolve/s', 'cells', 'save/s'] in lines)
+        results = [line for line in lines if line and line[0] in query_types]
+        self.assertEquals(sorted(line[0] for line in results), sorted(query_types))
+        for query_type, rows, fetch_rate, resolve_rate, cells, save_rate in results:
+            self.assertTrue(int(rows) > 0)
+            self.assertTrue(int(cells) > 0)
+            for value in (resolve_rate, save_rate):
+                self.assertTrue(value == '-' or int(value) >= 0)
+        self.assertTrue(PackageStats.get_all_visits(dataset['id'])['count'] > 0)
+
+
+class TestWindows(TestCase):
+    def setUp(self):
+        self.command = GACommand('googleanalytics')
+
+    def windows(self, start_date, now, latest_date=None):
+        dates = self.command.get_dates_between_update(start_date, latest_date, now=now)
+        return self.command.get_windows(dates, now)
+
+    def test_calendar_months(self):
+        now = datetime.datetime(2019, 5, 20, 12)
+        self.assertEquals(self.windows(datetime.date(2019, 1, 15), now),
+                          [(datetime.date(2019, 5, 1), now),
+                           (datetime.date(2019, 4, 1), datetime.date(2019, 5, 1)),
+                           (datetime.date(2019, 3, 1), datetime.date(2019, 4, 1)),
+                           (datetime.date(2019, 2, 1), datetime.date(2019, 3, 1)),
+                           (datetime.date(2019, 1, 15), datetime.date(2019, 2, 1))])
+
+    def test_stable_across_runs(self):
+        # Runs in different months fetch the same windows for the months both cover
+        earlier = set(self.windows(datetime.date(2018, 11, 1), datetime.datetime(2019, 3, 31))[1:])
+        later = set(self.windows(datetime.date(2018, 11, 1), datetime.datetime(2019, 6, 2))[1:])
+        self.assertEquals(len(earlier), 4)
+        self.assertTrue(earlier < later)
+
+    def test_same_month(self):
+        now = datetime.datetime(2019, 5, 20)
+        self.assertEquals(self.windows(None, now, latest_date=datetime.date(2019, 5, 10)),
+                          [(datetime.date(2019, 5, 8), now)])
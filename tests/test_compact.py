@@ -0,0 +1,91 @@
+import logging
+
+import ckan.model as model
+
+from fixtures import DatabaseTestCase, days_ago
+from ckanext.googleanalytics import backfill
+from ckanext.googleanalytics.accumulator import StatsAccumulator
+from ckanext.googleanalytics.commands import GACommand
+from ckanext.googleanalytics.compact import compact, retention_cutoff
+from ckanext.googleanalytics.model import PackageStats, ResourceStats, get_compacted_before
+
+
+class TestCompact(DatabaseTestCase):
+    def setUp(self):
+        super(TestCompact, self).setUp()
+        self.dataset = self.create_dataset('dataset')
+        self.resource = self.create_resource(self.dataset)
+        # Two years ago is compacted with a retention of one year, the last weeks are not
+        for days, visits, downloads in [(1, 5, 1), (10, 3, 0), (800, 100, 10), (810, 50, 5)]:
+            model.Session.add(PackageStats(package_id=self.dataset['id'], visit_date=days_ago(days), visits=visits,
+                                           entrances=0, downloads=downloads))
+        model.Session.add(PackageStats(package_id='purged', visit_date=days_ago(800), visits=1, entrances=0,
+                                       downloads=0))
+        for days, visits in [(1, 2), (800, 20)]:
+            model.Session.add(ResourceStats(resource_id=self.resource['id'], visit_date=days_ago(days), visits=visits))
+        model.Session.commit()
+
+    def totals(self):
+        model.Session.remove()
+        package_id = self.dataset['id']
+        return (PackageStats.get_all_visits(package_id),
+                PackageStats.get_all_visits_for_packages([package_id], num_days=30)[package_id],
+                ResourceStats.get_last_visits_by_dataset_id(package_id))
+
+    def test_totals_unchanged(self):
+        before = self.totals()
+        self.assertEquals((before[0]['count'], before[0]['download_count']), (158, 16))
+        self.assertEquals(before[2]['tot_visits'], 22)
+
+        counts = compact(retention_years=1)
+        self.assertEquals(counts['package_stats orphaned'], 1)
+        self.assertEquals(counts['package_stats folded'], 2)
+        self.assertEquals(counts['resource_stats folded'], 1)
+        self.assertEquals(self.totals(), before)
+        self.assertEquals(get_compacted_before(), retention_cutoff(1).date())
+        self.assertEquals(model.Session.query(PackageStats).count(), 2)
+
+        # Compacting again or with a longer retention changes nothing
+        compact(retention_years=1)
+        compact(retention_years=3)
+        self.assertEquals(self.totals(), before)
+        self.assertEquals(get_compacted_before(), retention_cutoff(1).date())
+
+    def test_save_skips_compacted(self):
+        compact(retention_years=1)
+        before = self.totals()
+
+        command = GACommand('googleanalytics')
+        command.log = logging.getLogger('ckanext.googleanalytics')
+        data = StatsAccumulator(('visits', 'entrances'))
+        data.add('dataset', days_ago(800).toordinal(), 100, 0)
+        data.add('dataset', days_ago(2).toordinal(), 7, 0)
+        command.save_type_package(data)
+        downloads = StatsAccumulator(('downloads',))
+        downloads.add(self.resource['id'], days_ago(800).toordinal(), 20)
+        command.save_type_resource(downloads)
+        model.Session.commit()
+
+        after = self.totals()
+        self.assertEquals(after[0]['count'], before[0]['count'] + 7)
+        self.assertEquals(after[2]['tot_visits'], before[2]['tot_visits'])
+
+    def test_backfill_skips_compacted(self):
+        compact(retention_years=1)
+        before = self.totals()
+
+        data = StatsAccumulator(('visits', 'entrances'))
+        for days, visits in [(1, 5), (10, 3), (800, 100), (810, 50)]:
+            data.add('dataset', days_ago(days).toordinal(), visits, 0)
+        staging = backfill.StagingTables()
+        staging.create()
+        try:
+            backfill.stage(staging, 'package', data)
+            backfill.merge_staging(staging, days_ago(900).date(), days_ago(1).date())
+        finally:
+            staging.drop()
+
+        # Only the daily rows were replaced, and the staged rows carry no downloads
+        after = self.totals()
+        self.assertEquals(after[0]['count'], before[0]['count'])
+        self.assertEquals(after[0]['download_count'], before[0]['download_count'] - 1)
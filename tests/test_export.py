@@ -0,0 +1,112 @@
+import json
+import datetime
+from unittest import TestCase
+
+import ckan.model as model
+
+from fixtures import DatabaseTestCase
+from ckanext.googleanalytics import export
+from ckanext.googleanalytics.model import PackageStats, ResourceStats
+
+COLUMNS = ['package_id', 'package_name', 'visit_date', 'visits']
+ROWS = [('id-%d' % i, u'n\xe4me-%d' % i, datetime.datetime(2019, 3, 1), i) for i in range(100)]
+
+
+class ChunkSizeTestCase(TestCase):
+    def setUp(self):
+        self.chunk_size = export.CHUNK_SIZE
+        export.CHUNK_SIZE = 100
+
+    def tearDown(self):
+        export.CHUNK_SIZE = self.chunk_size
+
+
+class TestCsvChunks(ChunkSizeTestCase):
+    def test_chunks(self):
+        chunks = list(export.csv_chunks(COLUMNS, ROWS))
+        self.assertEquals(chunks[0], 'package_id,package_name,visit_date,visits\n')
+        self.assertTrue(len(chunks) > 2)
+        self.assertTrue(all(len(chunk) <= export.CHUNK_SIZE for chunk in chunks))
+
+        lines = ''.join(chunks).splitlines()
+        self.assertEquals(len(lines), 101)
+        self.assertEquals(lines[1], 'id-0,n\xc3\xa4me-0,2019-03-01T00:00:00,0')
+        self.assertEquals(lines[-1], 'id-99,n\xc3\xa4me-99,2019-03-01T00:00:00,99')
+
+    def test_no_rows(self):
+        self.assertEquals(list(export.csv_chunks(COLUMNS, [])), ['package_id,package_name,visit_date,visits\n'])
+
+
+class TestNdjsonChunks(ChunkSizeTestCase):
+    def test_chunks(self):
+        chunks = list(export.ndjson_chunks(COLUMNS, ROWS))
+        self.assertTrue(len(chunks) > 2)
+        # Chunks end on whole lines
+        self.assertTrue(all(chunk.endswith('\n') for chunk in chunks))
+
+        records = [json.loads(line) for line in ''.join(chunks).splitlines()]
+        self.assertEquals(len(records), 100)
+        self.assertEquals(records[1], {'package_id': 'id-1', 'package_name': u'n\xe4me-1',
+                                       'visit_date': '2019-03-01T00:00:00', 'visits': 1})
+
+    def test_no_rows(self):
+        self.assertEquals(list(export.ndjson_chunks(COLUMNS, [])), [])
+
+
+class TestJsonChunks(ChunkSizeTestCase):
+    def test_chunks(self):
+        chunks = list(export.json_chunks(COLUMNS, ROWS))
+        self.assertTrue(len(chunks) > 2)
+        records = json.loads(''.join(chunks))
+        self.assertEquals(len(records), 100)
+        self.assertEquals(records[99]['package_name'], u'n\xe4me-99')
+
+    def test_no_rows(self):
+        self.assertEquals(json.loads(''.join(export.json_chunks(COLUMNS, []))), [])
+
+
+class TestExportQuery(DatabaseTestCase):
+    def setUp(self):
+        super(TestExportQuery, self).setUp()
+        self.dataset_a = self.create_dataset('dataset-a', title='Dataset A')
+        self.dataset_b = self.create_dataset('dataset-b', title='Dataset B')
+        self.resource = self.create_resource(self.dataset_a, name='Resource')
+        for day in (1, 2, 3):
+            for dataset in (self.dataset_a, self.dataset_b):
+                model.Session.add(PackageStats(package_id=dataset['id'], visit_date=datetime.datetime(2019, 3, day),
+                                               visits=day, entrances=0, downloads=0))
+            model.Session.add(ResourceStats(resource_id=self.resource['id'],
+                                            visit_date=datetime.datetime(2019, 3, day), visits=day * 10))
+        model.Session.commit()
+
+    def records(self, kind, **kwargs):
+        return [json.loads(line) for line in ''.join(export.export_chunks(kind, 'ndjson', **kwargs)).splitlines()]
+
+    def test_package(self):
+        columns, query = export.export_query('package')
+        self.assertEquals(columns, ['package_id', 'package_name', 'package_title', 'visit_date', 'visits',
+                                    'entrances', 'downloads'])
+        records = self.records('package', start_date=datetime.date(2019, 3, 2), end_date=datetime.date(2019, 3, 3))
+        self.assertEquals(sorted((record['package_name'], record['package_title'], record['visit_date'],
+                                  record['visits']) for record in records),
+                          [('dataset-a', 'Dataset A', '2019-03-02T00:00:00', 2),
+                           ('dataset-a', 'Dataset A', '2019-03-03T00:00:00', 3),
+                           ('dataset-b', 'Dataset B', '2019-03-02T00:00:00', 2),
+                           ('dataset-b', 'Dataset B', '2019-03-03T00:00:00', 3)])
+        keys = [(record['visit_date'], record['package_id']) for record in records]
+        self.assertEquals(keys, sorted(keys))
+
+    def test_package_filter(self):
+        records = self.records('package', package_id=self.dataset_b['id'])
+        self.assertEquals([record['visits'] for record in records], [1, 2, 3])
+        self.assertEquals(set(record['package_id'] for record in records), set([self.dataset_b['id']]))
+
+    def test_resource(self):
+        lines = ''.join(export.export_chunks('resource', 'csv', start_date=datetime.date(2019, 3, 3))).splitlines()
+        self.assertEquals(lines, ['resource_id,resource_name,package_id,package_name,visit_date,visits',
+                                  '%s,Resource,%s,dataset-a,2019-03-03T00:00:00,30' % (self.resource['id'],
+                                                                                       self.dataset_a['id'])])
+
+    def test_unknown(self):
+        self.assertRaises(ValueError, export.export_query, 'organization')
+        self.assertRaises(ValueError, export.export_chunks, 'package', 'xml')
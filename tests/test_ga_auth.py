@@ -0,0 +1,96 @@
+import shutil
+import tempfile
+from unittest import TestCase
+
+from pylons import config
+
+from ckanext.googleanalytics import ga_auth, ga_fake
+
+CONFIG_KEYS = ('googleanalytics.service', 'googleanalytics.service.recorded_dir',
+               'googleanalytics.service.record_dir', 'googleanalytics.service.rows_per_day',
+               'googleanalytics.account', 'googleanalytics.id', 'googleanalytics.profile_id',
+               'googleanalytics.metadata_cache.dir', 'googleanalytics.metadata_cache.ttl')
+
+
+class ConfigTestCase(TestCase):
+    def setUp(self):
+        self.config = dict((key, config.get(key)) for key in CONFIG_KEYS)
+        for key in CONFIG_KEYS:
+            config.pop(key, None)
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        for key, value in self.config.items():
+            if value is None:
+                config.pop(key, None)
+            else:
+                config[key] = value
+
+
+class TestCreateService(ConfigTestCase):
+    def setUp(self):
+        super(TestCreateService, self).setUp()
+        self.init_service = ga_auth.init_service
+        ga_auth.init_service = lambda credentials_file: ga_fake.FakeService(ga_fake.SyntheticResponses(1))
+
+    def tearDown(self):
+        ga_auth.init_service = self.init_service
+        super(TestCreateService, self).tearDown()
+
+    def test_default_is_google(self):
+        service = ga_auth.create_service('credentials.json')
+        self.assertTrue(isinstance(service.source, ga_fake.SyntheticResponses))
+        config['googleanalytics.service.record_dir'] = self.directory
+        self.assertTrue(isinstance(ga_auth.create_service('credentials.json'), ga_fake.RecordingService))
+
+    def test_synthetic_from_config(self):
+        config['googleanalytics.service'] = 'synthetic'
+        config['googleanalytics.service.rows_per_day'] = '3'
+        config['googleanalytics.account'] = 'Account'
+        service = ga_auth.create_service(None)
+        self.assertTrue(isinstance(service.source, ga_fake.SyntheticResponses))
+        self.assertEquals(service.source.rows_per_day, 3)
+        self.assertEquals(service.account_name, 'Account')
+        # Command line options win over the config
+        self.assertEquals(ga_auth.create_service(None, rows_per_day=7).source.rows_per_day, 7)
+
+    def test_recorded_from_arguments(self):
+        config['googleanalytics.service'] = 'synthetic'
+        service = ga_auth.create_service(None, service_name='recorded', recorded_dir=self.directory)
+        self.assertTrue(isinstance(service.source, ga_fake.RecordedResponses))
+        self.assertRaises(ValueError, ga_auth.create_service, None, service_name='recorded')
+
+    def test_unknown(self):
+        self.assertRaises(ValueError, ga_auth.create_service, None, service_name='live')
+
+
+class TestGetProfileId(ConfigTestCase):
+    def setUp(self):
+        super(TestGetProfileId, self).setUp()
+        config['googleanalytics.metadata_cache.dir'] = self.directory
+        config['googleanalytics.account'] = 'Account'
+        config['googleanalytics.id'] = 'UA-1'
+        self.service = ga_fake.FakeService(ga_fake.SyntheticResponses(1), account_name='Account',
+                                           web_property_id='UA-1')
+
+    def test_lookup(self):
+        self.assertEquals(ga_auth.get_profile_id(self.service), ga_fake.FAKE_PROFILE_ID)
+        self.assertEquals(ga_auth.metadata_cache().get('profile_id:FakeService:Account:UA-1'),
+                          ga_fake.FAKE_PROFILE_ID)
+
+    def test_override(self):
+        config['googleanalytics.profile_id'] = '1234'
+        self.assertEquals(ga_auth.get_profile_id(self.service), '1234')
+        self.assertEquals(ga_auth.metadata_cache().get('profile_id:FakeService:Account:UA-1'), None)
+
+    def test_cache_hit(self):
+        ga_auth.metadata_cache().set('profile_id:FakeService:Account:UA-1', '42')
+        # The accounts of the service are not looked at
+        self.service.account_name = 'Other account'
+        self.assertEquals(ga_auth.get_profile_id(self.service), '42')
+
+    def test_no_matching_account(self):
+        self.service.account_name = 'Other account'
+        self.assertEquals(ga_auth.get_profile_id(self.service), None)
+        self.assertEquals(ga_auth.metadata_cache().get('profile_id:FakeService:Account:UA-1'), None)
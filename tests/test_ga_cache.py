@@ -0,0 +1,71 @@
+import os
+import time
+import shutil
+import datetime
+import tempfile
+from unittest import TestCase
+
+from ckanext.googleanalytics.ga_cache import ResponseCache, MetadataCache
+
+
+class TestResponseCache(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_settled_windows(self):
+        cache = ResponseCache(self.directory, settle_hours=48)
+        now = datetime.datetime(2019, 3, 10, 12)
+        self.assertTrue(cache.is_settled(datetime.date(2019, 3, 7), now=now))
+        self.assertFalse(cache.is_settled(datetime.date(2019, 3, 8), now=now))
+        self.assertFalse(cache.is_settled(datetime.datetime(2019, 3, 10), now=now))
+
+    def test_get_set(self):
+        cache = ResponseCache(self.directory)
+        key = cache.key(filters='ga:pagePath=~/dataset/', start_date='2019-03-01')
+        self.assertEquals(cache.get(key), None)
+        cache.set(key, {'rows': [['/dataset/a', '1']]})
+        self.assertEquals(cache.get(key), {'rows': [['/dataset/a', '1']]})
+        self.assertNotEquals(key, cache.key(filters='ga:pagePath=~/dataset/', start_date='2019-03-02'))
+
+    def test_size(self):
+        cache = ResponseCache(self.directory)
+        key = cache.key(i=0)
+        cache.set(key, {'rows': [['a']]})
+        self.assertEquals(cache.size(), os.path.getsize(cache._path(key)))
+        cache.set(key, {'rows': [['a'] * 100]})
+        cache.set(cache.key(i=1), {'rows': []})
+        expected = os.path.getsize(cache._path(key)) + os.path.getsize(cache._path(cache.key(i=1)))
+        self.assertEquals(cache.size(), expected)
+        self.assertEquals(ResponseCache(self.directory).size(), expected)
+
+    def test_evicts_least_recently_used(self):
+        cache = ResponseCache(self.directory)
+        keys = [cache.key(i=i) for i in range(3)]
+        for i, key in enumerate(keys):
+            cache.set(key, {'rows': [[os.urandom(100).encode('hex')]]})
+            os.utime(cache._path(key), (i, i))
+        # Compressed sizes vary, so the limit is just above what is there before the next response
+        cache.max_size = cache.size() + 1
+        cache.set(cache.key(i=3), {'rows': [[os.urandom(100).encode('hex')]]})
+        self.assertEquals(cache.get(keys[0]), None)
+        self.assertTrue(cache.size() <= cache.max_size)
+
+
+class TestMetadataCache(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_expires(self):
+        cache = MetadataCache(os.path.join(self.directory, 'metadata'), ttl=60)
+        self.assertEquals(cache.get(u'profile_id:\xe4'), None)
+        cache.set(u'profile_id:\xe4', u'12345')
+        self.assertEquals(cache.get(u'profile_id:\xe4'), u'12345')
+        path = cache._path(u'profile_id:\xe4')
+        os.utime(path, (time.time() - 120, time.time() - 120))
+        self.assertEquals(cache.get(u'profile_id:\xe4'), None)
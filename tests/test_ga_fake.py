@@ -0,0 +1,74 @@
+import os
+import json
+import shutil
+import tempfile
+from unittest import TestCase
+
+from ckanext.googleanalytics.ga_fake import FakeService, RecordedResponses, RecordingService, SyntheticResponses, \
+    query_key
+
+QUERY = {
+    'filters': 'ga:pagePath=~/dataset/',
+    'metrics': 'ga:uniquePageviews',
+    'dimensions': 'ga:pagePath, ga:date',
+}
+
+
+class RecordingTestCase(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def record(self, start_date, end_date, rows):
+        path = os.path.join(self.directory, '%s_%s_%s.json' % (
+            query_key(QUERY['filters'], QUERY['metrics'], QUERY['dimensions']), start_date, end_date))
+        with open(path, 'w') as f:
+            json.dump({'rows': rows, 'totalResults': len(rows)}, f)
+
+
+class TestRecordedResponses(RecordingTestCase):
+    def setUp(self):
+        super(TestRecordedResponses, self).setUp()
+        self.record('2019-03-01', '2019-03-02', [['/dataset/a', '20190301', '1'], ['/dataset/a', '20190302', '2']])
+        self.record('2019-03-02', '2019-03-03', [['/dataset/a', '20190302', '5'], ['/dataset/b', '20190303', '3']])
+
+    def test_recorded_window(self):
+        responses = RecordedResponses(self.directory)
+        response = responses.get(start_date='2019-03-01', end_date='2019-03-02', **QUERY)
+        self.assertEquals(response['rows'], [['/dataset/a', '20190301', '1'], ['/dataset/a', '20190302', '2']])
+
+    def test_other_windows(self):
+        responses = RecordedResponses(self.directory)
+        # Rows of all recordings of the query, the later recording of a cell wins
+        response = responses.get(start_date='2019-03-02', end_date='2019-03-05', **QUERY)
+        self.assertEquals(response, {'rows': [['/dataset/a', '20190302', '5'], ['/dataset/b', '20190303', '3']],
+                                     'totalResults': 2})
+        self.assertEquals(responses.get(start_date='2019-04-01', end_date='2019-04-02', **QUERY),
+                          {'totalResults': 0})
+
+    def test_other_queries(self):
+        responses = RecordedResponses(self.directory)
+        self.assertEquals(responses.get(start_date='2019-03-01', end_date='2019-03-02', filters=QUERY['filters'],
+                                        metrics='ga:entrances', dimensions=QUERY['dimensions']),
+                          {'totalResults': 0})
+
+    def test_missing_directory(self):
+        self.assertRaises(ValueError, RecordedResponses, os.path.join(self.directory, 'missing'))
+
+
+class TestRecordingService(RecordingTestCase):
+    def test_round_trip(self):
+        live = FakeService(SyntheticResponses(rows_per_day=5), account_name='Account', web_property_id='UA-1')
+        recording = RecordingService(live, os.path.join(self.directory, 'recorded'))
+        recorded = recording.data().ga().get(start_date='2019-03-01', end_date='2019-03-07', **QUERY).execute()
+        self.assertEquals(len(recorded['rows']), 35)
+        self.assertEquals(recording.management().accounts().list().execute()['items'][0]['name'], 'Account')
+
+        replay = FakeService(RecordedResponses(os.path.join(self.directory, 'recorded')))
+        self.assertEquals(replay.data().ga().get(start_date='2019-03-01', end_date='2019-03-07', **QUERY).execute(),
+                          recorded)
+        rows = replay.data().ga().get(start_date='2019-03-03', end_date='2019-03-04', **QUERY).execute()['rows']
+        self.assertTrue(rows)
+        self.assertEquals(set(row[1] for row in rows), set(['20190303', '20190304']))
@@ -0,0 +1,132 @@
+from datetime import date, datetime
+
+import ckan.model as model
+
+from fixtures import DatabaseTestCase
+from ckanext.googleanalytics import backfill
+from ckanext.googleanalytics.accumulator import StatsAccumulator
+from ckanext.googleanalytics.bulkload import BulkLoader
+from ckanext.googleanalytics.model import AudienceLocationDate, AudienceLocationTotals
+
+VISITS = [('Finland', datetime(2019, 1, 10), 100),
+          ('Finland', datetime(2019, 2, 5), 50),
+          ('Sweden', datetime(2019, 2, 6), 30),
+          ('Finland', datetime(2019, 3, 3), 20),
+          ('Sweden', datetime(2019, 3, 4), 10),
+          ('Norway', datetime(2019, 3, 5), 5)]
+
+
+class LocationTestCase(DatabaseTestCase):
+    def add_location_visits(self, rows):
+        for location_name, visit_date, visits in rows:
+            AudienceLocationDate.update_visits(location_name, visit_date, visits)
+        model.Session.commit()
+
+    @staticmethod
+    def accumulator(rows):
+        data = StatsAccumulator(('visits',), merge='replace')
+        for location_name, visit_date, visits in rows:
+            data.add(location_name, visit_date.toordinal(), visits)
+        return data
+
+
+class TestLocationReport(LocationTestCase):
+    def setUp(self):
+        super(TestLocationReport, self).setUp()
+        self.add_location_visits(VISITS)
+
+    def test_report(self):
+        months_start, months_end = datetime(2019, 2, 1), datetime(2019, 3, 31)
+        report = AudienceLocationDate.get_location_report('Finland', datetime(2019, 3, 1), datetime(2019, 3, 31),
+                                                          months_start, months_end, limit=2)
+
+        self.assertEquals(report['first_date'], datetime(2019, 1, 10))
+        self.assertEquals([(location['location_name'], location['total_visits'], location['percent_visits'])
+                           for location in report['top_locations']],
+                          [('Finland', 170, 100.0 * 170 / 215), ('Sweden', 40, 100.0 * 40 / 215),
+                           ('Other', 5, 100.0 * 5 / 215)])
+        self.assertEquals(report['home_vs_world_all'], [{'location_name': 'Finland', 'total_visits': 170},
+                                                        {'location_name': 'Other', 'total_visits': 45}])
+        self.assertEquals(report['home_vs_world_window'], [{'location_name': 'Finland', 'total_visits': 20},
+                                                           {'location_name': 'Other', 'total_visits': 15}])
+        self.assertEquals(report['home_vs_world_window'],
+                          AudienceLocationDate.special_total_location_to_rest(datetime(2019, 3, 1),
+                                                                              datetime(2019, 3, 31), 'Finland'))
+
+        self.assertEquals(report['sessions_by_month'],
+                          AudienceLocationDate.special_total_by_months(months_start, months_end))
+        self.assertEquals([(month['combined_date'], month['visits']) for month in report['sessions_by_month']],
+                          [('2-2019', 80), ('3-2019', 35)])
+        self.assertEquals(report['sessions_by_month_all'],
+                          AudienceLocationDate.special_total_by_months(datetime(2000, 1, 1), months_end))
+        self.assertEquals([(month['combined_date'], month['date']) for month in report['sessions_by_month_all']],
+                          [('1-2019', '2019-01-10 00:00:00'), ('2-2019', '2019-02-06 00:00:00'),
+                           ('3-2019', '2019-03-05 00:00:00')])
+
+    def test_top_locations_match_old_query(self):
+        report = AudienceLocationDate.get_location_report('Finland', datetime(2019, 3, 1), datetime(2019, 3, 31),
+                                                          datetime(2019, 2, 1), datetime(2019, 3, 31))
+        self.assertEquals(report['top_locations'], AudienceLocationDate.get_total_top_locations())
+        self.assertEquals(report['top_locations'][-1], {'location_name': 'Other', 'total_visits': 0,
+                                                        'percent_visits': 0.0})
+
+    def test_empty(self):
+        model.Session.execute('TRUNCATE audience_location_totals, audience_location_date')
+        report = AudienceLocationDate.get_location_report('Finland', datetime(2019, 3, 1), datetime(2019, 3, 31),
+                                                          datetime(2019, 2, 1), datetime(2019, 3, 31))
+        self.assertEquals(report['first_date'], None)
+        self.assertEquals(report['top_locations'], [{'location_name': 'Other', 'total_visits': 0,
+                                                     'percent_visits': 0.0}])
+        self.assertEquals(report['sessions_by_month_all'], [])
+
+
+class TestLocationTotals(LocationTestCase):
+    """
+    Every way of writing audience_location_date keeps the totals equal to
+    what rebuild computes from scratch
+    """
+
+    def setUp(self):
+        super(TestLocationTotals, self).setUp()
+        self.add_location_visits(VISITS)
+
+    def assert_matches_rebuild(self):
+        totals = AudienceLocationTotals.get_all()
+        AudienceLocationTotals.rebuild()
+        model.Session.commit()
+        self.assertEquals(AudienceLocationTotals.get_all(), totals)
+        return dict((location['location_name'], location['total_visits']) for location in totals)
+
+    def test_update_visits(self):
+        self.assertEquals(self.assert_matches_rebuild(), {'Finland': 170, 'Sweden': 40, 'Norway': 5})
+        self.add_location_visits([('Finland', datetime(2019, 2, 5), 70), ('Denmark', datetime(2019, 3, 6), 8)])
+        self.assertEquals(self.assert_matches_rebuild(), {'Finland': 190, 'Sweden': 40, 'Norway': 5, 'Denmark': 8})
+
+    def test_bulk_load(self):
+        BulkLoader(model.Session).save_location_visits(self.accumulator([('Finland', date(2019, 2, 5), 70),
+                                                                         ('Denmark', date(2019, 3, 6), 8)]))
+        model.Session.commit()
+        self.assertEquals(self.assert_matches_rebuild(), {'Finland': 190, 'Sweden': 40, 'Norway': 5, 'Denmark': 8})
+
+    def backfill(self, rows, start_date, end_date):
+        staging = backfill.StagingTables()
+        staging.create()
+        try:
+            backfill.stage(staging, 'visitorlocation', self.accumulator(rows))
+            backfill.merge_staging(staging, start_date, end_date)
+        finally:
+            staging.drop()
+
+    def test_backfill(self):
+        self.backfill([('Finland', date(2019, 2, 5), 60), ('Sweden', date(2019, 2, 6), 35),
+                       ('Sweden', date(2019, 2, 20), 2)], date(2019, 2, 1), date(2019, 2, 28))
+        self.assertEquals(self.assert_matches_rebuild(), {'Finland': 180, 'Sweden': 47, 'Norway': 5})
+
+    def test_backfill_removes_days(self):
+        # Finland's first day and all of Norway's visits are gone after the backfill
+        self.backfill([('Sweden', date(2019, 1, 20), 4)], date(2019, 1, 1), date(2019, 1, 31))
+        self.backfill([], date(2019, 3, 5), date(2019, 3, 5))
+        self.assertEquals(self.assert_matches_rebuild(), {'Finland': 70, 'Sweden': 44})
+        totals = dict((location['location_name'], location) for location in AudienceLocationTotals.get_all())
+        self.assertEquals(totals['Finland']['first_date'], datetime(2019, 2, 5))
+        self.assertEquals(totals['Sweden']['first_date'], datetime(2019, 1, 20))
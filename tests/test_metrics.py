@@ -0,0 +1,142 @@
+import os
+import json
+import shutil
+import datetime
+import tempfile
+from unittest import TestCase
+
+from sqlalchemy import create_engine
+
+from ckanext.googleanalytics.metrics import IngestMetrics, TrackingMetrics, LatencyHistogram, percentile, timed
+
+
+class TestPercentile(TestCase):
+    def test_nearest_rank(self):
+        values = range(1, 101)
+        self.assertEquals(percentile(values, 50), 50)
+        self.assertEquals(percentile(values, 99), 99)
+        self.assertEquals(percentile(values, 100), 100)
+        self.assertEquals(percentile([7], 90), 7)
+        self.assertEquals(percentile([], 50), None)
+
+
+class TestTrackingMetrics(TestCase):
+    def test_keeps_latest_samples(self):
+        histogram = LatencyHistogram(2)
+        for seconds in (0.5, 0.001, 0.002):
+            histogram.add(seconds)
+        summary = histogram.summary()
+        self.assertEquals(summary['count'], 3)
+        self.assertEquals(summary['max_ms'], 2.0)
+        self.assertEquals(summary['p50_ms'], 1.0)
+
+    def test_summary_by_logic_function(self):
+        metrics = TrackingMetrics(max_samples=10)
+        metrics.record_overhead('package_show', 0.001)
+        metrics.record_overhead('package_show', 0.003)
+        metrics.record_queue_wait('package_search', 0.25)
+        summary = metrics.summary()
+        self.assertEquals(summary['overhead'].keys(), ['package_show'])
+        self.assertEquals(summary['overhead']['package_show']['count'], 2)
+        self.assertEquals(summary['overhead']['package_show']['max_ms'], 3.0)
+        self.assertEquals(summary['queue_wait']['package_search']['p99_ms'], 250.0)
+        self.assertEquals(summary['queue_wait'].get('package_show'), None)
+
+    def test_empty_summary(self):
+        self.assertEquals(TrackingMetrics().summary(), {'overhead': {}, 'queue_wait': {}})
+
+
+class TestIngestMetrics(TestCase):
+    def setUp(self):
+        self.engine = create_engine('sqlite://')
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def ingest(self, metrics):
+        """Two windows and a save of one query type, like GACommand.run_query"""
+        record = metrics.query('package')
+        for start_date, end_date in [(datetime.date(2019, 3, 1), datetime.date(2019, 3, 10)),
+                                     (datetime.date(2019, 2, 1), datetime.date(2019, 3, 1))]:
+            window = metrics.window(record, start_date, end_date)
+            with timed(window, 'fetch_seconds'):
+                window['rows'] = 3
+            with timed(window, 'resolve_seconds'):
+                pass
+            metrics.add_window_totals(record, window)
+        with metrics.count_statements(record):
+            with timed(record, 'save_seconds'):
+                self.engine.execute('SELECT 1')
+                self.engine.execute('SELECT 2')
+            metrics.sample_memory(record)
+        metrics.finish_query(record)
+        return record
+
+    def test_records(self):
+        metrics = IngestMetrics(self.engine)
+        with metrics.run():
+            self.engine.execute('SELECT 0')
+            record = self.ingest(metrics)
+        self.engine.execute('SELECT 3')
+
+        self.assertEquals(record['rows'], 6)
+        self.assertEquals(record['db_statements'], 2)
+        self.assertEquals(metrics.statements, 3)
+        self.assertEquals([(window['start_date'], window['end_date'], window['rows']) for window in record['windows']],
+                          [('2019-03-01', '2019-03-10', 3), ('2019-02-01', '2019-03-01', 3)])
+        self.assertTrue(record['save_seconds'] >= 0)
+        if os.path.exists('/proc/self/statm'):
+            self.assertTrue(record['peak_memory_bytes'] > 0)
+            self.assertTrue(all(record['peak_memory_bytes'] >= window['memory_bytes']
+                                for window in record['windows']))
+
+        data = metrics.as_dict()
+        self.assertTrue(data['succeeded'])
+        self.assertEquals(data['db_statements'], 3)
+        self.assertEquals(data['queries'], [record])
+        self.assertTrue(data['duration_seconds'] >= 0)
+
+    def test_prometheus(self):
+        metrics = IngestMetrics()
+        with metrics.run():
+            self.ingest(metrics)
+        lines = metrics.as_prometheus().splitlines()
+        self.assertTrue('# HELP ckanext_googleanalytics_ingest_rows Rows received from the Google Analytics API'
+                        in lines)
+        self.assertTrue('# TYPE ckanext_googleanalytics_ingest_rows gauge' in lines)
+        self.assertTrue('ckanext_googleanalytics_ingest_rows{type="package"} 6' in lines)
+        self.assertTrue('ckanext_googleanalytics_ingest_success 1' in lines)
+        self.assertTrue([line for line in lines if line.startswith('ckanext_googleanalytics_ingest_last_run_'
+                                                                     'timestamp_seconds ')])
+        # Every sample line follows its HELP and TYPE lines
+        for line in lines:
+            if not line.startswith('#'):
+                name = line.split('{')[0].split(' ')[0]
+                self.assertTrue('# TYPE %s gauge' % name in lines)
+
+    def test_failed_ingest(self):
+        metrics = IngestMetrics()
+        try:
+            with metrics.run():
+                metrics.query('package')
+                raise RuntimeError()
+        except RuntimeError:
+            pass
+        self.assertFalse(metrics.succeeded)
+        self.assertTrue('ckanext_googleanalytics_ingest_success 0' in metrics.as_prometheus().splitlines())
+
+    def test_write_files(self):
+        metrics = IngestMetrics()
+        with metrics.run():
+            self.ingest(metrics)
+        json_path = os.path.join(self.directory, 'ingest.json')
+        prometheus_path = os.path.join(self.directory, 'ingest.prom')
+        metrics.write_json(json_path)
+        metrics.write_prometheus(prometheus_path)
+        # Nothing but the finished files is left behind
+        self.assertEquals(sorted(os.listdir(self.directory)), ['ingest.json', 'ingest.prom'])
+        with open(json_path) as f:
+            self.assertEquals(json.load(f)['queries'][0]['rows'], 6)
+        with open(prometheus_path) as f:
+            self.assertEquals(f.read(), metrics.as_prometheus())
@@ -0,0 +1,93 @@
+from unittest import TestCase
+
+from ckanext.googleanalytics.middleware import AnalyticsCacheMiddleware
+
+LAST_INGEST = 1552212000
+
+
+class FakeApp(object):
+    def __init__(self):
+        self.calls = 0
+
+    def __call__(self, environ, start_response):
+        self.calls += 1
+        start_response('200 OK', [('Content-Type', 'application/json'), ('Cache-Control', 'no-cache')])
+        return ['{}']
+
+
+class TestAnalyticsCacheMiddleware(TestCase):
+    def setUp(self):
+        self.app = FakeApp()
+        self.report_generated = {'google-analytics-dataset': LAST_INGEST - 60}
+        self.middleware = AnalyticsCacheMiddleware(self.app, max_age=60, last_ingest=lambda: LAST_INGEST,
+                                                   report_generated=self.report_generated.get)
+
+    def request(self, path, **environ):
+        environ.update({'REQUEST_METHOD': 'GET', 'PATH_INFO': path})
+        response = {}
+
+        def start_response(status, headers, exc_info=None):
+            response['status'] = status
+            response['headers'] = dict(headers)
+
+        self.middleware(environ, start_response)
+        return response
+
+    def test_adds_validators(self):
+        response = self.request('/api/3/action/googleanalytics_dataset_visits')
+        self.assertEquals(response['status'], '200 OK')
+        self.assertEquals(response['headers']['Cache-Control'], 'public, max-age=60')
+        self.assertEquals(response['headers']['Last-Modified'], 'Sun, 10 Mar 2019 10:00:00 GMT')
+
+    def test_not_modified(self):
+        etag = self.request('/fi/report/google-analytics-dataset')['headers']['ETag']
+        response = self.request('/fi/report/google-analytics-dataset', HTTP_IF_NONE_MATCH=etag)
+        self.assertEquals(response['status'], '304 Not Modified')
+        response = self.request('/report/google-analytics-dataset',
+                                HTTP_IF_MODIFIED_SINCE='Sun, 10 Mar 2019 10:00:00 GMT')
+        self.assertEquals(response['status'], '304 Not Modified')
+        self.assertEquals(self.app.calls, 1)
+
+    def test_logged_in(self):
+        etag = self.request('/report/google-analytics-dataset')['headers']['ETag']
+        response = self.request('/report/google-analytics-dataset', HTTP_IF_NONE_MATCH=etag,
+                                HTTP_COOKIE='auth_tkt=abc')
+        self.assertEquals(response['status'], '200 OK')
+        self.assertEquals(response['headers']['Cache-Control'], 'private, max-age=0, must-revalidate')
+
+    def test_per_user(self):
+        path = '/report/google-analytics-dataset'
+        etag = self.request(path, HTTP_COOKIE='ckan=x; auth_tkt="abc!userid_type:unicode"')['headers']['ETag']
+        response = self.request(path, HTTP_IF_NONE_MATCH=etag, HTTP_COOKIE='auth_tkt="abc!userid_type:unicode"')
+        self.assertEquals(response['status'], '304 Not Modified')
+        response = self.request(path, HTTP_IF_NONE_MATCH=etag, HTTP_COOKIE='auth_tkt=def')
+        self.assertEquals(response['status'], '200 OK')
+        response = self.request(path, HTTP_IF_NONE_MATCH=etag, HTTP_X_CKAN_API_KEY='key')
+        self.assertEquals(response['status'], '200 OK')
+        # The date of a copy doesn't tell whose it is
+        response = self.request(path, HTTP_IF_MODIFIED_SINCE='Sun, 10 Mar 2019 10:00:00 GMT',
+                                HTTP_COOKIE='auth_tkt=def')
+        self.assertEquals(response['status'], '200 OK')
+
+    def test_report_regenerated(self):
+        response = self.request('/report/google-analytics-dataset')
+        self.assertEquals(response['headers']['Last-Modified'], 'Sun, 10 Mar 2019 10:00:00 GMT')
+        etag = response['headers']['ETag']
+
+        self.report_generated['google-analytics-dataset'] = LAST_INGEST + 3600
+        response = self.request('/report/google-analytics-dataset', HTTP_IF_NONE_MATCH=etag)
+        self.assertEquals(response['status'], '200 OK')
+        self.assertEquals(response['headers']['Last-Modified'], 'Sun, 10 Mar 2019 11:00:00 GMT')
+        response = self.request('/report/google-analytics-dataset',
+                                HTTP_IF_MODIFIED_SINCE='Sun, 10 Mar 2019 10:00:00 GMT')
+        self.assertEquals(response['status'], '200 OK')
+
+    def test_report_not_generated(self):
+        response = self.request('/report/google-analytics-resource')
+        self.assertEquals(response['headers']['Cache-Control'], 'no-cache')
+        self.assertFalse('ETag' in response['headers'])
+
+    def test_other_paths(self):
+        response = self.request('/api/3/action/googleanalytics_tracking_stats')
+        self.assertEquals(response['headers']['Cache-Control'], 'no-cache')
+        self.assertFalse('ETag' in response['headers'])
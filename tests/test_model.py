@@ -0,0 +1,125 @@
+import ckan.model as model
+
+from fixtures import DatabaseTestCase, days_ago
+from ckanext.googleanalytics.model import PackageStats, ResourceStats
+from ckanext.googleanalytics import reports
+from ckanext.googleanalytics.reports import PERIODS, last_calendar_period
+
+
+class StatsTestCase(DatabaseTestCase):
+    def add_package_stats(self, rows):
+        for package_id, days, visits in rows:
+            model.Session.add(PackageStats(package_id=package_id, visit_date=days_ago(days), visits=visits,
+                                           entrances=visits // 2, downloads=visits // 3))
+        model.Session.commit()
+
+
+class TestTotalVisitsByPeriods(StatsTestCase):
+    def setUp(self):
+        super(TestTotalVisitsByPeriods, self).setUp()
+        organization = self.create_organization()
+        self.datasets = [self.create_dataset('dataset-%d' % i, owner_org=organization['id']) for i in range(4)]
+        private = self.create_dataset('private', owner_org=organization['id'], private=True)
+        ids = [dataset['id'] for dataset in self.datasets]
+        self.add_package_stats([(ids[0], 1, 10), (ids[0], 20, 5), (ids[0], 200, 100),
+                                (ids[1], 3, 7), (ids[1], 300, 1),
+                                (ids[2], 40, 12),
+                                (ids[3], 1, 10),
+                                (private['id'], 1, 50)])
+
+    def test_matches_get_total_visits(self):
+        periods = dict((period, last_calendar_period(period)) for period in PERIODS)
+        results = PackageStats.get_total_visits_by_periods(periods)
+        self.assertEquals(sorted(results.keys()), sorted(PERIODS))
+
+        fields = ('package_id', 'package_name', 'visits', 'entrances', 'downloads')
+        for period, (start_date, end_date) in periods.items():
+            expected = PackageStats.get_total_visits(start_date, end_date, limit=None)
+            self.assertEquals(sorted(tuple(dataset[field] for field in fields) for dataset in results[period]),
+                              sorted(tuple(dataset[field] for field in fields) for dataset in expected))
+            visits = [dataset['visits'] for dataset in results[period]]
+            self.assertEquals(visits, sorted(visits, reverse=True))
+
+        self.assertEquals([dataset['visits'] for dataset in results['week']], [10, 10, 7])
+        self.assertEquals(len(results['year']), 4)
+        self.assertEquals(results['year'][0]['organization_name'], self.datasets[0]['organization']['name'])
+
+
+class TestResourceTop(StatsTestCase):
+    def test_ranks_by_days_with_downloads(self):
+        dataset = self.create_dataset('dataset')
+        busy = self.create_resource(dataset, description='Busy')
+        quiet = self.create_resource(dataset, format='CSV', description='')
+        deleted = self.create_resource(dataset)
+        for resource, days in [(busy, [1, 2, 3]), (quiet, [5]), (deleted, [1, 2, 3, 4])]:
+            for day in days:
+                model.Session.add(ResourceStats(resource_id=resource['id'], visit_date=days_ago(day), visits=1))
+        model.Resource.get(deleted['id']).state = 'deleted'
+        model.Session.commit()
+
+        resources = ResourceStats.get_top(limit=20)['resources']
+        self.assertEquals([(r['resource_id'], r['visits'], r['resource_name'], r['package_id']) for r in resources],
+                          [(busy['id'], 3, 'Busy', 'dataset'), (quiet['id'], 1, 'CSV', 'dataset')])
+        self.assertEquals(resources[0]['visit_date'], days_ago(1).strftime("%d-%m-%Y"))
+        self.assertEquals(len(ResourceStats.get_top(limit=1)['resources']), 1)
+
+
+class TestTotalVisitsPage(StatsTestCase):
+    def setUp(self):
+        super(TestTotalVisitsPage, self).setUp()
+        datasets = [self.create_dataset('dataset-%d' % i) for i in range(5)]
+        private = self.create_dataset('private', private=True)
+        # Three datasets tie on visits, so the package_id breaks the tie across page boundaries
+        visits = [5, 3, 3, 3, 1]
+        self.add_package_stats([(dataset['id'], 2, dataset_visits)
+                                for dataset, dataset_visits in zip(datasets, visits)] +
+                               [(datasets[4]['id'], 100, 50), (private['id'], 2, 10)])
+        self.expected = sorted((dataset_visits, dataset['id']) for dataset, dataset_visits in zip(datasets, visits))
+        self.start_date, self.end_date = days_ago(7), days_ago(0)
+
+    def pages(self, descending, page_size):
+        pages, after = [], None
+        while True:
+            datasets, after = PackageStats.get_total_visits_page(self.start_date, self.end_date, descending,
+                                                                 page_size, after)
+            pages.append([(dataset['visits'], dataset['package_id']) for dataset in datasets])
+            if after is None:
+                return pages
+
+    def test_descending(self):
+        pages = self.pages(True, 2)
+        self.assertEquals([len(page) for page in pages], [2, 2, 1])
+        self.assertEquals(sum(pages, []), self.expected[::-1])
+
+    def test_ascending(self):
+        pages = self.pages(False, 2)
+        self.assertEquals(sum(pages, []), self.expected)
+
+    def test_page_boundaries(self):
+        self.assertEquals(self.pages(True, 5), [self.expected[::-1]])
+        self.assertEquals(self.pages(True, 4), [self.expected[:0:-1], self.expected[:1]])
+
+    def test_matches_get_total_visits(self):
+        datasets, after = PackageStats.get_total_visits_page(self.start_date, self.end_date, page_size=20)
+        expected = PackageStats.get_total_visits(self.start_date, self.end_date, limit=None)
+        self.assertEquals(sorted(dataset['package_id'] for dataset in datasets),
+                          sorted(dataset['package_id'] for dataset in expected))
+        self.assertEquals(PackageStats.count_total_visits(self.start_date, self.end_date), 5)
+        self.assertEquals(PackageStats.count_total_visits(days_ago(200), days_ago(50)), 1)
+
+    def test_dataset_report(self):
+        report = reports.google_analytics_dataset_report('week')
+        self.assertEquals(sorted(report), ['top', 'total'])
+        self.assertEquals([(dataset['visits'], dataset['package_id']) for dataset in report['top']],
+                          self.expected[::-1])
+        self.assertEquals(report['total'], 5)
+
+    def test_dataset_table_rows(self):
+        page_size = reports.DOWNLOAD_PAGE_SIZE
+        reports.DOWNLOAD_PAGE_SIZE = 2
+        try:
+            rows = list(reports.dataset_table_rows('week', descending=False))
+        finally:
+            reports.DOWNLOAD_PAGE_SIZE = page_size
+        self.assertEquals([(row[2], row[0]) for row in rows], self.expected)
+        self.assertEquals(rows[0][1], 'dataset-4')
@@ -0,0 +1,36 @@
+import datetime
+from unittest import TestCase
+
+from ckanext.googleanalytics.parsing import parse_page_path, decode_ga_date
+
+
+class TestParsePagePath(TestCase):
+    def test_dataset_page(self):
+        self.assertEquals(parse_page_path('/dataset/annakarenina'), ('dataset', 'annakarenina', None))
+
+    def test_language_prefix_and_query_string(self):
+        self.assertEquals(parse_page_path('/fi/dataset/annakarenina?foo=1&bar=2'),
+                          ('dataset', 'annakarenina', None))
+        self.assertEquals(parse_page_path('/sv/dataset/annakarenina&foo=1'), ('dataset', 'annakarenina', None))
+
+    def test_resource_download(self):
+        self.assertEquals(parse_page_path('/dataset/annakarenina/resource/abc-123/download/file.csv'),
+                          ('resource', 'annakarenina', 'abc-123'))
+        self.assertEquals(parse_page_path('/dataset/annakarenina/resource/abc-123?x=1'),
+                          ('resource', 'annakarenina', 'abc-123'))
+
+    def test_malformed(self):
+        self.assertEquals(parse_page_path('/organization/foo'), None)
+        self.assertEquals(parse_page_path('/fi/dataset'), None)
+        self.assertEquals(parse_page_path('/dataset/'), None)
+
+
+class TestDecodeGaDate(TestCase):
+    def test_decode(self):
+        self.assertEquals(decode_ga_date('20190224'),
+                          (datetime.date(2019, 2, 24), datetime.date(2019, 2, 24).toordinal()))
+        self.assertEquals(decode_ga_date('20190224'), decode_ga_date('20190224'))
+
+    def test_invalid_date(self):
+        self.assertRaises(ValueError, decode_ga_date, '20190230')
+
@@ -0,0 +1,100 @@
+import time
+import Queue
+import random
+from unittest import TestCase
+
+from ckanext.googleanalytics.plugin import ApiActionSampler, EventAggregator, sample_weight
+
+
+def event(client='a', action='package_search', label='', **values):
+    data_dict = {'cid': client, 'ea': 'action' + action, 'el': label}
+    data_dict.update(values)
+    return data_dict
+
+
+class TestApiActionSampler(TestCase):
+    def test_allow_and_deny(self):
+        sampler = ApiActionSampler(allow=['package_show', 'status_show'], deny=['status_show'])
+        self.assertEquals(sampler.sample('package_show'), 1.0)
+        self.assertEquals(sampler.sample('status_show'), None)
+        self.assertEquals(sampler.sample('package_search'), None)
+
+    def test_sample_rates(self):
+        sampler = ApiActionSampler(default_rate=0.5, sample_rates={'package_search': 0.01})
+        self.assertEquals(sampler.sample_rate('package_show'), 0.5)
+        self.assertEquals(sampler.sample_rate('package_search'), 0.01)
+
+        random.seed(1)
+        sent = [sampler.sample('package_search') for _ in range(10000)]
+        self.assertEquals(set(sent), set([None, 0.01]))
+        self.assertTrue(50 < sent.count(0.01) < 150)
+
+    def test_zero_rate(self):
+        sampler = ApiActionSampler(sample_rates={'status_show': 0.0})
+        self.assertEquals(sampler.sample('status_show'), None)
+
+    def test_rejects_inexact_rates(self):
+        self.assertRaises(ValueError, ApiActionSampler, default_rate=0.3)
+        self.assertRaises(ValueError, ApiActionSampler, sample_rates={'package_search': 1.5})
+
+    def test_sample_weight(self):
+        self.assertEquals(sample_weight(1.0), 1)
+        self.assertEquals(sample_weight(0.25), 4)
+        self.assertEquals(sample_weight(0.1), 10)
+        self.assertEquals(sample_weight(0.01), 100)
+        self.assertRaises(ValueError, sample_weight, 0.3)
+        self.assertRaises(ValueError, sample_weight, 0.0)
+
+
+class TestEventAggregator(TestCase):
+    def setUp(self):
+        self.queue = Queue.Queue()
+        self.aggregator = EventAggregator(self.queue, 60)
+
+    def sent(self):
+        hits = []
+        while not self.queue.empty():
+            hits.append(self.queue.get_nowait())
+        return hits
+
+    def test_sums_event_values(self):
+        self.aggregator.add(event(), 'package_search')
+        self.aggregator.add(event(), 'package_search')
+        self.aggregator.add(event(ev=10), 'package_search')
+        self.aggregator.add(event(label='water'), 'package_search')
+        self.aggregator.add(event(client='b'), 'package_search')
+        self.assertEquals(self.sent(), [])
+
+        self.aggregator.flush()
+        hits = sorted((data_dict['cid'], data_dict['el'], data_dict['ev']) for data_dict, key, sent in self.sent())
+        self.assertEquals(hits, [('a', '', 12), ('a', 'water', 1), ('b', '', 1)])
+        self.assertEquals(self.aggregator.pending, {})
+
+        self.aggregator.flush()
+        self.assertEquals(self.sent(), [])
+
+    def test_queue_time(self):
+        self.aggregator.add(event(), 'package_search')
+        key = self.aggregator.pending.keys()[0]
+        data_dict, metric_key, first_seen = self.aggregator.pending[key]
+        self.aggregator.pending[key] = (data_dict, metric_key, first_seen - 2.5)
+
+        self.aggregator.flush()
+        (data_dict, metric_key, sent), = self.sent()
+        self.assertEquals(metric_key, 'package_search')
+        self.assertTrue(2500 <= data_dict['qt'] < 3500)
+        self.assertTrue(abs(sent - time.time()) < 1)
+
+    def test_flushes_when_full(self):
+        aggregator = EventAggregator(self.queue, 60, max_pending=2)
+        aggregator.add(event(label='1'), 'package_search')
+        aggregator.add(event(label='1'), 'package_search')
+        self.assertEquals(self.sent(), [])
+        aggregator.add(event(label='2'), 'package_search')
+        self.assertEquals(len(self.sent()), 2)
+        self.assertEquals(aggregator.pending, {})
+
+    def test_shutdown_sends_pending(self):
+        self.aggregator.add(event(), 'package_search')
+        self.aggregator.shutdown(timeout=0)
+        self.assertEquals(len(self.sent()), 1)
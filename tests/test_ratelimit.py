@@ -0,0 +1,87 @@
+import json
+from unittest import TestCase
+
+from ckanext.googleanalytics.ratelimit import RateScheduler, QuotaExceeded, is_retryable, is_rate_limited
+
+
+class FakeResponse(object):
+    def __init__(self, status):
+        self.status = status
+
+
+class FakeHttpError(Exception):
+    def __init__(self, status, reason=None):
+        super(FakeHttpError, self).__init__(status)
+        self.resp = FakeResponse(status)
+        self.content = json.dumps({'error': {'errors': [{'reason': reason}]}}) if reason else ''
+
+
+class FakeRequest(object):
+    def __init__(self, errors):
+        self.errors = list(errors)
+        self.calls = 0
+
+    def execute(self):
+        self.calls += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        return {'rows': []}
+
+
+class TestRateScheduler(TestCase):
+    def test_retryable_errors(self):
+        self.assertTrue(is_retryable(FakeHttpError(429)))
+        self.assertTrue(is_retryable(FakeHttpError(503)))
+        self.assertTrue(is_retryable(FakeHttpError(403, 'userRateLimitExceeded')))
+        self.assertFalse(is_retryable(FakeHttpError(403, 'dailyLimitExceeded')))
+        self.assertFalse(is_retryable(FakeHttpError(400)))
+        self.assertFalse(is_retryable(ValueError()))
+
+    def test_rate_limit_errors(self):
+        self.assertTrue(is_rate_limited(FakeHttpError(429)))
+        self.assertTrue(is_rate_limited(FakeHttpError(403, 'rateLimitExceeded')))
+        self.assertFalse(is_rate_limited(FakeHttpError(403, 'insufficientPermissions')))
+        self.assertFalse(is_rate_limited(FakeHttpError(500)))
+        self.assertFalse(is_rate_limited(FakeHttpError(503)))
+
+    def test_retries_and_slows_down(self):
+        scheduler = RateScheduler(qps=100, backoff_seconds=0.001)
+        request = FakeRequest([FakeHttpError(429), FakeHttpError(403, 'rateLimitExceeded')])
+        self.assertEquals(scheduler.execute(request), {'rows': []})
+        self.assertEquals(request.calls, 3)
+        self.assertEquals(scheduler.retries, 2)
+        self.assertTrue(scheduler.rate < 100)
+
+    def test_server_errors_keep_rate(self):
+        scheduler = RateScheduler(qps=100, backoff_seconds=0.001)
+        request = FakeRequest([FakeHttpError(500), FakeHttpError(503)])
+        self.assertEquals(scheduler.execute(request), {'rows': []})
+        self.assertEquals(scheduler.retries, 2)
+        self.assertEquals(scheduler.rate, 100)
+
+    def test_concurrency_follows_rate(self):
+        scheduler = RateScheduler(qps=100, max_concurrent=8)
+        self.assertEquals(scheduler.concurrency, 8)
+        scheduler.acquire()
+        scheduler.release(rate_limited=True)
+        self.assertEquals(scheduler.concurrency, 4)
+        for i in range(2):
+            scheduler.acquire()
+            scheduler.release(rate_limited=True)
+        self.assertEquals(scheduler.concurrency, 1)
+        scheduler.acquire()
+        scheduler.release()
+        self.assertTrue(scheduler.rate > 12.5)
+
+    def test_gives_up(self):
+        scheduler = RateScheduler(qps=100, max_retries=1, backoff_seconds=0.001)
+        request = FakeRequest([FakeHttpError(503), FakeHttpError(503), FakeHttpError(503)])
+        self.assertRaises(FakeHttpError, scheduler.execute, request)
+        self.assertEquals(request.calls, 2)
+        self.assertRaises(FakeHttpError, scheduler.execute, FakeRequest([FakeHttpError(400)]))
+
+    def test_daily_quota(self):
+        scheduler = RateScheduler(qps=100, daily_quota=2)
+        scheduler.execute(FakeRequest([]))
+        scheduler.execute(FakeRequest([]))
+        self.assertRaises(QuotaExceeded, scheduler.execute, FakeRequest([]))
@@ -0,0 +1,45 @@
+from unittest import TestCase
+
+from ckanext.googleanalytics import reporting_v4
+from ckanext.googleanalytics.ga_fake import FakeService, SyntheticResponses
+
+QUERIES = [{
+    'filters': 'ga:pagePath=~/dataset/',
+    'metrics': 'ga:uniquePageviews, ga:entrances',
+    'sort': 'ga:date',
+    'dimensions': 'ga:pagePath, ga:date',
+}, {
+    'filters': 'ga:browser!@Python;ga:networkDomain!=ua.es',
+    'metrics': 'ga:sessions',
+    'sort': '-ga:sessions',
+    'dimensions': 'ga:country, ga:date',
+}]
+
+
+class TestReportingV4(TestCase):
+    def test_request_round_trip(self):
+        request = reporting_v4.report_request('123', QUERIES[1], '2019-03-01', '2019-03-07')
+        self.assertEquals(request['orderBys'], [{'fieldName': 'ga:sessions', 'sortOrder': 'DESCENDING'}])
+        params = reporting_v4.v3_params(request)
+        self.assertEquals(params['ids'], 'ga:123')
+        for key in ('filters', 'metrics', 'sort', 'dimensions'):
+            self.assertEquals(params[key], QUERIES[1][key])
+
+    def test_batch_matches_v3(self):
+        service = FakeService(SyntheticResponses(rows_per_day=7))
+        calls = []
+
+        def execute(request):
+            calls.append(request)
+            return request.execute()
+
+        results = reporting_v4.batch_get(service, '0', QUERIES, '2019-03-01', '2019-03-03', execute, page_size=5)
+        # 21 rows per query in pages of 5
+        self.assertEquals(len(calls), 5)
+        for query, result in zip(QUERIES, results):
+            expected = service.data().ga().get(start_date='2019-03-01', end_date='2019-03-03', **query).execute()
+            self.assertEquals(result['rows'], expected['rows'])
+
+    def test_batch_size(self):
+        self.assertRaises(ValueError, reporting_v4.batch_get, None, '0', QUERIES * 3, '2019-03-01', '2019-03-03',
+                          None)
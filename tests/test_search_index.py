@@ -0,0 +1,83 @@
+import time
+
+import ckan.model as model
+from ckan.lib import search
+from pylons import config
+
+from fixtures import DatabaseTestCase, days_ago
+from ckanext.googleanalytics import search_index
+from ckanext.googleanalytics.model import PackageStats
+from ckanext.googleanalytics.plugin import GoogleAnalyticsPlugin
+
+
+class SearchIndexTestCase(DatabaseTestCase):
+    def setUp(self):
+        super(SearchIndexTestCase, self).setUp()
+        self.config = dict((key, config.get(key)) for key in
+                           ('googleanalytics.index_popularity', 'googleanalytics.views_recent_days'))
+        config['googleanalytics.views_recent_days'] = '30'
+
+    def tearDown(self):
+        for key, value in self.config.items():
+            if value is None:
+                config.pop(key, None)
+            else:
+                config[key] = value
+        super(SearchIndexTestCase, self).tearDown()
+
+    def add_package_stats(self, rows):
+        for package_id, days, visits, downloads in rows:
+            model.Session.add(PackageStats(package_id=package_id, visit_date=days_ago(days), visits=visits,
+                                           entrances=0, downloads=downloads))
+        model.Session.commit()
+
+
+class TestBeforeIndex(SearchIndexTestCase):
+    def setUp(self):
+        super(TestBeforeIndex, self).setUp()
+        self.dataset = self.create_dataset('dataset')
+        self.add_package_stats([(self.dataset['id'], 1, 3, 1), (self.dataset['id'], 100, 40, 2)])
+
+    def test_disabled_by_default(self):
+        config.pop('googleanalytics.index_popularity', None)
+        self.assertFalse(search_index.enabled())
+        pkg_dict = GoogleAnalyticsPlugin().before_index({'id': self.dataset['id']})
+        self.assertEquals(pkg_dict, {'id': self.dataset['id']})
+
+    def test_enabled(self):
+        config['googleanalytics.index_popularity'] = 'true'
+        pkg_dict = GoogleAnalyticsPlugin().before_index({'id': self.dataset['id']})
+        self.assertEquals(pkg_dict, {'id': self.dataset['id'], 'views_total': '000000000043',
+                                     'views_recent': '000000000003', 'downloads_total': '000000000003'})
+        # Zero padded so that string order is numeric order
+        self.assertTrue(search_index.popularity_fields('missing')['views_total'] < pkg_dict['views_total'])
+
+
+class TestReindexChanged(SearchIndexTestCase):
+    def setUp(self):
+        super(TestReindexChanged, self).setUp()
+        self.rebuilt = []
+        self.rebuild, self.commit = search.rebuild, search.commit
+        search.rebuild = lambda package_id, defer_commit=False: self.rebuilt.append(package_id)
+        search.commit = lambda: None
+
+    def tearDown(self):
+        search.rebuild, search.commit = self.rebuild, self.commit
+        super(TestReindexChanged, self).tearDown()
+
+    def test_reindexes_changed_datasets(self):
+        loaded = self.create_dataset('loaded')
+        dropped = self.create_dataset('dropped')
+        unchanged = self.create_dataset('unchanged')
+        self.add_package_stats([(loaded['id'], 1, 5, 0),
+                                (dropped['id'], 31, 5, 0),
+                                (unchanged['id'], 10, 5, 0),
+                                (unchanged['id'], 200, 5, 0)])
+
+        previous_ingest = time.mktime(days_ago(1).timetuple())
+        self.assertEquals(search_index.reindex_changed(days_ago(2), previous_ingest), 2)
+        self.assertEquals(sorted(self.rebuilt), sorted([loaded['id'], dropped['id']]))
+
+        del self.rebuilt[:]
+        self.assertEquals(search_index.reindex_changed(days_ago(2)), 1)
+        self.assertEquals(self.rebuilt, [loaded['id']])